@@ -4,83 +4,23 @@ This module contains functions, not specified for some out service.
 '''
 import os
 import logging
-import shutil
-import json
 from post import Post
+from jobstore import get_job_store
+from downloader import get_downloader
+from mediastore import get_media_store
 
 
 logger = logging.getLogger(__name__)
 
-def get_last_json_id(config: dict, service: str) -> int:
-    '''
-    Get last processed post id by service from file
-    '''
-    last_id_file_path = os.path.join(config['temp_dir'], '.last.json')
-    if os.path.exists(last_id_file_path):
-        with open(last_id_file_path, encoding='utf8') as last_id_file:
-            last_json = json.load(last_id_file)
-        if service in last_json.keys():
-            last_id = last_json[service]
-        else:
-            last_id = 0
-    else:
-        last_id = 0
-
-    logger.debug(
-        'Last id for service %s is %s',
-        service,
-        last_id
-    )
-    return last_id
-
-def write_last_json_id(config: dict, service: str, last_id: int) -> None:
-    '''
-    Write last processed post id by service to file
-    '''
-    last_id_file_path = os.path.join(config['temp_dir'], '.last.json')
-    if os.path.exists(last_id_file_path):
-        with open(last_id_file_path, encoding='utf8') as last_id_file:
-            last_json = json.load(last_id_file)
-        last_json[service] = last_id
-    else:
-        last_json = {service: last_id}
-
-    with open(last_id_file_path, 'w', encoding='utf-8') as last_id_file:
-        json.dump(last_json, last_id_file)
-        logger.info(
-            'Last id %s for service %s is written to %s',
-            last_id,
-            service,
-            last_id_file_path
-        )
-
 def get_last_id(config):
     '''
-    Get last processed post id from file
+    Get last processed post id from job store
     '''
-    last_id_file_path = os.path.join(config['temp_dir'], '.last')
-
-    if os.path.exists(last_id_file_path):
-        with open(last_id_file_path, encoding='utf8') as last_id_file:
-            last_id = int(last_id_file.read().strip())
-    else:
-        last_id = 0
-
+    last_id = get_job_store(config).last_id
     logger.debug('Last id is %s', last_id)
     return last_id
 
 
-def write_last_id(config, last_id):
-    '''
-    Wtite last processeed post id to file
-    '''
-    last_id_file_path = os.path.join(config['temp_dir'], '.last')
-
-    with open(last_id_file_path, 'w', encoding='utf-8') as last_id_file:
-        last_id_file.write(str(last_id))
-        logger.debug('Last id is written to %s', last_id_file_path)
-
-
 def make_content_dir(config):
     '''
     Creates temp content folder for photos.
@@ -94,12 +34,25 @@ def make_content_dir(config):
 
 def cleanup_content(config, posts: list[Post]):
     '''
-    Cleanup content from temp folder after processing
+    Release post content in temp folder after processing.
+    It is removed by media store GC, publishing does not wait for it.
     '''
+    media_store = get_media_store(config)
     for post in posts:
-        post_content = os.path.join(config['temp_dir'],'content',str(post.id))
-        try:
-            shutil.rmtree(post_content)
-            logger.info('Post content removed from %s', post_content)
-        except OSError as err:
-            logger.error('Cannot remove content from %s: %s', post_content, err)
+        media_store.release(post.id)
+        logger.debug('Post %s content released', post.id)
+
+
+def restore_post(config, post_data: dict, downloader=None) -> Post:
+    '''
+    Create post, saved to job store by previous run.
+    Photos, not downloaded before restart, are downloaded again
+    by downloader (process-wide one by default).
+    '''
+    downloader = downloader or get_downloader(config)
+    for photo_data in post_data['photos']:
+        if not os.path.exists(photo_data['file_path']):
+            photo_data['download'] = downloader.submit(photo_data['url'], photo_data['file_path'])
+    post = Post(post_data)
+    logger.info('Post %s restored from job store', post.id)
+    return post
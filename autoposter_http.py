@@ -0,0 +1,97 @@
+'''
+This module contains per-service HTTP sessions.
+Every service gets one keep-alive connection pool, shared by all its callers.
+Async engine uses httpx clients, HTTP/2 is negotiated if h2 is installed.
+'''
+from __future__ import annotations
+
+import logging
+import threading
+import importlib.util
+from typing import TYPE_CHECKING
+import requests
+from requests.adapters import HTTPAdapter
+from lazyimport import lazy_import
+from metrics import api_call
+
+if TYPE_CHECKING:
+    from settings import AppConfig
+
+# Loaded by async engine only
+httpx = lazy_import('httpx')
+
+
+logger = logging.getLogger(__name__)
+
+# Services, which use proxy from config[service]['proxy']
+PROXIED_SERVICES = {'instagram'}
+
+_sessions: dict[str, tuple[str | None, requests.Session]] = {}
+_sessions_lock = threading.Lock()
+
+HTTP2 = importlib.util.find_spec('h2') is not None
+
+_clients: dict[str, tuple[str | None, httpx.AsyncClient]] = {}
+
+
+def get_session(config: AppConfig, service: str, pool_size: int = 10) -> requests.Session:
+    '''
+    Return process-wide session of service.
+    Session is recreated when service proxy is changed in config.
+    '''
+    proxies = config.proxies.get(service)
+    proxy = proxies['https'] if proxies else None
+
+    with _sessions_lock:
+        cached = _sessions.get(service)
+        if cached is not None and cached[0] == proxy:
+            return cached[1]
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.hooks['response'].append(
+            lambda response, *args, **kwargs: api_call(service, response.status_code)
+        )
+        if proxies:
+            session.proxies.update(proxies)
+            logger.debug('Using proxy %s for %s', proxy, service)
+
+        if cached is not None:
+            cached[1].close()
+        _sessions[service] = (proxy, session)
+        logger.debug('HTTP session for %s created', service)
+        return session
+
+
+async def get_async_client(
+    config: AppConfig,
+    service: str,
+    pool_size: int = 10
+) -> httpx.AsyncClient:
+    '''
+    Return async client of service. Clients are bound to event loop of async engine,
+    client is recreated when service proxy is changed in config.
+    '''
+    proxies = config.proxies.get(service)
+    proxy = proxies['https'] if proxies else None
+
+    cached = _clients.get(service)
+    if cached is not None and cached[0] == proxy:
+        return cached[1]
+
+    async def count_call(response: httpx.Response) -> None:
+        api_call(service, response.status_code)
+
+    client = httpx.AsyncClient(
+        http2=HTTP2,
+        proxy=proxy,
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        event_hooks={'response': [count_call]}
+    )
+    _clients[service] = (proxy, client)
+    logger.debug('Async HTTP client for %s created, HTTP/2 %s', service, HTTP2)
+    if cached is not None:
+        await cached[1].aclose()
+    return client
@@ -0,0 +1,413 @@
+'''
+This module contains Instagram related functions.
+Media containers are created concurrently and published
+as soon as Instagram reports them ready.
+AsyncContainerPipeline does the same on event loop of async engine.
+'''
+from __future__ import annotations
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from autoposter_http import get_async_client, get_session
+from lazyimport import lazy_import
+from metrics import STAGE_SECONDS
+from ratelimit import get_retrier
+
+# Used by AsyncContainerPipeline only
+asyncio = lazy_import('asyncio')
+httpx = lazy_import('httpx')
+
+logger = logging.getLogger(__name__)
+
+GRAPH_URL = 'https://graph.instagram.com/v21.0'
+
+# Container status polling: first delay, growth factor and max delay, seconds
+POLL_DELAY = 0.5
+POLL_FACTOR = 1.5
+POLL_MAX_DELAY = 8
+
+# OAuthException: access token is invalid or expired
+AUTH_ERROR_CODE = 190
+# Graph API errors of throttling, temporary failures and media, not ready yet
+TRANSIENT_CODES = frozenset({1, 2, 4, 17, 32, 613, 9007})
+
+# app_token: Instagram user_id
+_identities: dict[str, str] = {}
+
+
+class InstagramError(Exception):
+    '''Instagram API returned error'''
+    def __init__(self, message: str, error: dict | None = None):
+        '''error - Graph API error object, if any'''
+        super().__init__(message)
+        self.error = error or {}
+        # Used by retriers: request was rejected, so it may be repeated
+        self.retryable = bool(self.error.get('is_transient')) or (
+            self.error.get('code') in TRANSIENT_CODES
+        )
+
+
+class ContainerError(InstagramError):
+    '''Instagram media container cannot be created or processed'''
+    def __init__(self, message: str, error: dict | None = None):
+        super().__init__(message, error)
+        if error is None:
+            # Processing failed or timed out, new container may succeed
+            self.retryable = True
+
+
+def get_user_id(config: dict) -> str:
+    '''
+    Return Instagram user_id of config['instagram']['app_token'].
+    It is requested once per token and kept until auth error.
+    '''
+    token = config['instagram']['app_token']
+    if (user_id := _identities.get(token)) is None:
+        session = get_session(config, 'instagram')
+        user_id = get_retrier(config, 'instagram').call(lambda: _remember_user(
+            token,
+            _json(session.get(
+                f'{GRAPH_URL}/me',
+                params={
+                    'access_token': token,
+                    'fields': 'user_id,username,account_type,name'
+                },
+                timeout=config['instagram']['timeout']
+            ))
+        ))
+    return user_id
+
+
+async def get_user_id_async(config: dict) -> str:
+    '''
+    Same as get_user_id, identity is requested by async client
+    '''
+    token = config['instagram']['app_token']
+    if (user_id := _identities.get(token)) is None:
+        client = await get_async_client(config, 'instagram')
+
+        async def request() -> str:
+            response = await client.get(
+                f'{GRAPH_URL}/me',
+                params={
+                    'access_token': token,
+                    'fields': 'user_id,username,account_type,name'
+                },
+                timeout=config['instagram']['timeout']
+            )
+            return _remember_user(token, _json(response))
+
+        user_id = await get_retrier(config, 'instagram').call_async(request)
+    return user_id
+
+
+def _remember_user(token: str, me: dict) -> str:
+    '''Keep user_id of token, returned by /me'''
+    if 'user_id' not in me:
+        check_result(me)
+        raise InstagramError(f'Cannot get Instagram user: {me}', me.get('error'))
+    user_id = me['user_id']
+    # Every route may have its own token
+    _identities[token] = user_id
+    logger.debug('Instagram user ID is %s', user_id)
+    return user_id
+
+
+def check_result(result: dict) -> None:
+    '''
+    Forget cached identity on auth error, so it is requested again on retry
+    '''
+    if result.get('error', {}).get('code') == AUTH_ERROR_CODE:
+        logger.warning('Instagram auth error, user id will be requested again: %s', result)
+        _identities.clear()
+
+
+def _json(response) -> dict:
+    '''
+    Return Graph API result of requests or httpx response.
+    Server error is raised as HTTP error, so retriers tell it by status.
+    '''
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response.json()
+
+
+def _checked(result: dict, message: str) -> dict:
+    '''Return Graph API result, raise ContainerError with its error if it has no id'''
+    if 'id' not in result:
+        check_result(result)
+        raise ContainerError(f'{message}: {result}', result.get('error') or {})
+    return result
+
+
+class ContainerPipeline:
+    '''
+    Creates Instagram media containers, waits until they are processed
+    and publishes them
+    '''
+    def __init__(self, config: dict, ig_id: str):
+        self.__ig_id = ig_id
+        self.__session = get_session(config, 'instagram')
+        self.__token = config['instagram']['app_token']
+        self.__timeout = config['instagram']['timeout']
+        self.__ready_timeout = config['instagram'].get('container_timeout', 120)
+        self.__concurrency = config['instagram'].get('concurrency', 4)
+        self.__retrier = get_retrier(config, 'instagram')
+        self.__timings: dict[str, float] = {}
+
+    def __create(self, params: dict) -> str:
+        '''Create media container, return its id'''
+        # Container, created twice, is never published and expires
+        result = self.__retrier.call(lambda: _checked(
+            _json(self.__session.post(
+                f'{GRAPH_URL}/{self.__ig_id}/media',
+                params={**params, 'access_token': self.__token},
+                timeout=self.__timeout
+            )),
+            f'Container is not created for {params}'
+        ))
+        logger.debug('Container %s created for %s', result['id'], params)
+        return result['id']
+
+    def __status(self, container_id: str) -> dict:
+        '''Return container status'''
+        def request() -> dict:
+            status = _json(self.__session.get(
+                f'{GRAPH_URL}/{container_id}',
+                params={'fields': 'status_code,status', 'access_token': self.__token},
+                timeout=self.__timeout
+            ))
+            if 'error' in status:
+                check_result(status)
+                raise InstagramError(
+                    f'Container {container_id} status error: {status}',
+                    status['error']
+                )
+            return status
+
+        return self.__retrier.call(request)
+
+    def __wait_ready(self, container_id: str) -> None:
+        '''
+        Poll container status_code with growing delay until it is FINISHED
+        '''
+        started = time.monotonic()
+        delay = POLL_DELAY
+        while True:
+            status = self.__status(container_id)
+            if (status_code := status.get('status_code')) == 'FINISHED':
+                return
+            if status_code in {'ERROR', 'EXPIRED'}:
+                raise ContainerError(f'Container {container_id} is {status_code}: {status}')
+            if time.monotonic() - started + delay > self.__ready_timeout:
+                raise ContainerError(
+                    f'Container {container_id} is not ready in {self.__ready_timeout} s: {status}'
+                )
+            logger.debug(
+                'Container %s status is %s, next check in %s s',
+                container_id,
+                status,
+                delay
+            )
+            time.sleep(delay)
+            delay = min(delay * POLL_FACTOR, POLL_MAX_DELAY)
+
+    def __prepare(self, name: str, params: dict) -> str:
+        '''Create container and wait until it is ready, return its id'''
+        started = time.monotonic()
+        container_id = self.__create(params)
+        self.__wait_ready(container_id)
+        self.__timings[name] = time.monotonic() - started
+        STAGE_SECONDS.observe(self.__timings[name], 'instagram_container')
+        return container_id
+
+    def publish(self, photo_urls: list[str], caption: str) -> str:
+        '''
+        Publish single photo or carousel, return Instagram media id
+        '''
+        started = time.monotonic()
+        if len(photo_urls) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(self.__concurrency, len(photo_urls)),
+                thread_name_prefix='inst-container'
+            ) as executor:
+                children = list(executor.map(
+                    lambda photo_url: self.__prepare(
+                        photo_url,
+                        {'image_url': photo_url, 'is_carousel_item': 'true'}
+                    ),
+                    photo_urls
+                ))
+            container_id = self.__prepare(
+                'carousel',
+                {'caption': caption, 'media_type': 'CAROUSEL', 'children': ','.join(children)}
+            )
+        else:
+            container_id = self.__prepare(
+                photo_urls[0],
+                {'image_url': photo_urls[0], 'caption': caption}
+            )
+
+        # Publish request, timed out after Instagram got it, is not repeated
+        result = self.__retrier.call(
+            lambda: _checked(
+                _json(self.__session.post(
+                    f'{GRAPH_URL}/{self.__ig_id}/media_publish',
+                    params={'creation_id': container_id, 'access_token': self.__token},
+                    timeout=self.__timeout
+                )),
+                f'Container {container_id} is not published'
+            ),
+            idempotent=False
+        )
+        logger.info('Instagram post result: %s', result)
+
+        for name, elapsed in self.__timings.items():
+            logger.info('Instagram container %s ready in %.1f s', name, elapsed)
+        STAGE_SECONDS.observe(time.monotonic() - started, 'instagram')
+        logger.info(
+            'Instagram media %s published in %.1f s',
+            result['id'],
+            time.monotonic() - started
+        )
+        return result['id']
+
+
+class AsyncContainerPipeline:
+    '''
+    Same as ContainerPipeline on event loop of async engine:
+    requests are sent by async client, status polling does not block loop
+    '''
+    def __init__(self, config: dict, ig_id: str, client: httpx.AsyncClient):
+        self.__ig_id = ig_id
+        self.__client = client
+        self.__token = config['instagram']['app_token']
+        self.__timeout = config['instagram']['timeout']
+        self.__ready_timeout = config['instagram'].get('container_timeout', 120)
+        self.__slots = asyncio.Semaphore(config['instagram'].get('concurrency', 4))
+        self.__retrier = get_retrier(config, 'instagram')
+        self.__timings: dict[str, float] = {}
+
+    async def __create(self, params: dict) -> str:
+        '''Create media container, return its id'''
+        async def request() -> dict:
+            response = await self.__client.post(
+                f'{GRAPH_URL}/{self.__ig_id}/media',
+                params={**params, 'access_token': self.__token},
+                timeout=self.__timeout
+            )
+            return _checked(_json(response), f'Container is not created for {params}')
+
+        result = await self.__retrier.call_async(request)
+        logger.debug('Container %s created for %s', result['id'], params)
+        return result['id']
+
+    async def __status(self, container_id: str) -> dict:
+        '''Return container status'''
+        async def request() -> dict:
+            response = await self.__client.get(
+                f'{GRAPH_URL}/{container_id}',
+                params={'fields': 'status_code,status', 'access_token': self.__token},
+                timeout=self.__timeout
+            )
+            if 'error' in (status := _json(response)):
+                check_result(status)
+                raise InstagramError(
+                    f'Container {container_id} status error: {status}',
+                    status['error']
+                )
+            return status
+
+        return await self.__retrier.call_async(request)
+
+    async def __wait_ready(self, container_id: str) -> None:
+        '''
+        Poll container status_code with growing delay until it is FINISHED
+        '''
+        started = time.monotonic()
+        delay = POLL_DELAY
+        while True:
+            status = await self.__status(container_id)
+            if (status_code := status.get('status_code')) == 'FINISHED':
+                return
+            if status_code in {'ERROR', 'EXPIRED'}:
+                raise ContainerError(f'Container {container_id} is {status_code}: {status}')
+            if time.monotonic() - started + delay > self.__ready_timeout:
+                raise ContainerError(
+                    f'Container {container_id} is not ready in {self.__ready_timeout} s: {status}'
+                )
+            logger.debug(
+                'Container %s status is %s, next check in %s s',
+                container_id,
+                status,
+                delay
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * POLL_FACTOR, POLL_MAX_DELAY)
+
+    async def __prepare(self, name: str, params: dict) -> str:
+        '''Create container and wait until it is ready, return its id'''
+        async with self.__slots:
+            started = time.monotonic()
+            container_id = await self.__create(params)
+            await self.__wait_ready(container_id)
+        self.__timings[name] = time.monotonic() - started
+        STAGE_SECONDS.observe(self.__timings[name], 'instagram_container')
+        return container_id
+
+    async def publish(self, photo_urls: list[str], caption: str) -> str:
+        '''
+        Publish single photo or carousel, return Instagram media id
+        '''
+        started = time.monotonic()
+        if len(photo_urls) > 1:
+            children = [
+                asyncio.ensure_future(self.__prepare(
+                    photo_url,
+                    {'image_url': photo_url, 'is_carousel_item': 'true'}
+                ))
+                for photo_url in photo_urls
+            ]
+            try:
+                await asyncio.gather(*children)
+            except Exception:
+                # Containers of failed carousel are not needed
+                for child in children:
+                    child.cancel()
+                raise
+            container_id = await self.__prepare(
+                'carousel',
+                {
+                    'caption': caption,
+                    'media_type': 'CAROUSEL',
+                    'children': ','.join(child.result() for child in children)
+                }
+            )
+        else:
+            container_id = await self.__prepare(
+                photo_urls[0],
+                {'image_url': photo_urls[0], 'caption': caption}
+            )
+
+        async def request() -> dict:
+            response = await self.__client.post(
+                f'{GRAPH_URL}/{self.__ig_id}/media_publish',
+                params={'creation_id': container_id, 'access_token': self.__token},
+                timeout=self.__timeout
+            )
+            return _checked(_json(response), f'Container {container_id} is not published')
+
+        # Publish request, timed out after Instagram got it, is not repeated
+        result = await self.__retrier.call_async(request, idempotent=False)
+        logger.info('Instagram post result: %s', result)
+
+        for name, elapsed in self.__timings.items():
+            logger.info('Instagram container %s ready in %.1f s', name, elapsed)
+        STAGE_SECONDS.observe(time.monotonic() - started, 'instagram')
+        logger.info(
+            'Instagram media %s published in %.1f s',
+            result['id'],
+            time.monotonic() - started
+        )
+        return result['id']
@@ -0,0 +1,338 @@
+'''
+This module contains Telegram related functions.
+One bot is kept for process lifetime, large posts are sent
+as several media groups, uploaded photos are reused by file_id.
+Async engine calls Bot API with httpx client, sharing the same state.
+'''
+from __future__ import annotations
+
+import os
+import json
+import math
+import logging
+import functools
+import threading
+from contextlib import ExitStack
+from typing import TYPE_CHECKING
+import telebot
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from telebot.types import InputMediaPhoto
+from lazyimport import lazy_import
+from photo import Photo
+from metrics import STAGE_SECONDS, api_call
+
+if TYPE_CHECKING:
+    from ratelimit import Retrier
+
+httpx = lazy_import('httpx')
+
+
+logger = logging.getLogger(__name__)
+
+# sendMediaGroup accepts 2-10 items
+MEDIA_GROUP_MAX = 10
+
+# Used unless telebot apihelper.API_URL is set, e.g. to local Bot API server
+BOT_API_URL = 'https://api.telegram.org/bot{0}/{1}'
+
+# Telegram cannot download photo by URL
+URL_ERRORS = (
+    'failed to get http url content',
+    'wrong file identifier/http url specified',
+    'wrong type of the web page content',
+    'webpage_curl_failed',
+)
+
+
+def split_media(photos: list[Photo]) -> list[list[Photo]]:
+    '''
+    Split photos to the least number of media groups of nearly equal size,
+    so no group has a single photo
+    '''
+    chunks_count = math.ceil(len(photos) / MEDIA_GROUP_MAX)
+    chunk_size, larger_chunks = divmod(len(photos), chunks_count)
+    chunks = []
+    start = 0
+    for chunk_index in range(chunks_count):
+        end = start + chunk_size + (1 if chunk_index < larger_chunks else 0)
+        chunks.append(photos[start:end])
+        start = end
+    return chunks
+
+
+class TelegramPublisher:
+    '''
+    Publishes posts to Telegram channels with one long-lived bot
+    '''
+    def __init__(self, token: str):
+        self.__token = token
+        self.__bot = telebot.TeleBot(token, threaded=False)
+        self.__lock = threading.Lock()
+        # photo url: file_id of photo, uploaded to Telegram
+        self.__file_ids: dict[str, str] = {}
+        # (post id, channel id, chunk index) of chunks already sent
+        self.__sent: set[tuple] = set()
+
+    def __media(self, photo: Photo, local_file: bool, stack: ExitStack) -> InputMediaPhoto:
+        '''Return photo as file_id if it is known, as URL or as local file'''
+        if file_id := photo.tg_file_id or self.__file_ids.get(photo.url):
+            return InputMediaPhoto(media=file_id)
+        if local_file:
+            return InputMediaPhoto(media=stack.enter_context(open(photo.wait_download(), 'rb')))
+        return InputMediaPhoto(media=photo.url)
+
+    def __send_media(
+        self,
+        channel_id,
+        photos: list[Photo],
+        caption: str | None,
+        local_file: bool
+    ) -> list:
+        '''Send photos as one message or media group, return sent messages'''
+        with ExitStack() as stack:
+            medias = [self.__media(photo, local_file, stack) for photo in photos]
+            if caption:
+                medias[0].caption = caption
+                medias[0].parse_mode = 'markdown'
+            try:
+                if len(medias) == 1:
+                    messages = [self.__bot.send_photo(
+                        chat_id=channel_id,
+                        photo=medias[0].media,
+                        caption=medias[0].caption,
+                        parse_mode=medias[0].parse_mode
+                    )]
+                else:
+                    messages = self.__bot.send_media_group(chat_id=channel_id, media=medias)
+            except ApiTelegramException as err:
+                api_call('telegram', err.error_code)
+                raise
+        api_call('telegram', 200)
+        return messages
+
+    def __send_chunk(
+        self,
+        retrier: Retrier,
+        channel_id,
+        photos: list[Photo],
+        caption: str | None
+    ) -> None:
+        '''
+        Send photos as one message or media group.
+        If Telegram cannot fetch photo URLs, local files are uploaded.
+        '''
+        for local_file in (False, True):
+            try:
+                # Message, timed out after Telegram got it, is not sent again
+                messages = retrier.call(
+                    functools.partial(self.__send_media, channel_id, photos, caption, local_file),
+                    idempotent=False
+                )
+                break
+            except ApiTelegramException as err:
+                if local_file or not any(
+                    error in err.description.lower() for error in URL_ERRORS
+                ):
+                    raise
+                logger.warning(
+                    'Telegram cannot get photos by URL, uploading local files: %s',
+                    err.description
+                )
+
+        for photo, message in zip(photos, messages):
+            if message.photo:
+                self.__remember(photo, message.photo[-1].file_id)
+
+    def __remember(self, photo: Photo, file_id: str) -> None:
+        '''Reuse uploaded photo by file_id'''
+        photo.tg_file_id = file_id
+        with self.__lock:
+            self.__file_ids[photo.url] = file_id
+
+    def __media_value(self, photo: Photo, local_file: bool, files: dict) -> str:
+        '''Return photo as file_id, URL or attach:// name of local file, added to files'''
+        if file_id := photo.tg_file_id or self.__file_ids.get(photo.url):
+            return file_id
+        if local_file:
+            name = f'photo{len(files)}'
+            with open(photo.file_path, 'rb') as photo_file:
+                files[name] = (os.path.basename(photo.file_path), photo_file.read())
+            return f'attach://{name}'
+        return photo.url
+
+    async def __send_media_async(
+        self,
+        client: httpx.AsyncClient,
+        channel_id,
+        photos: list[Photo],
+        caption: str | None,
+        local_file: bool
+    ) -> list[dict]:
+        '''Same as __send_media with Bot API request sent by async client'''
+        files = {}
+        medias = [
+            {'type': 'photo', 'media': self.__media_value(photo, local_file, files)}
+            for photo in photos
+        ]
+        if caption:
+            medias[0].update(caption=caption, parse_mode='markdown')
+        if len(medias) == 1:
+            method = 'sendPhoto'
+            params = {'chat_id': channel_id, **medias[0]}
+            del params['type']
+            if files:
+                # Single photo is uploaded as the parameter itself
+                files = {'photo': files.pop(params.pop('media')[len('attach://'):])}
+            else:
+                params['photo'] = params.pop('media')
+        else:
+            method = 'sendMediaGroup'
+            params = {'chat_id': channel_id, 'media': json.dumps(medias)}
+
+        # Parameters are sent in query string and timeouts are the same as by telebot
+        response = await client.post(
+            (apihelper.API_URL or BOT_API_URL).format(self.__token, method),
+            params=params,
+            files=files or None,
+            timeout=httpx.Timeout(apihelper.READ_TIMEOUT, connect=apihelper.CONNECT_TIMEOUT)
+        )
+        if not (result := response.json()).get('ok'):
+            raise ApiTelegramException(method, response, result)
+        return result['result'] if isinstance(result['result'], list) else [result['result']]
+
+    async def __send_chunk_async(
+        self,
+        client: httpx.AsyncClient,
+        retrier: Retrier,
+        channel_id,
+        photos: list[Photo],
+        caption: str | None
+    ) -> None:
+        '''Same as __send_chunk with Bot API requests sent by async client'''
+        for local_file in (False, True):
+            if local_file:
+                for photo in photos:
+                    await photo.wait_download_async()
+            try:
+                # Message, timed out after Telegram got it, is not sent again
+                messages = await retrier.call_async(
+                    functools.partial(
+                        self.__send_media_async,
+                        client,
+                        channel_id,
+                        photos,
+                        caption,
+                        local_file
+                    ),
+                    idempotent=False
+                )
+                break
+            except ApiTelegramException as err:
+                if local_file or not any(
+                    error in err.description.lower() for error in URL_ERRORS
+                ):
+                    raise
+                logger.warning(
+                    'Telegram cannot get photos by URL, uploading local files: %s',
+                    err.description
+                )
+
+        for photo, message in zip(photos, messages):
+            if message.get('photo'):
+                # Last size is the original one
+                self.__remember(photo, message['photo'][-1]['file_id'])
+
+    def publish(
+        self,
+        retrier: Retrier,
+        post_id: int,
+        channel_ids: list,
+        text: str,
+        photos: list[Photo]
+    ) -> None:
+        '''
+        Publish post to every channel, requests are sent by retrier.
+        Chunks, sent before failed retry, are not sent again.
+        '''
+        with STAGE_SECONDS.time('telegram'):
+            self.__publish(retrier, post_id, channel_ids, text, photos)
+
+    def __publish(
+        self,
+        retrier: Retrier,
+        post_id: int,
+        channel_ids: list,
+        text: str,
+        photos: list[Photo]
+    ) -> None:
+        '''Send chunks, not sent yet, to every channel'''
+        chunks = split_media(photos)
+        for channel_id in channel_ids:
+            for chunk_index, chunk in enumerate(chunks):
+                if (sent_key := (post_id, channel_id, chunk_index)) in self.__sent:
+                    logger.debug('Post %s part %s is already sent to %s', *sent_key)
+                    continue
+                self.__send_chunk(retrier, channel_id, chunk, text if chunk_index == 0 else None)
+                self.__sent.add(sent_key)
+
+            logger.info(
+                'Post id=%s (%s photos, %s messages) reposted to Telegram channel %s',
+                post_id,
+                len(photos),
+                len(chunks),
+                channel_id
+            )
+
+        self.__sent = {key for key in self.__sent if key[0] != post_id}
+
+    async def publish_async(
+        self,
+        client: httpx.AsyncClient,
+        retrier: Retrier,
+        post_id: int,
+        channel_ids: list,
+        text: str,
+        photos: list[Photo]
+    ) -> None:
+        '''
+        Same as publish on event loop of async engine
+        '''
+        with STAGE_SECONDS.time('telegram'):
+            chunks = split_media(photos)
+            for channel_id in channel_ids:
+                for chunk_index, chunk in enumerate(chunks):
+                    if (sent_key := (post_id, channel_id, chunk_index)) in self.__sent:
+                        logger.debug('Post %s part %s is already sent to %s', *sent_key)
+                        continue
+                    await self.__send_chunk_async(
+                        client,
+                        retrier,
+                        channel_id,
+                        chunk,
+                        text if chunk_index == 0 else None
+                    )
+                    self.__sent.add(sent_key)
+
+                logger.info(
+                    'Post id=%s (%s photos, %s messages) reposted to Telegram channel %s',
+                    post_id,
+                    len(photos),
+                    len(chunks),
+                    channel_id
+                )
+
+            self.__sent = {key for key in self.__sent if key[0] != post_id}
+
+
+_publishers: dict[str, TelegramPublisher] = {}
+
+
+def get_telegram_publisher(config: dict) -> TelegramPublisher:
+    '''
+    Return publisher for config['telegram']['token'], kept for process lifetime
+    '''
+    if (token := config['telegram']['token']) not in _publishers:
+        _publishers.clear()
+        _publishers[token] = TelegramPublisher(token)
+    return _publishers[token]
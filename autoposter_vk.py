@@ -1,46 +1,434 @@
 '''
 This module contains VK related functions
 '''
+from __future__ import annotations
+
 import os
+import time
 import logging
-import urllib.request
-import requests.exceptions
+import threading
+from collections.abc import Callable, Iterator
+import requests
 import vk
+from vk.exceptions import VkAPIError
 from post import Post
 from autoposter_common import get_last_id, make_content_dir
+from downloader import get_async_downloader, get_downloader
+from autoposter_http import get_async_client, get_session
+from lazyimport import lazy_import
+from ratelimit import Retrier, RetryPolicy, get_retrier
+
+httpx = lazy_import('httpx')
 
 logger = logging.getLogger(__name__)
 
+VK_API_VERSION = '5.199'
+VK_API_URL = 'https://api.vk.com/method/'
+# Seconds to wait for VK API response, as vk.API does
+VK_API_TIMEOUT = 10
+# wall.get maximum count
+WALL_PAGE_SIZE = 100
+# Bots Long Poll request hold time, seconds (90 at most)
+LONG_POLL_WAIT = 25
+# Pause after Long Poll error grows up to this, seconds
+LONG_POLL_MAX_DELAY = 300
+# Long Poll is watched forever, so attempts are not limited
+LONG_POLL_RETRIES = RetryPolicy(attempts=0, delay=1, max_delay=LONG_POLL_MAX_DELAY)
+
+
+class SessionAPI(vk.API):
+    '''
+    vk.API, sending requests through shared VK session and VK retrier
+    '''
+    def __init__(self, session: requests.Session, retrier: Retrier, access_token=None, **kwargs):
+        super().__init__(access_token, **kwargs)
+        session.headers['Accept'] = 'application/json'
+        session.headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.session = session
+        self.retrier = retrier
+
+    def send(self, request):
+        '''Send API request, repeating it after transient errors'''
+        send = super().send
+        return self.retrier.call(lambda: send(request))
+
+
+class AsyncVkApi:
+    '''
+    VK API methods, called by async client through VK retrier
+    '''
+    def __init__(self, client: httpx.AsyncClient, retrier: Retrier, access_token: str):
+        self.__client = client
+        self.__retrier = retrier
+        self.__access_token = access_token
+
+    async def call(self, method: str, **params) -> dict:
+        '''Call API method, return its response. API error is raised as by vk.API.'''
+        async def request() -> dict:
+            response = await self.__client.post(
+                VK_API_URL + method,
+                data={**params, 'access_token': self.__access_token},
+                headers={'Accept': 'application/json'},
+                timeout=VK_API_TIMEOUT
+            )
+            response.raise_for_status()
+            if 'error' in (result := response.json()):
+                raise VkAPIError(result['error'])
+            return result['response']
+
+        return await self.__retrier.call_async(request)
+
+
+class VkWallScanner:
+    '''
+    Walks VK wall from newest post to older ones page by page
+    and stops at already processed post.
+    Without processed posts (last_id is 0) only the first full page is taken,
+    older history is reposted by backfill.
+    vk_api is vk.API for scan or AsyncVkApi for scan_async.
+    '''
+    def __init__(self, vk_api, group_id: int, first_page_size: int = 10):
+        self.__vk_api = vk_api
+        self.__group_id = group_id
+        self.__first_page_size = min(first_page_size, WALL_PAGE_SIZE)
+        self.__newest_seen = 0
+        # Date of newest post, returned by scan, including posts skipped by caller
+        self.__newest_handled = 0
+
+    @property
+    def newest_seen(self) -> int:
+        ''' Return date of newest post ever seen on wall '''
+        return self.__newest_seen
+
+    def scan(self, last_id: int) -> Iterator[dict]:
+        '''
+        Yield wall posts newer than last_id, oldest first
+        '''
+        count = self.__first_count(last_id)
+        new = {}
+        offset = 0
+        while True:
+            items = self.__vk_api.wall.get(
+                owner_id=self.__group_id,
+                count=count,
+                v=VK_API_VERSION,
+                filter='owner',
+                offset=offset
+            )['items']
+            if self.__take_page(items, offset, count, last_id, new):
+                break
+            offset += len(items)
+            count = WALL_PAGE_SIZE
+
+        yield from self.__handled(new)
+
+    async def scan_async(self, last_id: int) -> list[dict]:
+        '''
+        Same as scan, wall pages are requested by async client
+        '''
+        count = self.__first_count(last_id)
+        new = {}
+        offset = 0
+        while True:
+            items = (await self.__vk_api.call(
+                'wall.get',
+                owner_id=self.__group_id,
+                count=count,
+                v=VK_API_VERSION,
+                filter='owner',
+                offset=offset
+            ))['items']
+            if self.__take_page(items, offset, count, last_id, new):
+                break
+            offset += len(items)
+            count = WALL_PAGE_SIZE
+
+        return self.__handled(new)
+
+    def scan_history(
+        self,
+        since: int = 0,
+        until: int | None = None,
+        min_id: int = 0,
+        max_id: int | None = None
+    ) -> Iterator[dict]:
+        '''
+        Yield wall posts, published in [since, until) with id in [min_id, max_id],
+        newest first. Pages are requested until older post is found.
+        Same post may come twice, if posts are published during scan.
+        '''
+        offset = 0
+        while True:
+            items = self.__vk_api.wall.get(
+                owner_id=self.__group_id,
+                count=WALL_PAGE_SIZE,
+                v=VK_API_VERSION,
+                filter='owner',
+                offset=offset
+            )['items']
+            logger.debug('VK wall history page offset=%s: %s posts', offset, len(items))
+            for post in items:
+                if post['date'] < since or post['id'] < min_id:
+                    if post.get('is_pinned'):
+                        # Pinned post is on top regardless of its date
+                        continue
+                    return
+                if (until is None or post['date'] < until) and (
+                    max_id is None or post['id'] <= max_id
+                ):
+                    yield post
+            if len(items) < WALL_PAGE_SIZE:
+                return
+            offset += len(items)
+
+    def __first_count(self, last_id: int) -> int:
+        '''Return size of first page'''
+        # Nothing was pending after previous poll, so new posts (if any)
+        # fit into small first page. Otherwise start with full page.
+        # Posts, skipped by caller, do not move last_id, but they are handled.
+        if last_id and 0 < self.__newest_seen <= max(last_id, self.__newest_handled):
+            return self.__first_page_size
+        return WALL_PAGE_SIZE
+
+    def __handled(self, new: dict[int, dict]) -> list[dict]:
+        '''Return new posts oldest first, they are handled by caller'''
+        logger.debug('%s new posts found on VK wall %s', len(new), self.__group_id)
+        if posts := sorted(new.values(), key=lambda post: post['date']):
+            self.__newest_handled = max(self.__newest_handled, posts[-1]['date'])
+        return posts
+
+    def __take_page(
+        self,
+        items: list[dict],
+        offset: int,
+        count: int,
+        last_id: int,
+        new: dict[int, dict]
+    ) -> bool:
+        '''
+        Add posts newer than last_id from page to new.
+        Return True if there is no need for next page.
+        '''
+        logger.debug('VK wall page offset=%s count=%s: %s posts', offset, count, len(items))
+        for post in items:
+            self.__newest_seen = max(self.__newest_seen, post['date'])
+            if post['date'] > last_id:
+                # Posts published during scan shift offsets, so same post
+                # may come twice
+                new[post['id']] = post
+            elif not post.get('is_pinned'):
+                # Pinned post is on top regardless of its date
+                return True
+        # Nothing is processed yet: first page only, not the whole wall
+        return not last_id or len(items) < count
+
+
+class VkLongPoll:
+    '''
+    Watches VK Bots Long Poll of group in background thread
+    and sets new_post event on every wall_post_new update.
+    Group token must have Long Poll enabled with "wall_post_new" event.
+    '''
+    def __init__(
+        self,
+        vk_api,
+        session: requests.Session,
+        retrier: Retrier,
+        group_id: int,
+        timeout: float = 10,
+        new_post: threading.Event | None = None
+    ):
+        '''
+        retrier - VK retrier, it repeats update checks after transient errors
+        as API calls of vk_api.
+        new_post - if given, event is shared, e.g. by Long Polls of several groups
+        '''
+        self.__vk_api = vk_api
+        self.__session = session
+        self.__retrier = retrier
+        # Long Poll server of community is requested by positive id
+        self.__group_id = abs(group_id)
+        self.__timeout = timeout
+        self.new_post = new_post or threading.Event()
+
+    def start(self) -> None:
+        '''Start watching in daemon thread'''
+        threading.Thread(target=self.__run, name='vk-long-poll', daemon=True).start()
+        logger.info('VK Long Poll of group %s started', self.__group_id)
+
+    def __get_server(self) -> dict:
+        '''Return server, key and ts of Long Poll session'''
+        return self.__vk_api.groups.getLongPollServer(
+            group_id=self.__group_id,
+            v=VK_API_VERSION
+        )
+
+    def __run(self) -> None:
+        '''Poll forever, errors are logged and retried with growing pause'''
+        failures = 0
+        server = None
+        while True:
+            try:
+                if server is None:
+                    server = self.__get_server()
+                server = self.__check(server)
+                failures = 0
+            except Exception as err: # pylint: disable=broad-exception-caught
+                failures += 1
+                delay = LONG_POLL_RETRIES.backoff(failures)
+                logger.warning(
+                    '%s: VK Long Poll error, retry in %.1f s: %s',
+                    type(err),
+                    delay,
+                    err
+                )
+                server = None
+                time.sleep(delay)
+
+    def __check(self, server: dict) -> dict | None:
+        '''
+        Wait for updates once, return server to continue with
+        or None if new session is needed
+        '''
+        def request() -> dict:
+            response = self.__session.get(
+                server['server'],
+                params={
+                    'act': 'a_check',
+                    'key': server['key'],
+                    'ts': server['ts'],
+                    'wait': LONG_POLL_WAIT
+                },
+                timeout=LONG_POLL_WAIT + self.__timeout
+            )
+            response.raise_for_status()
+            return response.json()
+
+        result = self.__retrier.call(request)
+
+        if (failed := result.get('failed')) is not None:
+            logger.debug('VK Long Poll failed=%s', failed)
+            if failed == 1:
+                # Events are lost, wall scan catches up anyway
+                self.new_post.set()
+                return {**server, 'ts': result['ts']}
+            return None
+
+        if any(update.get('type') == 'wall_post_new' for update in result.get('updates', [])):
+            logger.debug('VK Long Poll: new wall post')
+            self.new_post.set()
+        return {**server, 'ts': result['ts']}
+
+
+# group id: (settings, scanner)
+_scanners: dict[int, tuple[tuple, VkWallScanner]] = {}
+_async_scanners: dict[int, tuple[tuple, VkWallScanner]] = {}
+
+
+def get_wall_scanner(config: dict) -> VkWallScanner:
+    '''
+    Return wall scanner for config['vk']['group_id'], kept between cycles.
+    Scanner is recreated when VK token, first page size, session or retrier is changed.
+    '''
+    group_id = config['vk']['group_id']
+    session = get_session(config, 'vk')
+    retrier = get_retrier(config, 'vk')
+    settings = (config['vk']['token'], config['vk'].get('first_page_size', 10), session, retrier)
+    cached = _scanners.get(group_id)
+    if cached is None or cached[0] != settings:
+        cached = (settings, VkWallScanner(
+            SessionAPI(session=session, retrier=retrier, access_token=settings[0]),
+            group_id,
+            settings[1]
+        ))
+        _scanners[group_id] = cached
+    return cached[1]
+
+
+async def get_async_wall_scanner(config: dict) -> VkWallScanner:
+    '''
+    Return wall scanner of async engine for config['vk']['group_id'].
+    Scanner is recreated when VK token, first page size, client or retrier is changed.
+    '''
+    group_id = config['vk']['group_id']
+    client = await get_async_client(config, 'vk')
+    retrier = get_retrier(config, 'vk')
+    settings = (config['vk']['token'], config['vk'].get('first_page_size', 10), client, retrier)
+    cached = _async_scanners.get(group_id)
+    if cached is None or cached[0] != settings:
+        cached = (settings, VkWallScanner(
+            AsyncVkApi(client, retrier, settings[0]),
+            group_id,
+            settings[1]
+        ))
+        _async_scanners[group_id] = cached
+    return cached[1]
+
+
+def get_long_poll(config: dict, new_post: threading.Event | None = None) -> VkLongPoll | None:
+    '''
+    Return started Long Poll watcher if config['vk']['long_poll'] is enabled.
+    It sets new_post event, if given.
+    '''
+    if not config['vk'].get('long_poll'):
+        return None
+    session = get_session(config, 'vk')
+    # Server of Long Poll and its updates are requested through the same retrier
+    retrier = get_retrier(config, 'vk')
+    long_poll = VkLongPoll(
+        SessionAPI(session=session, retrier=retrier, access_token=config['vk']['token']),
+        session,
+        retrier,
+        config['vk']['group_id'],
+        new_post=new_post
+    )
+    long_poll.start()
+    return long_poll
+
+
 def get_new_vk_posts(config):
-    '''Return new VK posts as list of Post objects'''
+    '''Return new VK posts as list of Post objects, oldest first'''
     content_dir = make_content_dir(config)
-    posts = []
+    downloader = get_downloader(config)
     last_id = get_last_id(config)
-    vk_api = vk.API(access_token=config['vk']['token'])
-
-    offset = 0
 
-    new = []
     try:
-        new = list(
-            filter(
-                lambda post: post['date'] > last_id,
-                vk_api.wall.get(
-                    owner_id=config['vk']['group_id'],
-                    count=100,
-                    v='5.199',
-                    filter='owner',
-                    offset=offset
-                )['items']
-            )
-        )
+        new = list(get_wall_scanner(config).scan(last_id))
     except requests.exceptions.ConnectionError as err:
         logger.error(
             'HTTP error while fetching VK posts: %s',
             err
         )
-        return posts
+        return []
+    return make_posts(new, content_dir, downloader.submit)
+
+
+async def get_new_vk_posts_async(config) -> list[Post]:
+    '''
+    Same as get_new_vk_posts, photos are downloaded by async downloader
+    '''
+    content_dir = make_content_dir(config)
+    downloader = await get_async_downloader(config)
+    last_id = get_last_id(config)
 
+    scanner = await get_async_wall_scanner(config)
+    try:
+        new = await scanner.scan_async(last_id)
+    except (httpx.NetworkError, httpx.ConnectTimeout) as err:
+        logger.error(
+            'HTTP error while fetching VK posts: %s',
+            err
+        )
+        return []
+    return make_posts(new, content_dir, downloader.submit)
+
+
+def make_posts(new: list[dict], content_dir: str, submit: Callable) -> list[Post]:
+    '''
+    Return Post objects of VK wall posts with attachments.
+    submit(url, file_path) schedules download of photo.
+    '''
+    posts = []
     if not new:
         logger.debug('No new VK posts')
         return posts
@@ -70,16 +458,22 @@ def get_new_vk_posts(config):
                 )
             ]
 
+            # Photos are downloaded in background, each one
+            # is ready as soon as its own transfer is finished
             for photo in photos:
                 photo_url = photo['orig_photo']['url']
                 photo_file = os.path.join(post_dir,f'{photo['id']}.jpg')
-                urllib.request.urlretrieve(photo_url, photo_file)
+                current_post.add_photo(
+                    photo['id'],
+                    photo_file,
+                    photo_url,
+                    submit(photo_url, photo_file)
+                )
                 logger.debug(
-                    'Photo %s saved to %s',
+                    'Photo %s download to %s scheduled',
                     photo['id'],
                     photo_file
                 )
-                current_post.add_photo(photo['id'], photo_file, photo_url)
 
             posts.append(current_post)
 
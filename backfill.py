@@ -0,0 +1,392 @@
+'''
+This module reposts historical VK posts, e.g. when channel is migrated.
+VK wall is paged through for date or id range and found posts are reposted
+oldest first by the same download, tag, render and publish stages as
+main loop, with their own concurrency and per-target rate caps (config['backfill']).
+Repost state is kept in job store, so interrupted backfill is resumed
+by the same command.
+
+Stop autoposter service while backfill is running: backfill adds posts by
+JobStore.add_post, which moves the same last_id cursor as main loop,
+so main loop, running at the same time, may skip new posts.
+Squares for Instagram are served by media server of backfill itself, if it is enabled.
+
+python backfill.py --since 2023-01-01 --until 2024-01-01
+python backfill.py --from-id 1200 --to-id 1500 --rate instagram=10 --route nature
+'''
+from __future__ import annotations
+
+import os
+import sys
+import copy
+import json
+import time
+import logging
+import argparse
+from collections.abc import Callable
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from autoposter_common import cleanup_content, make_content_dir
+from autoposter_vk import get_wall_scanner, make_posts
+from dispatcher import TargetDispatcher, TargetSkipped
+from downloader import get_downloader
+from jobstore import JobStore, get_job_store
+from lazyimport import preload
+from main import tag_and_repost_to_instagram
+from mediaserver import serves_squares, start_media_server
+from metrics import BACKLOG, STAGE_SECONDS
+from post import Post
+from ratelimit import get_rate_limiter
+from renderer import prerender_posts
+from settings import TARGETS, AppConfig, read_config
+
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_KEY = 'backfill'
+BATCH_SIZE = 20
+REPORT_INTERVAL = 60
+
+# backfill key: stage setting, it replaces
+STAGE_SETTINGS = {
+    'download_workers': 'downloader.workers',
+    'tag_concurrency': 'imagga.concurrency',
+    'render_workers': 'instagram.render_workers',
+    'posts_ahead': 'max_posts_ahead',
+}
+
+
+class BackfillRange(NamedTuple):
+    '''VK posts, published in [since, until) with id in [min_id, max_id]'''
+    since: int = 0
+    until: int | None = None
+    min_id: int = 0
+    max_id: int | None = None
+
+
+class Checkpoint:
+    '''
+    Newest backfilled post of range, kept in job store.
+    Posts up to it are skipped, even if job store is compacted since.
+    '''
+    def __init__(self, job_store: JobStore, post_range: BackfillRange):
+        self.__job_store = job_store
+        self.__range = list(post_range)
+        saved = json.loads(job_store.get_meta(CHECKPOINT_KEY) or '{}')
+        if saved.get('range') == self.__range:
+            self.__done = saved['done']
+            logger.info('Backfill is resumed after post %s', self.__done)
+        else:
+            if saved:
+                logger.info('Checkpoint of range %s is replaced', saved.get('range'))
+            self.__done = 0
+
+    @property
+    def done(self) -> int:
+        ''' Return id of newest backfilled post '''
+        return self.__done
+
+    def advance(self, post_id: int) -> None:
+        '''Save post as backfilled'''
+        self.__done = max(self.__done, post_id)
+        self.__job_store.set_meta(
+            CHECKPOINT_KEY,
+            json.dumps({'range': self.__range, 'done': self.__done})
+        )
+
+
+class Progress:
+    '''
+    Counts backfilled posts and logs progress with ETA by measured throughput
+    '''
+    def __init__(self, total: int, interval: float = REPORT_INTERVAL):
+        self.__total = total
+        self.__interval = interval
+        self.__done = 0
+        self.__started = time.monotonic()
+        self.__reported = self.__started
+        BACKLOG.set(total)
+
+    @property
+    def done(self) -> int:
+        ''' Return number of backfilled posts '''
+        return self.__done
+
+    def advance(self) -> None:
+        '''Count one more backfilled post, report if it is time'''
+        self.__done += 1
+        BACKLOG.set(self.__total - self.__done)
+        if time.monotonic() - self.__reported >= self.__interval:
+            self.report()
+
+    def report(self) -> None:
+        '''Log progress'''
+        now = time.monotonic()
+        self.__reported = now
+        if not self.__done:
+            logger.info('Backfill: 0/%s posts', self.__total)
+            return
+        per_second = self.__done / max(now - self.__started, 1e-9)
+        left = timedelta(seconds=round((self.__total - self.__done) / per_second))
+        logger.info(
+            'Backfill: %s/%s posts (%.0f%%), %.1f posts/h, ETA %s (%s left)',
+            self.__done,
+            self.__total,
+            100 * self.__done / self.__total,
+            per_second * 3600,
+            (datetime.now() + left).strftime('%Y-%m-%d %H:%M'),
+            left
+        )
+
+
+def make_backfill_config(raw: dict, path: str | None, overrides: dict) -> AppConfig:
+    '''
+    Return config, where stage settings are replaced by config['backfill'] ones
+    and then by overrides (from command line)
+    '''
+    raw = copy.deepcopy(raw)
+    settings = {**(raw.get('backfill') or {}), **overrides}
+    raw['backfill'] = settings
+    for name, stage_setting in STAGE_SETTINGS.items():
+        if (value := settings.get(name)) is None:
+            continue
+        section, _, key = stage_setting.rpartition('.')
+        if not section:
+            raw[key] = value
+        elif isinstance(raw.get(section), dict):
+            raw[section][key] = value
+    return AppConfig(raw, path)
+
+
+def _rate_capped(
+    target: str,
+    publisher: Callable[[Post], None],
+    per_hour: float | None
+) -> Callable[[Post], None]:
+    '''Return publisher, waiting for rate cap of target before every repost'''
+    if (limiter := get_rate_limiter(f'backfill-{target}', per_hour and per_hour / 3600)) is None:
+        return publisher
+
+    def publish(post: Post) -> None:
+        if waited := limiter.acquire():
+            logger.debug('Repost of %s to %s waited %.1f s for rate cap', post.id, target, waited)
+        publisher(post)
+
+    return publish
+
+
+class Backfill:
+    '''
+    Reposts history posts batch by batch.
+    Next batch is downloaded and rendered while previous one is published.
+    '''
+    def __init__(
+        self,
+        config: AppConfig,
+        job_store: JobStore,
+        dispatcher: TargetDispatcher,
+        checkpoint: Checkpoint,
+        progress: Progress
+    ):
+        self.__config = config
+        self.__job_store = job_store
+        self.__dispatcher = dispatcher
+        self.__checkpoint = checkpoint
+        self.__progress = progress
+        self.__content_dir = make_content_dir(config)
+        self.__downloader = get_downloader(config)
+
+    def run(self, history: list[dict], batch_size: int = BATCH_SIZE) -> None:
+        '''Repost VK wall posts, oldest first'''
+        in_flight: list[tuple[Post, dict[str, Future]]] = []
+        for start in range(0, len(history), batch_size):
+            queued = self.__queue(history[start:start + batch_size])
+            self.__finish(in_flight)
+            in_flight = queued
+        self.__finish(in_flight)
+
+    def __queue(self, batch: list[dict]) -> list[tuple[Post, dict[str, Future]]]:
+        '''Start downloads and rendering of posts and submit them to targets'''
+        posts = make_posts(batch, self.__content_dir, self.__downloader.submit)
+        reposts = []
+        for post in posts:
+            self.__job_store.add_post(post.id, post.to_dict(), self.__dispatcher.targets)
+            # Targets, done before backfill was interrupted, are not repeated
+            reposts.append((post, self.__job_store.pending_targets(post.id)))
+
+        inst_posts = [post for post, targets in reposts if 'instagram' in targets]
+        prerender_posts(self.__config, inst_posts)
+        if len(inst_posts) > 1:
+            Post.prefetch_translations(self.__config, inst_posts)
+
+        queued = []
+        for post, targets in reposts:
+            logger.info(
+                'Backfilling post %s (%s photos) to %s',
+                post.id,
+                len(post.photos),
+                ', '.join(targets) or 'no target'
+            )
+            queued.append((post, self.__dispatcher.submit(post, targets)))
+        return queued
+
+    def __finish(self, queued: list[tuple[Post, dict[str, Future]]]) -> None:
+        '''Wait for reposts in submit order. First failed repost stops backfill.'''
+        for post, futures in queued:
+            if errors := self.__dispatcher.wait(futures):
+                # Checkpoint must not pass failed post
+                raise next(
+                    (err for err in errors.values() if not isinstance(err, TargetSkipped)),
+                    next(iter(errors.values()))
+                )
+            if self.__job_store.is_finished(post.id):
+                cleanup_content(self.__config, posts=[post])
+            self.__checkpoint.advance(post.id)
+            self.__progress.advance()
+
+
+def backfill(config: AppConfig, post_range: BackfillRange, dry_run: bool = False) -> int:
+    '''
+    Repost VK posts of range, not reposted yet, oldest first.
+    Return number of posts to repost (dry run) or reposted.
+    '''
+    job_store = get_job_store(config)
+    checkpoint = Checkpoint(job_store, post_range)
+    settings = config.get('backfill') or {}
+
+    with STAGE_SECONDS.time('vk'):
+        # Posts published during scan may come twice
+        wall = {post['id']: post for post in get_wall_scanner(config).scan_history(*post_range)}
+    # Repost job ids are dates of VK posts
+    history = [
+        post for post in sorted(wall.values(), key=lambda post: post['date'])
+        if 'attachments' in post
+        and post['date'] > checkpoint.done
+        and not job_store.is_finished(post['date'])
+    ]
+    logger.info(
+        '%s posts of VK wall %s to backfill to %s',
+        len(history),
+        config['vk']['group_id'],
+        ', '.join(config.enabled_targets)
+    )
+    if dry_run or not history:
+        return len(history)
+
+    publishers = {
+        'telegram': lambda post: post.repost_to_tg(config),
+        'instagram': lambda post: tag_and_repost_to_instagram(config, post, logger),
+    }
+    rates = settings.get('rate_per_hour') or {}
+    publishers = {
+        target: _rate_capped(target, publishers[target], rates.get(target))
+        for target in config.enabled_targets
+    }
+
+    progress = Progress(len(history), settings.get('report_interval', REPORT_INTERVAL))
+    progress.report()
+    with TargetDispatcher(publishers, config.get('max_posts_ahead', 1), job_store) as dispatcher:
+        try:
+            Backfill(config, job_store, dispatcher, checkpoint, progress).run(
+                history,
+                settings.get('batch', BATCH_SIZE)
+            )
+        finally:
+            progress.report()
+    return progress.done
+
+
+def parse_time(value: str) -> int:
+    '''Parse local date or date and time to unix time'''
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f'{value} is not date, e.g. 2023-01-31') from err
+
+
+def parse_rates(values: list[str]) -> dict[str, float]:
+    '''Parse target=posts_per_hour arguments'''
+    rates = {}
+    for value in values:
+        target, _, rate = value.partition('=')
+        if target not in TARGETS or not rate:
+            raise argparse.ArgumentTypeError(f'{value} is not target=posts_per_hour')
+        rates[target] = float(rate)
+    return rates
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    '''Parse command line'''
+    parser = argparse.ArgumentParser(description='Repost historical VK posts')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--route', help='route to backfill, required if config has several')
+    parser.add_argument('--since', type=parse_time, default=0, help='first date, e.g. 2023-01-01')
+    parser.add_argument('--until', type=parse_time, help='date to stop before, e.g. 2024-01-01')
+    parser.add_argument('--from-id', type=int, default=0, help='first VK post id')
+    parser.add_argument('--to-id', type=int, help='last VK post id')
+    parser.add_argument('--batch', type=int, help=f'posts in flight, default {BATCH_SIZE}')
+    parser.add_argument('--download-workers', type=int)
+    parser.add_argument('--tag-concurrency', type=int)
+    parser.add_argument('--render-workers', type=int)
+    parser.add_argument('--posts-ahead', type=int, help='posts a target may go ahead')
+    parser.add_argument(
+        '--rate', nargs='*', default=[], help='target=posts_per_hour cap, e.g. instagram=10'
+    )
+    parser.add_argument('--dry-run', action='store_true', help='only count posts to repost')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    args = parse_args()
+    cli_overrides = {
+        name: value for name, value in (
+            ('batch', args.batch),
+            ('download_workers', args.download_workers),
+            ('tag_concurrency', args.tag_concurrency),
+            ('render_workers', args.render_workers),
+            ('posts_ahead', args.posts_ahead),
+        ) if value is not None
+    }
+    try:
+        rate_overrides = parse_rates(args.rate)
+    except argparse.ArgumentTypeError as arg_err:
+        sys.exit(f'--rate: {arg_err}')
+    raw_config = read_config(args.config)
+    if rate_overrides:
+        cli_overrides['rate_per_hour'] = {
+            **((raw_config.get('backfill') or {}).get('rate_per_hour') or {}),
+            **rate_overrides
+        }
+    main_config = make_backfill_config(raw_config, args.config, cli_overrides)
+    if args.route is None and len(main_config.routes) > 1:
+        sys.exit(f'--route is required, routes are {", ".join(main_config.routes)}')
+    route_name = args.route or next(iter(main_config.routes))
+    if (route_config := main_config.routes.get(route_name)) is None:
+        sys.exit(f'Route {args.route} is not found in {args.config}')
+
+    logging.basicConfig(
+        level=str(main_config['log_level']).upper(),
+        format=main_config['log_format']
+    )
+    # Modules of targets are loaded here, not by worker threads at once
+    preload(route_config)
+    os.makedirs(main_config['temp_dir'], exist_ok=True)
+    if not args.dry_run and serves_squares(main_config) and not start_media_server(main_config):
+        # Port is most likely taken by autoposter, which must be stopped
+        sys.exit('Media server cannot be started, stop autoposter service before backfill')
+    try:
+        count = backfill(
+            route_config,
+            BackfillRange(args.since, args.until, args.from_id, args.to_id),
+            args.dry_run
+        )
+    except Exception as backfill_err: # pylint: disable=broad-exception-caught
+        logger.error(
+            '%s: Backfill stopped: %s. Run the same command to resume.',
+            type(backfill_err),
+            backfill_err
+        )
+        sys.exit(1)
+    logger.info('Backfill done, %s posts %s', count, 'found' if args.dry_run else 'reposted')
@@ -0,0 +1,339 @@
+'''
+Local stand-ins of VK, imagga.com, Telegram, Instagram Graph and
+Google Translate APIs, used by benchmarks/pipeline.py.
+Every service answers with configurable latency, error rate and
+its own flavour of throttling (VK error 6, HTTP 429, Instagram 9007).
+
+All services are served by one HTTP/1.1 keep-alive server under path prefixes:
+/vk, /imagga, /tg, /graph, /translate, /media and /control.
+'''
+import io
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from PIL import Image, ImageDraw
+
+SERVICES = ('vk', 'imagga', 'telegram', 'instagram', 'translate', 'media')
+
+# Mean latency of every service, milliseconds
+DEFAULT_LATENCY = {
+    'vk': 80,
+    'imagga': 1200,
+    'telegram': 300,
+    'instagram': 400,
+    'translate': 250,
+    'media': 60,
+}
+
+TAGS = (
+    'landscape', 'sky', 'mountain', 'travel', 'water', 'tree', 'outdoor', 'sunset',
+    'nature', 'cloud', 'lake', 'forest', 'summer', 'scenic', 'river', 'beach',
+    'city', 'architecture', 'people', 'portrait', 'street', 'night', 'light', 'snow',
+)
+
+PREFIXES = {
+    '/vk/': 'vk',
+    '/imagga/': 'imagga',
+    '/tg/': 'telegram',
+    '/graph/': 'instagram',
+    '/translate/': 'translate',
+    '/media/': 'media',
+}
+
+
+def make_media(count: int, size: tuple[int, int], seed: int) -> list[bytes]:
+    '''Return count distinct JPEG photos of size'''
+    rnd = random.Random(seed)
+    media = []
+    for _ in range(count):
+        photo = Image.merge('RGB', (
+            Image.linear_gradient('L').resize(size),
+            Image.effect_noise(size, 40),
+            Image.radial_gradient('L').resize(size)
+        ))
+        draw = ImageDraw.Draw(photo)
+        for _ in range(40):
+            left, top = rnd.randrange(size[0]), rnd.randrange(size[1])
+            draw.ellipse(
+                (left, top, left + rnd.randrange(50, 600), top + rnd.randrange(50, 400)),
+                outline=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)),
+                width=6
+            )
+        buffer = io.BytesIO()
+        photo.save(buffer, 'JPEG', quality=90)
+        media.append(buffer.getvalue())
+    return media
+
+
+class FakeApis:
+    '''
+    State of all fake services: VK wall, Instagram containers, request counters
+    '''
+    def __init__(self, options: dict):
+        self.options = options
+        self.base_url = ''
+        self.random = random.Random(options['seed'])
+        self.lock = threading.Lock()
+        self.media = make_media(options['media_count'], options['photo_size'], options['seed'])
+        self.wall: list[dict] = []
+        self.next_date = int(time.time()) - 10 ** 6
+        # Next VK post id and Telegram message id
+        self.next_ids = {'vk': 1, 'telegram': 1}
+        self.containers: dict[str, float] = {}
+        self.requests = {service: 0 for service in SERVICES}
+        self.failures = {service: 0 for service in SERVICES}
+
+    def publish(self, count: int) -> list[dict]:
+        '''Add count new posts to VK wall'''
+        low, high = self.options['photos']
+        with self.lock:
+            posts = []
+            for _ in range(count):
+                post_id = self.next_ids['vk']
+                photos = []
+                for photo_index in range(self.random.randint(low, high)):
+                    photo_id = post_id * 100 + photo_index
+                    photos.append({'type': 'photo', 'photo': {
+                        'id': photo_id,
+                        'orig_photo': {'url': f'{self.base_url}/media/{photo_id}.jpg'}
+                    }})
+                posts.append({
+                    'id': post_id,
+                    'date': self.next_date,
+                    'text': f'Пост номер {post_id}. В кадре: [id1|Павел]\n#пейзаж #путешествия',
+                    'attachments': photos,
+                })
+                self.next_ids['vk'] += 1
+                self.next_date += 1
+            self.wall.extend(posts)
+        return posts
+
+    def delay(self, service: str) -> None:
+        '''Sleep for random latency around service mean'''
+        if latency := self.options['latency'].get(service, 0):
+            time.sleep(latency / 1000 * self.random.uniform(0.5, 1.5))
+
+    def roll(self, kind: str, service: str) -> bool:
+        '''Return True with probability options[kind][service]'''
+        with self.lock:
+            return self.random.random() < self.options[kind].get(service, 0)
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Routes request to fake service by path prefix'''
+    protocol_version = 'HTTP/1.1'
+    server: 'FakeServer'
+
+    def log_message(self, format, *args):
+        '''Requests are counted, not logged'''
+
+    def do_GET(self): # pylint: disable=invalid-name
+        '''Handle GET request'''
+        self.__handle()
+
+    def do_POST(self): # pylint: disable=invalid-name
+        '''Handle POST request'''
+        self.__handle()
+
+    def __reply(self, status: int, body, content_type: str = 'application/json') -> None:
+        '''Send body, serialized to JSON unless it is bytes'''
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __params(self) -> dict[str, str]:
+        '''Return query and urlencoded body parameters, multipart body is only read'''
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            for key, values in parse_qs(body.decode('utf-8')).items():
+                params[key] = values[0]
+        return params
+
+    def __handle(self) -> None:
+        '''Count request, apply latency and errors and pass it to service'''
+        apis = self.server.apis
+        path = urlsplit(self.path).path
+        params = self.__params()
+        if path.startswith('/control/'):
+            self.__control(path, params)
+            return
+
+        service = next(
+            (service for prefix, service in PREFIXES.items() if path.startswith(prefix)),
+            None
+        )
+        if service is None:
+            self.__reply(404, {'error': f'{path} is not faked'})
+            return
+
+        with apis.lock:
+            apis.requests[service] += 1
+        apis.delay(service)
+        if apis.roll('errors', service):
+            with apis.lock:
+                apis.failures[service] += 1
+            self.__reply(500, {'ok': False, 'error_code': 500, 'description': 'Internal error'})
+            return
+
+        handlers = {
+            'vk': self.__vk,
+            'imagga': self.__imagga,
+            'telegram': self.__telegram,
+            'instagram': self.__instagram,
+            'translate': self.__translate,
+            'media': self.__media,
+        }
+        handlers[service](path.split('/', 2)[2], params)
+
+    def __control(self, path: str, params: dict) -> None:
+        '''Publish posts on VK wall or return request counters'''
+        apis = self.server.apis
+        if path == '/control/publish':
+            self.__reply(200, {'posts': len(apis.publish(int(params.get('count', 1))))})
+        elif path == '/control/stats':
+            with apis.lock:
+                self.__reply(200, {'requests': apis.requests, 'failures': apis.failures})
+        else:
+            self.__reply(404, {})
+
+    def __vk(self, path: str, params: dict) -> None:
+        '''VK API wall.get, newest posts first'''
+        apis = self.server.apis
+        if path != 'method/wall.get':
+            self.__reply(200, {'error': {'error_code': 3, 'error_msg': 'Unknown method'}})
+            return
+        if apis.roll('throttle', 'vk'):
+            self.__reply(200, {'error': {
+                'error_code': 6,
+                'error_msg': 'Too many requests per second',
+                'request_params': []
+            }})
+            return
+        offset = int(params.get('offset', 0))
+        count = int(params.get('count', 20))
+        with apis.lock:
+            newest_first = apis.wall[::-1]
+        self.__reply(200, {'response': {
+            'count': len(newest_first),
+            'items': newest_first[offset:offset + count]
+        }})
+
+    def __imagga(self, _path: str, _params: dict) -> None:
+        '''imagga.com tags of uploaded photo'''
+        apis = self.server.apis
+        if apis.roll('throttle', 'imagga'):
+            self.__reply(429, {'status': {'type': 'error', 'text': 'Too many requests'}})
+            return
+        with apis.lock:
+            tags = apis.random.sample(TAGS, 12)
+        self.__reply(200, {'result': {'tags': [
+            {'confidence': 100 - index * 5.5, 'tag': {'en': tag}}
+            for index, tag in enumerate(tags)
+        ]}, 'status': {'type': 'success', 'text': ''}})
+
+    def __telegram(self, path: str, params: dict) -> None:
+        '''Telegram Bot API sendPhoto and sendMediaGroup'''
+        apis = self.server.apis
+        if apis.roll('throttle', 'telegram'):
+            self.__reply(429, {
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            })
+            return
+        method = path.rsplit('/', 1)[-1]
+        count = len(json.loads(params['media'])) if method == 'sendMediaGroup' else 1
+        messages = []
+        with apis.lock:
+            for _ in range(count):
+                message_id = apis.next_ids['telegram']
+                messages.append({
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': -100, 'type': 'channel'},
+                    'photo': [{
+                        'file_id': f'fake-{message_id}',
+                        'file_unique_id': f'unique-{message_id}',
+                        'width': 1280,
+                        'height': 960
+                    }]
+                })
+                apis.next_ids['telegram'] += 1
+        self.__reply(200, {
+            'ok': True,
+            'result': messages if method == 'sendMediaGroup' else messages[0]
+        })
+
+    def __instagram(self, path: str, params: dict) -> None:
+        '''Instagram Graph API user, containers, their status and publishing'''
+        apis = self.server.apis
+        if (parts := path.split('/')[1:]) == ['me']:
+            self.__reply(200, {'user_id': '17841400000000000', 'username': 'benchmark'})
+        elif len(parts) == 2 and parts[1] == 'media':
+            with apis.lock:
+                container_id = str(10 ** 15 + len(apis.containers))
+                apis.containers[container_id] = time.monotonic()
+            self.__reply(200, {'id': container_id})
+        elif len(parts) == 2 and parts[1] == 'media_publish':
+            if apis.roll('throttle', 'instagram'):
+                self.__reply(400, {'error': {
+                    'message': 'Media ID is not available',
+                    'type': 'OAuthException',
+                    'code': 9007,
+                    'error_subcode': 2207027
+                }})
+                return
+            self.__reply(200, {'id': str(2 * 10 ** 15 + int(params['creation_id']) % 10 ** 15)})
+        elif len(parts) == 1 and parts[0] in apis.containers:
+            ready = time.monotonic() - apis.containers[parts[0]] >= apis.options['ig_processing']
+            self.__reply(200, {
+                'status_code': 'FINISHED' if ready else 'IN_PROGRESS',
+                'id': parts[0]
+            })
+        else:
+            self.__reply(400, {'error': {'message': f'Unknown path {path}', 'code': 100}})
+
+    def __translate(self, _path: str, params: dict) -> None:
+        '''Google Translate, text is marked as translated'''
+        text = params.get('q', '')
+        self.__reply(200, [
+            [[f'[en] {text}', text, None, None, 10]],
+            None,
+            params.get('sl', 'ru'),
+        ])
+
+    def __media(self, path: str, _params: dict) -> None:
+        '''Photos of VK posts'''
+        apis = self.server.apis
+        photo_id = int(path.split('.', 1)[0])
+        self.__reply(200, apis.media[photo_id % len(apis.media)], 'image/jpeg')
+
+
+class FakeServer(ThreadingHTTPServer):
+    '''HTTP server of all fake services'''
+    daemon_threads = True
+
+    def __init__(self, options: dict):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.apis = FakeApis(options)
+        self.apis.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+
+
+def serve(options: dict, ready) -> None:
+    '''
+    Run fake server until process is terminated.
+    Server base URL is put to ready queue.
+    '''
+    server = FakeServer(options)
+    ready.put(server.apis.base_url)
+    server.serve_forever()
@@ -0,0 +1,395 @@
+'''
+Offline end-to-end benchmark of repost cycle.
+VK, imagga.com, Telegram, Instagram and Google Translate are replaced
+by local fake APIs (benchmarks/fake_apis.py) running in separate process,
+so benchmark needs no network and no credentials.
+
+Every cycle publishes new posts on fake VK wall and runs main.run_cycle
+with sync or async engine.
+Reported: per-stage and per-cycle latency, throughput and peak RSS.
+
+Usage: python benchmarks/pipeline.py [--cycles 5] [--posts 4] [--photos 1-12]
+    [--latency imagga=800] [--errors telegram=0.05] [--throttle instagram=0.1]
+    [--engine async] [--save result.json] [--baseline result.json]
+'''
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import statistics
+import multiprocessing
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+from telebot import apihelper
+from googletrans import urls as translate_urls
+import fake_apis
+import main as autoposter
+from post import Post
+from autoposter_http import get_async_client, get_session
+from renderer import get_render_stage
+from settings import AppConfig
+
+# Real API hosts and fake service path prefixes
+ROUTES = {
+    'https://api.vk.com/': '/vk/',
+    'https://api.imagga.com/': '/imagga/',
+    'https://graph.instagram.com/': '/graph/',
+}
+
+STAGES = ('get_new_vk_posts', 'add_tags', 'repost_to_tg', 'repost_to_instagram', 'cleanup_content')
+# Post methods of async engine, reported as the same stages
+ASYNC_STAGES = {
+    'add_tags_async': 'add_tags',
+    'repost_to_tg_async': 'repost_to_tg',
+    'repost_to_instagram_async': 'repost_to_instagram',
+}
+
+
+class RedirectAdapter(HTTPAdapter):
+    '''
+    Sends requests to real API hosts to fake server.
+    Any other HTTPS request fails, so benchmark never reaches network.
+    '''
+    def __init__(self, base_url: str, pool_size: int):
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__base_url = base_url
+
+    def send(self, request, *args, **kwargs):
+        for host, prefix in ROUTES.items():
+            if request.url.startswith(host):
+                request.url = self.__base_url + prefix + request.url[len(host):]
+                return super().send(request, *args, **kwargs)
+        raise requests.exceptions.ConnectionError(f'{request.url} is not faked')
+
+
+def redirect_hook(base_url: str):
+    '''Return httpx request hook, doing the same as RedirectAdapter'''
+    async def redirect(request: httpx.Request) -> None:
+        url = str(request.url)
+        for host, prefix in ROUTES.items():
+            if url.startswith(host):
+                request.url = httpx.URL(base_url + prefix + url[len(host):])
+                return
+        raise httpx.ConnectError(f'{url} is not faked', request=request)
+    return redirect
+
+
+class Timings:
+    '''Durations and errors of instrumented stages'''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.durations: dict[str, list[float]] = {stage: [] for stage in STAGES}
+        self.errors: dict[str, int] = dict.fromkeys(STAGES, 0)
+        self.posts_done = 0
+
+    def timed(self, stage: str, function):
+        '''Return function, recording its duration as stage'''
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                with self.__lock:
+                    self.errors[stage] += 1
+                raise
+            finally:
+                with self.__lock:
+                    self.durations[stage].append(time.perf_counter() - started)
+        return wrapper
+
+    def timed_async(self, stage: str, function):
+        '''Return coroutine function, recording its duration as stage'''
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                with self.__lock:
+                    self.errors[stage] += 1
+                raise
+            finally:
+                with self.__lock:
+                    self.durations[stage].append(time.perf_counter() - started)
+        return wrapper
+
+    def count_done(self, function):
+        '''Return cleanup function, counting posts it cleans up'''
+        def wrapper(config, posts):
+            with self.__lock:
+                self.posts_done += len(posts)
+            return function(config, posts=posts)
+        return wrapper
+
+
+def parse_mapping(values: list[str], cast) -> dict:
+    '''Parse service=value arguments'''
+    mapping = {}
+    for value in values:
+        service, _, number = value.partition('=')
+        if service not in fake_apis.SERVICES:
+            raise argparse.ArgumentTypeError(f'Unknown service {service}')
+        mapping[service] = cast(number)
+    return mapping
+
+
+def parse_args() -> argparse.Namespace:
+    '''Parse command line'''
+    parser = argparse.ArgumentParser(description='Offline benchmark of repost cycle')
+    parser.add_argument('--cycles', type=int, default=5, help='repost cycles to run')
+    parser.add_argument('--posts', type=int, default=4, help='new VK posts per cycle')
+    parser.add_argument('--photos', default='1-12', help='photos per post, min-max')
+    parser.add_argument('--photo-size', default='2560x1920', help='source photo size')
+    parser.add_argument(
+        '--latency', nargs='*', default=[],
+        help='service=ms mean latency, defaults: ' + ', '.join(
+            f'{service}={latency}' for service, latency in fake_apis.DEFAULT_LATENCY.items()
+        )
+    )
+    parser.add_argument('--errors', nargs='*', default=[], help='service=p HTTP 500 rate')
+    parser.add_argument(
+        '--throttle', nargs='*', default=[],
+        help='service=p throttling rate: VK error 6, HTTP 429, Instagram 9007'
+    )
+    parser.add_argument(
+        '--ig-processing', type=float, default=1.5,
+        help='seconds until Instagram container is FINISHED'
+    )
+    parser.add_argument(
+        '--targets', default='telegram,instagram', help='enabled targets, comma separated'
+    )
+    parser.add_argument('--tag-cache', action='store_true', help='enable imagga tag cache')
+    parser.add_argument('--engine', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='warning')
+    parser.add_argument('--save', help='write results to json file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    return parser.parse_args()
+
+
+def make_config(args: argparse.Namespace, temp_dir: str, base_url: str) -> AppConfig:
+    '''Return autoposter config for fake services'''
+    targets = args.targets.split(',')
+    return AppConfig({
+        'temp_dir': temp_dir,
+        'log_level': args.log_level,
+        'log_format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        'source': 'vk',
+        'pool_interval': 1,
+        'engine': args.engine,
+        'max_posts_ahead': 1,
+        'jobs_keep_days': 30,
+        'telegram': {
+            'enabled': 'telegram' in targets,
+            'channel_id': -100,
+            'token': '123456:BENCHMARK',
+        },
+        'vk': {'enabled': True, 'token': 'benchmark', 'group_id': -1, 'first_page_size': 10},
+        'instagram': {
+            'enabled': 'instagram' in targets,
+            'app_token': 'benchmark',
+            'timeout': 15,
+            'concurrency': 4,
+            'container_timeout': 120,
+            'proxy': None,
+            'web_photo_location': f'{base_url}/web',
+            'fill_color': '#fff',
+            'jpeg_quality': 75,
+            'render_workers': None,
+            'render_in_flight': None,
+            'default_tags': ['benchmark', 'autoposter'],
+            'total_tags_count': 16,
+        },
+        'imagga': {
+            'api_key': 'benchmark',
+            'api_secret': 'benchmark',
+            'timeout': 30,
+            'concurrency': 4,
+            'requests_per_second': None,
+            'cache': {'enabled': args.tag_cache, 'max_entries': 10000, 'max_age_days': 90},
+        },
+        'translation': {'src_lang': 'ru', 'dst_lang': 'en', 'cache_size': 1000, 'timeout': 10},
+        'replaces': {'id1': {'tg': '[Pavel Durov](https://t.me/durov)', 'inst': '@durov'}},
+        'downloader': {
+            'workers': 4,
+            'timeout': 30,
+            'max_time': 120,
+            'max_size_mb': 50,
+            'attempts': 3,
+        },
+    })
+
+
+def route_to_fakes(config: dict, base_url: str, runner: asyncio.Runner) -> None:
+    '''Point every API client of autoposter to fake server'''
+    for service in ('vk', 'imagga', 'instagram'):
+        get_session(config, service).mount('https://', RedirectAdapter(base_url, 10))
+        client = runner.run(get_async_client(config, service))
+        client.event_hooks['request'].append(redirect_hook(base_url))
+    apihelper.API_URL = base_url + '/tg/bot{0}/{1}'
+    translate_urls.TRANSLATE = base_url + '/translate/translate_a/single'
+
+
+def instrument(timings: Timings) -> None:
+    '''Wrap pipeline stages with timers'''
+    autoposter.get_new_vk_posts = timings.timed('get_new_vk_posts', autoposter.get_new_vk_posts)
+    autoposter.cleanup_content = timings.count_done(
+        timings.timed('cleanup_content', autoposter.cleanup_content)
+    )
+    for stage in ('add_tags', 'repost_to_tg', 'repost_to_instagram'):
+        setattr(Post, stage, timings.timed(stage, getattr(Post, stage)))
+    autoposter.get_new_vk_posts_async = timings.timed_async(
+        'get_new_vk_posts',
+        autoposter.get_new_vk_posts_async
+    )
+    for name, stage in ASYNC_STAGES.items():
+        setattr(Post, name, timings.timed_async(stage, getattr(Post, name)))
+
+
+def describe(durations: list[float]) -> dict:
+    '''Return latency statistics in seconds'''
+    if not durations:
+        return {}
+    ordered = sorted(durations)
+    return {
+        'count': len(ordered),
+        'mean': statistics.fmean(ordered),
+        'p50': ordered[len(ordered) // 2],
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1],
+    }
+
+
+def print_report(results: dict, baseline: dict | None) -> None:
+    '''Print results, compared with baseline if any'''
+    def change(value: float, base: float | None) -> str:
+        if not base:
+            return ''
+        return f'{base:>9.3f} {(value - base) / base * 100:>+7.1f}%'
+
+    print(
+        f'{"stage":<20} {"count":>5} {"errors":>6} {"mean s":>8} {"p50 s":>8} '
+        f'{"p95 s":>8} {"max s":>8}' + (f' {"base mean":>9} {"change":>8}' if baseline else '')
+    )
+    base_rows = {'cycle': baseline['cycle'], **baseline['stages']} if baseline else {}
+    for name, stats in {'cycle': results['cycle'], **results['stages']}.items():
+        print(
+            f'{name:<20} {stats["count"]:>5} {stats["errors"]:>6} '
+            f'{stats["mean"]:>8.3f} {stats["p50"]:>8.3f} {stats["p95"]:>8.3f} '
+            f'{stats["max"]:>8.3f} {change(stats["mean"], base_rows.get(name, {}).get("mean"))}'
+        )
+
+    print()
+    for name, unit in (
+        ('posts_per_minute', 'posts/min'),
+        ('peak_rss_mb', 'MB peak RSS, main process'),
+        ('peak_render_rss_mb', 'MB peak RSS, render worker'),
+    ):
+        base = (baseline or {}).get(name)
+        print(f'{results[name]:>10.1f} {unit:<28}{change(results[name], base)}')
+    print(f'{results["posts_done"]:>10} posts done in {results["elapsed"]:.1f} s')
+    print('requests: ' + ', '.join(
+        f'{service}={count} ({results["failures"][service]} failed)'
+        for service, count in results['requests'].items()
+    ))
+
+
+def run_cycles(args: argparse.Namespace, base_url: str) -> dict:
+    '''
+    Run repost cycles against fake server and return results.
+    Every cycle starts with new posts published on fake VK wall.
+    '''
+    logger = logging.getLogger('benchmark')
+    timings = Timings()
+    cycles = []
+    cycle_errors = 0
+    with tempfile.TemporaryDirectory() as temp_dir, asyncio.Runner() as runner:
+        config = make_config(args, temp_dir, base_url)
+        route_to_fakes(config, base_url, runner)
+        instrument(timings)
+        control = requests.Session()
+
+        started = time.perf_counter()
+        for cycle in range(args.cycles):
+            control.post(f'{base_url}/control/publish', params={'count': args.posts}, timeout=10)
+            cycle_started = time.perf_counter()
+            try:
+                autoposter.run_cycle(config, logger, runner)
+            except Exception as err: # pylint: disable=broad-exception-caught
+                cycle_errors += 1
+                logger.error('Cycle %s failed: %s', cycle, err)
+            cycles.append(time.perf_counter() - cycle_started)
+        elapsed = time.perf_counter() - started
+
+        # Render workers are joined, so their peak RSS is in children usage.
+        # Fake server is still running, so it is not counted.
+        get_render_stage(config).close()
+        stats = control.get(f'{base_url}/control/stats', timeout=10).json()
+
+    return {
+        'cycle': {**describe(cycles), 'errors': cycle_errors},
+        'stages': {
+            stage: {**describe(durations), 'errors': timings.errors[stage]}
+            for stage, durations in timings.durations.items() if durations
+        },
+        'posts_done': timings.posts_done,
+        'elapsed': elapsed,
+        'posts_per_minute': timings.posts_done / elapsed * 60,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_render_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'requests': stats['requests'],
+        'failures': stats['failures'],
+    }
+
+
+def main() -> None:
+    '''Run benchmark and print results'''
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    low, _, high = args.photos.partition('-')
+    width, _, height = args.photo_size.partition('x')
+    options = {
+        'seed': args.seed,
+        'photos': (int(low), int(high or low)),
+        'photo_size': (int(width), int(height)),
+        'media_count': 8,
+        'ig_processing': args.ig_processing,
+        'latency': {**fake_apis.DEFAULT_LATENCY, **parse_mapping(args.latency, float)},
+        'errors': parse_mapping(args.errors, float),
+        'throttle': parse_mapping(args.throttle, float),
+    }
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    server = context.Process(target=fake_apis.serve, args=(options, ready), daemon=True)
+    server.start()
+    try:
+        results = run_cycles(args, ready.get(timeout=60))
+    finally:
+        server.terminate()
+        server.join()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
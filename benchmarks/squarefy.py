@@ -0,0 +1,106 @@
+'''
+Benchmark of Instagram square rendering.
+Compares original full decode + contain + pad + default save
+with draft decoding and tuned encoder of photo.render_square.
+
+Usage: python benchmarks/squarefy.py [photo.jpg ...]
+Without arguments synthetic 4K photos are used.
+'''
+import os
+import sys
+import math
+import time
+import tempfile
+from PIL import Image, ImageDraw, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from photo import render_square, JPEG_QUALITY # pylint: disable=wrong-import-position
+
+SIZE = 1280
+COLOR = '#fff'
+ROUNDS = 5
+
+
+def make_photo(path: str, size: tuple[int, int]) -> None:
+    '''Create synthetic photo with gradients and details'''
+    photo = Image.linear_gradient('L').resize(size).convert('RGB')
+    photo = Image.merge('RGB', (
+        photo.getchannel(0),
+        photo.getchannel(0).rotate(90, expand=False).resize(size),
+        Image.effect_noise(size, 40)
+    ))
+    draw = ImageDraw.Draw(photo)
+    for i in range(0, max(size), 60):
+        draw.ellipse((i, i // 2, i + 300, i // 2 + 200), outline=(i % 255, 80, 200), width=5)
+    photo.save(path, 'JPEG', quality=95)
+
+
+def render_original(src_path: str, dst_path: str) -> str:
+    '''Rendering as it was done before'''
+    photo = Image.open(src_path)
+    resized_photo = ImageOps.contain(photo, (SIZE, SIZE))
+    squared_photo = ImageOps.pad(resized_photo, (SIZE, SIZE), color=COLOR)
+    squared_photo.save(dst_path)
+    return dst_path
+
+
+def render_new(src_path: str, dst_path: str) -> str:
+    '''Current rendering, cached file is removed to measure rendering itself'''
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    return render_square(src_path, dst_path, SIZE, COLOR, JPEG_QUALITY)
+
+
+def measure_decode(src_path: str, use_draft: bool) -> float:
+    '''Return seconds to decode photo'''
+    started = time.perf_counter()
+    with Image.open(src_path) as photo:
+        if use_draft:
+            scale = SIZE / max(photo.size)
+            photo.draft('RGB', (int(photo.width * scale) + 1, int(photo.height * scale) + 1))
+        photo.load()
+    return time.perf_counter() - started
+
+
+def measure(render, src_path: str, dst_path: str) -> tuple[float, int]:
+    '''Return best render time of ROUNDS and output size'''
+    best = math.inf
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        render(src_path, dst_path)
+        best = min(best, time.perf_counter() - started)
+    return best, os.path.getsize(dst_path)
+
+
+def main() -> None:
+    '''Run benchmark and print results table'''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if not (photos := sys.argv[1:]):
+            for size in ((3840, 2160), (2160, 3840), (6000, 4000)):
+                photo_path = os.path.join(temp_dir, f'{size[0]}x{size[1]}.jpg')
+                make_photo(photo_path, size)
+                photos.append(photo_path)
+
+        print(
+            f'{"photo":<16} {"decode old":>10} {"decode new":>10} '
+            f'{"render old":>10} {"render new":>10} {"bytes old":>10} {"bytes new":>10}'
+        )
+        for photo_path in photos:
+            decode_old = min(measure_decode(photo_path, False) for _ in range(ROUNDS))
+            decode_new = min(measure_decode(photo_path, True) for _ in range(ROUNDS))
+            render_old, bytes_old = measure(
+                render_original, photo_path, os.path.join(temp_dir, 'old.jpg')
+            )
+            render_new_time, bytes_new = measure(
+                render_new, photo_path, os.path.join(temp_dir, 'new.jpg')
+            )
+            print(
+                f'{os.path.basename(photo_path)[:16]:<16} '
+                f'{decode_old * 1000:>8.1f}ms {decode_new * 1000:>8.1f}ms '
+                f'{render_old * 1000:>8.1f}ms {render_new_time * 1000:>8.1f}ms '
+                f'{bytes_old:>10} {bytes_new:>10}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+'''
+This module contains repost dispatcher.
+Every target has its own worker, so targets publish concurrently,
+while posts of one target keep their order.
+Target, which runs out of retries, skips its later posts, they are left pending
+in job store for next cycle. Other targets go on.
+AsyncTargetDispatcher does the same with tasks on event loop of async engine.
+'''
+from __future__ import annotations
+
+import logging
+import functools
+import threading
+from collections import deque
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from post import Post
+from jobstore import JobStore
+from lazyimport import lazy_import
+from metrics import FAILURES, SINCE_LAST_POST
+from ratelimit import Retrier, RetryPolicy
+
+# Used by AsyncTargetDispatcher only
+asyncio = lazy_import('asyncio')
+
+
+logger = logging.getLogger(__name__)
+
+
+# How many times whole repost to target is tried. Requests of target are retried
+# by its own retrier, so repost is tried again only after transient error,
+# which may be fixed by new attempt, e.g. Instagram container processing failure.
+# Errors of requests, which may be processed by service, are not retried here either.
+TARGET_RETRIES = {
+    'telegram': RetryPolicy(attempts=1),
+    'instagram': RetryPolicy(attempts=3, delay=15, max_delay=60),
+}
+
+
+class TargetSkipped(Exception):
+    '''Post is not reposted because previous repost to the same target failed'''
+    retryable = False
+
+
+def _may_start(
+    target: str,
+    index: int,
+    unfinished: dict[str, deque[int]],
+    failed: set[str],
+    submitted: int,
+    max_ahead: int
+) -> bool:
+    '''
+    Return True if post index may be reposted to target:
+    it is at most max_ahead posts ahead of the first post, not finished by other target.
+    Failed targets hold nobody back.
+    '''
+    if target in failed:
+        return True
+    return index <= max_ahead + min(
+        queue[0] if queue else submitted
+        for other, queue in unfinished.items()
+        if other not in failed
+    )
+
+
+def _target_retriers(targets) -> dict[str, Retrier]:
+    '''Return retriers of whole reposts to targets'''
+    return {
+        target: Retrier(target, TARGET_RETRIES.get(target, RetryPolicy(attempts=1)))
+        for target in targets
+    }
+
+
+class TargetDispatcher:
+    '''
+    Runs publishers of enabled targets for every post concurrently
+    '''
+    def __init__(
+        self,
+        publishers: dict[str, Callable[[Post], None]],
+        max_ahead: int = 1,
+        job_store: JobStore | None = None
+    ):
+        '''
+        max_ahead - how many posts a target may go ahead of the first post,
+        not finished by other target.
+        job_store - if given, job states are recorded there
+        '''
+        self.__publishers = publishers
+        self.__job_store = job_store
+        self.__max_ahead = max_ahead
+        self.__executors = {
+            target: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'repost-{target}')
+            for target in publishers
+        }
+        self.__retriers = _target_retriers(publishers)
+        # Targets, which skip their later posts
+        self.__failed: set[str] = set()
+        self.__progress = threading.Condition()
+        self.__submitted = 0
+        # target: indexes of its posts, not finished yet, in submit order
+        self.__unfinished: dict[str, deque[int]] = {target: deque() for target in publishers}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def targets(self) -> list[str]:
+        ''' Return dispatched targets '''
+        return list(self.__publishers)
+
+    def submit(self, post: Post, targets: list[str] | None = None) -> dict[str, Future]:
+        '''
+        Queue post to targets (all by default), return futures by target
+        '''
+        futures = {}
+        with self.__progress:
+            index = self.__submitted
+            self.__submitted += 1
+            for target, executor in self.__executors.items():
+                if targets is None or target in targets:
+                    self.__unfinished[target].append(index)
+                    futures[target] = executor.submit(self.__repost, target, post, index)
+        return futures
+
+    def __repost(self, target: str, post: Post, index: int) -> None:
+        '''
+        Repost to one target with retries. Runs in target worker.
+        '''
+        try:
+            with self.__progress:
+                self.__progress.wait_for(lambda: _may_start(
+                    target,
+                    index,
+                    self.__unfinished,
+                    self.__failed,
+                    self.__submitted,
+                    self.__max_ahead
+                ))
+
+            try:
+                self.__retriers[target].call(functools.partial(self.__attempt, target, post))
+            except TargetSkipped:
+                raise
+            except Exception:
+                FAILURES.inc(target)
+                logger.error('No attempts left, later posts to %s are left for next cycle', target)
+                # Later posts must not overtake failed one
+                self.__stop([target])
+                raise
+        finally:
+            with self.__progress:
+                self.__unfinished[target].remove(index)
+                self.__progress.notify_all()
+
+        if self.__job_store:
+            self.__job_store.finish(post.id, target)
+        SINCE_LAST_POST.touch(target)
+
+    def __attempt(self, target: str, post: Post) -> None:
+        '''Repost to one target once, record failure in job store'''
+        if target in self.__failed:
+            raise TargetSkipped(f'Post {post.id} is not reposted to {target}')
+        if self.__job_store:
+            self.__job_store.start(post.id, target)
+        try:
+            self.__publishers[target](post)
+        except Exception as err:
+            if self.__job_store:
+                self.__job_store.fail(post.id, target, f'{type(err)}: {err}')
+            logger.error(
+                '%s: Error while reposting post %s to %s: %s',
+                type(err),
+                post.id,
+                target,
+                err
+            )
+            raise
+
+    def __stop(self, targets) -> None:
+        '''Skip reposts to targets, not started yet'''
+        with self.__progress:
+            self.__failed.update(targets)
+            self.__progress.notify_all()
+
+    def wait(self, futures: dict[str, Future]) -> dict[str, BaseException]:
+        '''
+        Wait until all targets are done with post, return errors by failed target
+        '''
+        return {
+            target: err for target, future in futures.items()
+            if (err := future.exception()) is not None
+        }
+
+    def close(self) -> None:
+        '''Cancel queued reposts and wait for running ones'''
+        self.__stop(self.__publishers)
+        for executor in self.__executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+class AsyncTargetDispatcher:
+    '''
+    Same as TargetDispatcher for async publishers.
+    Every repost is a task, waiting for previous repost of its target.
+    '''
+    def __init__(
+        self,
+        publishers: dict[str, Callable[[Post], Awaitable[None]]],
+        max_ahead: int = 1,
+        job_store: JobStore | None = None
+    ):
+        self.__publishers = publishers
+        self.__job_store = job_store
+        self.__max_ahead = max_ahead
+        self.__retriers = _target_retriers(publishers)
+        self.__tasks: list[asyncio.Task] = []
+        # target: task of last submitted repost
+        self.__last: dict[str, asyncio.Task] = {}
+        # Targets, which skip their later posts
+        self.__failed: set[str] = set()
+        self.__progress = asyncio.Condition()
+        self.__submitted = 0
+        # target: indexes of its posts, not finished yet, in submit order
+        self.__unfinished: dict[str, deque[int]] = {target: deque() for target in publishers}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def targets(self) -> list[str]:
+        ''' Return dispatched targets '''
+        return list(self.__publishers)
+
+    def submit(self, post: Post, targets: list[str] | None = None) -> dict[str, asyncio.Task]:
+        '''
+        Queue post to targets (all by default), return tasks by target
+        '''
+        index = self.__submitted
+        self.__submitted += 1
+        tasks = {}
+        for target in self.__publishers:
+            if targets is None or target in targets:
+                self.__unfinished[target].append(index)
+                tasks[target] = asyncio.ensure_future(
+                    self.__repost(target, post, index, self.__last.get(target))
+                )
+                self.__last[target] = tasks[target]
+                self.__tasks.append(tasks[target])
+        return tasks
+
+    async def __repost(
+        self,
+        target: str,
+        post: Post,
+        index: int,
+        previous: asyncio.Task | None
+    ) -> None:
+        '''
+        Repost to one target with retries after previous post of target
+        '''
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self.__progress:
+                await self.__progress.wait_for(lambda: _may_start(
+                    target,
+                    index,
+                    self.__unfinished,
+                    self.__failed,
+                    self.__submitted,
+                    self.__max_ahead
+                ))
+
+            try:
+                await self.__retriers[target].call_async(
+                    functools.partial(self.__attempt, target, post)
+                )
+            except TargetSkipped:
+                raise
+            except Exception:
+                FAILURES.inc(target)
+                logger.error('No attempts left, later posts to %s are left for next cycle', target)
+                # Later posts must not overtake failed one
+                await self.__stop([target])
+                raise
+        finally:
+            self.__unfinished[target].remove(index)
+            async with self.__progress:
+                self.__progress.notify_all()
+
+        if self.__job_store:
+            self.__job_store.finish(post.id, target)
+        SINCE_LAST_POST.touch(target)
+
+    async def __attempt(self, target: str, post: Post) -> None:
+        '''Repost to one target once, record failure in job store'''
+        if target in self.__failed:
+            raise TargetSkipped(f'Post {post.id} is not reposted to {target}')
+        if self.__job_store:
+            self.__job_store.start(post.id, target)
+        try:
+            await self.__publishers[target](post)
+        except Exception as err:
+            if self.__job_store:
+                self.__job_store.fail(post.id, target, f'{type(err)}: {err}')
+            logger.error(
+                '%s: Error while reposting post %s to %s: %s',
+                type(err),
+                post.id,
+                target,
+                err
+            )
+            raise
+
+    async def __stop(self, targets) -> None:
+        '''Skip reposts to targets, not started yet'''
+        async with self.__progress:
+            self.__failed.update(targets)
+            self.__progress.notify_all()
+
+    async def wait(self, tasks: dict[str, asyncio.Task]) -> dict[str, BaseException]:
+        '''
+        Wait until all targets are done with post, return errors by failed target
+        '''
+        if tasks:
+            await asyncio.wait(tasks.values())
+        return {
+            target: err for target, task in tasks.items()
+            if (err := task.exception()) is not None
+        }
+
+    async def close(self) -> None:
+        '''Skip reposts, not started yet, and wait for running ones'''
+        await self.__stop(self.__publishers)
+        if self.__tasks:
+            await asyncio.wait(self.__tasks)
+        for task in self.__tasks:
+            if not task.cancelled():
+                # Errors of posts, not waited, are already logged
+                task.exception()
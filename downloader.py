@@ -0,0 +1,359 @@
+'''
+This module contains concurrent photo downloader.
+Photos are fetched by bounded worker pool through one keep-alive
+connection pool, streamed to temporary file and renamed when complete.
+Async engine uses AsyncDownloader with the same limits on its event loop.
+'''
+from __future__ import annotations
+import os
+import time
+import logging
+import functools
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from autoposter_http import get_async_client, get_session
+from lazyimport import lazy_import
+from metrics import STAGE_SECONDS, FAILURES
+from mediastore import get_media_store
+from ratelimit import RETRY_POLICIES, Retrier, get_retrier
+
+asyncio = lazy_import('asyncio')
+httpx = lazy_import('httpx')
+
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = '.part'
+
+
+class DownloadError(Exception):
+    '''Photo cannot be downloaded within configured limits'''
+    retryable = False
+
+
+def _complete(url: str, file_path: str, on_complete: Callable[[str], object] | None) -> str:
+    '''Rename downloaded part to file_path and pass it to on_complete'''
+    os.replace(file_path + PART_SUFFIX, file_path)
+    logger.debug('Photo %s saved to %s', url, file_path)
+    if on_complete:
+        try:
+            on_complete(file_path)
+        except OSError as err:
+            logger.warning(
+                '%s: Post-download step failed for %s: %s',
+                type(err),
+                file_path,
+                err
+            )
+    return file_path
+
+
+class Downloader:
+    '''
+    Bounded pool of download workers sharing one HTTP session
+    '''
+    def __init__(
+        self,
+        workers: int = 4,
+        timeout: float = 30,
+        max_time: float = 120,
+        max_bytes: int = 50 * 1024 * 1024,
+        retrier: Retrier | None = None,
+        chunk_size: int = 64 * 1024,
+        session: requests.Session | None = None,
+        on_complete: Callable[[str], object] | None = None
+    ):
+        '''
+        retrier - repeats failed transfers, default download policy is used if not given.
+        on_complete - if given, it is called with path of every downloaded file
+        '''
+        self.__timeout = timeout
+        self.__max_time = max_time
+        self.__max_bytes = max_bytes
+        self.__retrier = retrier or Retrier('download', RETRY_POLICIES['download'])
+        self.__chunk_size = chunk_size
+        self.__on_complete = on_complete
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.__session = session
+
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='downloader'
+        )
+        # file_path: future of its running download
+        self.__in_flight: dict[str, Future] = {}
+        self.__lock = threading.Lock()
+        logger.debug('Downloader started with %s workers', workers)
+
+    def submit(self, url: str, file_path: str) -> Future:
+        '''
+        Schedule download of url to file_path.
+        Future result is file_path when file is completely written.
+        File, which is being downloaded already (e.g. for other route), is not fetched twice.
+        '''
+        with self.__lock:
+            if (future := self.__in_flight.get(file_path)) is not None:
+                return future
+            future = self.__executor.submit(self.download, url, file_path)
+            self.__in_flight[file_path] = future
+        future.add_done_callback(functools.partial(self.__forget, file_path))
+        return future
+
+    def __forget(self, file_path: str, future: Future) -> None:
+        '''Drop finished download'''
+        with self.__lock:
+            if self.__in_flight.get(file_path) is future:
+                del self.__in_flight[file_path]
+
+    def download(self, url: str, file_path: str) -> str:
+        '''
+        Download url to file_path, resuming partial file if any
+        '''
+        if os.path.exists(file_path):
+            logger.debug('File %s already downloaded', file_path)
+            return file_path
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with STAGE_SECONDS.time('download'):
+            try:
+                self.__download(url, file_path + PART_SUFFIX)
+            except Exception:
+                FAILURES.inc('download')
+                raise
+        return _complete(url, file_path, self.__on_complete)
+
+    def __download(self, url: str, part_path: str) -> None:
+        '''
+        Fetch url to part_path with retries
+        '''
+        deadline = time.monotonic() + self.__max_time
+        try:
+            self.__retrier.call(
+                functools.partial(self.__fetch, url, part_path, deadline),
+                deadline=deadline
+            )
+        except requests.exceptions.RequestException as err:
+            raise DownloadError(f'Cannot download {url}: {err}') from err
+
+    def __fetch(self, url: str, part_path: str, deadline: float) -> None:
+        '''
+        Stream url to part_path. Existing part is continued with Range request.
+        '''
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        with self.__session.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=self.__timeout
+        ) as response:
+            if response.status_code == 416:
+                # Part already holds the whole file
+                return
+            response.raise_for_status()
+
+            if response.status_code != 206:
+                offset = 0
+            elif offset:
+                logger.debug('Resuming %s from byte %s', url, offset)
+
+            expected = int(response.headers.get('Content-Length', 0)) + offset
+            if expected > self.__max_bytes:
+                raise DownloadError(
+                    f'{url} is {expected} bytes, limit is {self.__max_bytes}'
+                )
+
+            received = offset
+            with open(part_path, 'ab' if offset else 'wb') as part_file:
+                for chunk in response.iter_content(chunk_size=self.__chunk_size):
+                    received += len(chunk)
+                    if received > self.__max_bytes:
+                        raise DownloadError(
+                            f'{url} exceeds size limit {self.__max_bytes} bytes'
+                        )
+                    if time.monotonic() > deadline:
+                        raise DownloadError(
+                            f'{url} download exceeds {self.__max_time} s'
+                        )
+                    part_file.write(chunk)
+
+    def close(self) -> None:
+        '''Wait for running downloads'''
+        self.__executor.shutdown(wait=True)
+
+
+class AsyncDownloader:
+    '''
+    Downloader of async engine: transfers run on event loop,
+    at most workers at once, with the same limits and retries as Downloader
+    '''
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        workers: int = 4,
+        timeout: float = 30,
+        max_time: float = 120,
+        max_bytes: int = 50 * 1024 * 1024,
+        retrier: Retrier | None = None,
+        chunk_size: int = 64 * 1024,
+        on_complete: Callable[[str], object] | None = None
+    ):
+        self.__client = client
+        self.__timeout = timeout
+        self.__max_time = max_time
+        self.__max_bytes = max_bytes
+        self.__retrier = retrier or Retrier('download', RETRY_POLICIES['download'])
+        self.__chunk_size = chunk_size
+        self.__on_complete = on_complete
+        self.__slots = asyncio.Semaphore(workers)
+        # file_path: task of its running download.
+        # Running tasks are referenced until done, so they are not garbage collected.
+        self.__tasks: dict[str, asyncio.Task] = {}
+
+    def submit(self, url: str, file_path: str) -> asyncio.Task:
+        '''
+        Schedule download of url to file_path on running loop.
+        Task result is file_path when file is completely written.
+        File, which is being downloaded already, is not fetched twice.
+        '''
+        if (task := self.__tasks.get(file_path)) is not None:
+            return task
+        task = asyncio.get_running_loop().create_task(self.download(url, file_path))
+        self.__tasks[file_path] = task
+        task.add_done_callback(functools.partial(self.__forget, file_path))
+        return task
+
+    def __forget(self, file_path: str, task: asyncio.Task) -> None:
+        '''Drop finished task. Its error is raised to whoever waits for photo.'''
+        if self.__tasks.get(file_path) is task:
+            del self.__tasks[file_path]
+        if not task.cancelled():
+            # Download of unused photo may fail unnoticed
+            task.exception()
+
+    async def download(self, url: str, file_path: str) -> str:
+        '''
+        Download url to file_path, resuming partial file if any
+        '''
+        if os.path.exists(file_path):
+            logger.debug('File %s already downloaded', file_path)
+            return file_path
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        async with self.__slots:
+            with STAGE_SECONDS.time('download'):
+                try:
+                    await self.__download(url, file_path + PART_SUFFIX)
+                except Exception:
+                    FAILURES.inc('download')
+                    raise
+        return _complete(url, file_path, self.__on_complete)
+
+    async def __download(self, url: str, part_path: str) -> None:
+        '''
+        Fetch url to part_path with retries
+        '''
+        deadline = time.monotonic() + self.__max_time
+        try:
+            await self.__retrier.call_async(
+                functools.partial(self.__fetch, url, part_path, deadline),
+                deadline=deadline
+            )
+        except httpx.HTTPError as err:
+            raise DownloadError(f'Cannot download {url}: {err}') from err
+
+    async def __fetch(self, url: str, part_path: str, deadline: float) -> None:
+        '''
+        Stream url to part_path. Existing part is continued with Range request.
+        '''
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+        async with self.__client.stream(
+            'GET',
+            url,
+            headers=headers,
+            timeout=self.__timeout
+        ) as response:
+            if response.status_code == 416:
+                # Part already holds the whole file
+                return
+            response.raise_for_status()
+
+            if response.status_code != 206:
+                offset = 0
+            elif offset:
+                logger.debug('Resuming %s from byte %s', url, offset)
+
+            expected = int(response.headers.get('Content-Length', 0)) + offset
+            if expected > self.__max_bytes:
+                raise DownloadError(
+                    f'{url} is {expected} bytes, limit is {self.__max_bytes}'
+                )
+
+            received = offset
+            with open(part_path, 'ab' if offset else 'wb') as part_file:
+                async for chunk in response.aiter_bytes(self.__chunk_size):
+                    received += len(chunk)
+                    if received > self.__max_bytes:
+                        raise DownloadError(
+                            f'{url} exceeds size limit {self.__max_bytes} bytes'
+                        )
+                    if time.monotonic() > deadline:
+                        raise DownloadError(
+                            f'{url} download exceeds {self.__max_time} s'
+                        )
+                    part_file.write(chunk)
+
+
+_downloader: Downloader | None = None
+_async_downloader: AsyncDownloader | None = None
+
+
+def get_downloader(config: dict) -> Downloader:
+    '''
+    Return process-wide downloader, configured by config['downloader']
+    '''
+    global _downloader # pylint: disable=global-statement
+    if _downloader is None:
+        downloader_config = config.get('downloader') or {}
+        workers = downloader_config.get('workers', 4)
+        _downloader = Downloader(
+            workers=workers,
+            timeout=downloader_config.get('timeout', 30),
+            max_time=downloader_config.get('max_time', 120),
+            max_bytes=downloader_config.get('max_size_mb', 50) * 1024 * 1024,
+            retrier=get_retrier(config, 'download'),
+            session=get_session(config, 'media', pool_size=workers),
+            on_complete=get_media_store(config).ingest
+        )
+    return _downloader
+
+
+async def get_async_downloader(config: dict) -> AsyncDownloader:
+    '''
+    Return downloader of async engine, configured by config['downloader']
+    '''
+    global _async_downloader # pylint: disable=global-statement
+    if _async_downloader is None:
+        downloader_config = config.get('downloader') or {}
+        workers = downloader_config.get('workers', 4)
+        _async_downloader = AsyncDownloader(
+            await get_async_client(config, 'media', pool_size=workers),
+            workers=workers,
+            timeout=downloader_config.get('timeout', 30),
+            max_time=downloader_config.get('max_time', 120),
+            max_bytes=downloader_config.get('max_size_mb', 50) * 1024 * 1024,
+            retrier=get_retrier(config, 'download'),
+            on_complete=get_media_store(config).ingest
+        )
+    return _async_downloader
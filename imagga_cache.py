@@ -0,0 +1,126 @@
+'''
+This module contains persistent cache for imagga.com tags.
+Tags are keyed by SHA-256 of image content, so the same photo
+is sent to imagga.com only once.
+'''
+from __future__ import annotations
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Eviction is run once per this many stored entries
+EVICT_EVERY = 50
+
+
+def file_digest(file_path: str) -> str:
+    '''Return SHA-256 hex digest of file content'''
+    with open(file_path, 'rb') as image:
+        return hashlib.file_digest(image, 'sha256').hexdigest()
+
+
+class TagCache:
+    '''
+    SQLite backed imagga.com tags cache with size and age limits
+    '''
+    def __init__(self, db_path: str, max_entries: int = 10000, max_age_days: float = 90):
+        self.__max_entries = max_entries
+        self.__max_age = max_age_days * 24 * 3600
+        self.__lock = threading.Lock()
+        self.__puts = 0
+
+        self.__db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.__db:
+            self.__db.execute(
+                'CREATE TABLE IF NOT EXISTS tags ('
+                'hash TEXT PRIMARY KEY, '
+                'tags TEXT NOT NULL, '
+                'created REAL NOT NULL, '
+                'used REAL NOT NULL)'
+            )
+            self.__db.execute('CREATE INDEX IF NOT EXISTS tags_used ON tags(used)')
+        self.evict()
+        logger.debug('Imagga tags cache opened at %s', db_path)
+
+    def get(self, digest: str) -> list[dict] | None:
+        '''
+        Return cached imagga tags for image digest or None
+        '''
+        now = time.time()
+        with self.__lock, self.__db:
+            row = self.__db.execute(
+                'SELECT tags FROM tags WHERE hash = ? AND created >= ?',
+                (digest, now - self.__max_age)
+            ).fetchone()
+            if row is None:
+                return None
+            self.__db.execute('UPDATE tags SET used = ? WHERE hash = ?', (now, digest))
+        return json.loads(row[0])
+
+    def put(self, digest: str, tags: list[dict]) -> None:
+        '''
+        Store imagga tags for image digest
+        '''
+        now = time.time()
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'INSERT OR REPLACE INTO tags (hash, tags, created, used) VALUES (?, ?, ?, ?)',
+                (digest, json.dumps(tags), now, now)
+            )
+            self.__puts += 1
+            need_evict = self.__puts % EVICT_EVERY == 0
+        if need_evict:
+            self.evict()
+
+    def evict(self) -> None:
+        '''
+        Remove expired entries and least recently used ones above max_entries
+        '''
+        with self.__lock, self.__db:
+            expired = self.__db.execute(
+                'DELETE FROM tags WHERE created < ?',
+                (time.time() - self.__max_age,)
+            ).rowcount
+            excess = self.__db.execute(
+                'DELETE FROM tags WHERE hash IN '
+                '(SELECT hash FROM tags ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.__max_entries,)
+            ).rowcount
+        if expired or excess:
+            logger.info(
+                'Imagga tags cache: %s expired and %s excess entries evicted',
+                expired,
+                excess
+            )
+
+
+_tag_cache: TagCache | None = None
+_tag_cache_lock = threading.Lock()
+
+
+def get_tag_cache(config: dict) -> TagCache | None:
+    '''
+    Return process-wide tags cache or None if disabled in config['imagga']['cache'].
+    Cache is created once, even if it is requested by several threads at once.
+    '''
+    global _tag_cache # pylint: disable=global-statement
+    cache_config = config['imagga'].get('cache') or {}
+    if not cache_config.get('enabled', True):
+        return None
+    if _tag_cache is None:
+        # Photos of post are tagged by several threads at once
+        with _tag_cache_lock:
+            if _tag_cache is None:
+                _tag_cache = TagCache(
+                    os.path.join(config['temp_dir'], 'imagga_cache.sqlite'),
+                    max_entries=cache_config.get('max_entries', 10000),
+                    max_age_days=cache_config.get('max_age_days', 90)
+                )
+    return _tag_cache
@@ -0,0 +1,277 @@
+'''
+This module contains crash-safe store of repost jobs.
+Every source post has one job per target with its own state,
+so after restart reposting continues exactly where it stopped.
+Every route has its own store.
+'''
+from __future__ import annotations
+
+import os
+import time
+import json
+import sqlite3
+import logging
+import threading
+from settings import DEFAULT_ROUTE
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS posts ('
+    'id INTEGER PRIMARY KEY, '
+    'data TEXT NOT NULL, '
+    'created REAL NOT NULL, '
+    'finished REAL)',
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    'post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE, '
+    'target TEXT NOT NULL, '
+    'state TEXT NOT NULL, '
+    'attempts INTEGER NOT NULL DEFAULT 0, '
+    'error TEXT, '
+    'updated REAL NOT NULL, '
+    'PRIMARY KEY (post_id, target))',
+    'CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, post_id)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+)
+
+
+class JobStore:
+    '''
+    SQLite (WAL mode) store of posts and their per-target repost jobs
+    '''
+    def __init__(self, db_path: str):
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('PRAGMA foreign_keys=ON')
+        with self.__transaction():
+            for statement in SCHEMA:
+                self.__db.execute(statement)
+        logger.debug('Job store opened at %s', db_path)
+
+    def __transaction(self):
+        '''Return context manager, which runs statements atomically'''
+        return _Transaction(self.__db, self.__lock)
+
+    @property
+    def last_id(self) -> int:
+        ''' Return id of newest post ever added '''
+        with self.__transaction():
+            row = self.__db.execute("SELECT value FROM meta WHERE key = 'last_id'").fetchone()
+        return int(row[0]) if row else 0
+
+    @last_id.setter
+    def last_id(self, last_id: int) -> None:
+        with self.__transaction():
+            self.__set_last_id(last_id)
+
+    def __set_last_id(self, last_id: int) -> None:
+        '''Move last id forward, must be called in transaction'''
+        self.__db.execute(
+            "INSERT INTO meta (key, value) VALUES ('last_id', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), excluded.value)",
+            (last_id,)
+        )
+
+    def add_post(self, post_id: int, data: dict, targets: list[str]) -> None:
+        '''
+        Store post with pending job for every target and move last id to it
+        '''
+        now = time.time()
+        with self.__transaction():
+            self.__db.execute(
+                'INSERT OR IGNORE INTO posts (id, data, created) VALUES (?, ?, ?)',
+                (post_id, json.dumps(data, ensure_ascii=False), now)
+            )
+            self.__db.executemany(
+                'INSERT OR IGNORE INTO jobs (post_id, target, state, updated) VALUES (?, ?, ?, ?)',
+                [(post_id, target, PENDING, now) for target in targets]
+            )
+            if not targets:
+                self.__db.execute('UPDATE posts SET finished = ? WHERE id = ?', (now, post_id))
+            self.__set_last_id(post_id)
+        logger.debug('Post %s queued to %s', post_id, ', '.join(targets))
+
+    def get_meta(self, key: str) -> str | None:
+        '''Return stored value of key, None if it is not set'''
+        with self.__transaction():
+            row = self.__db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        '''Store value of key'''
+        with self.__transaction():
+            self.__db.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, value)
+            )
+
+    def pending(self) -> list[tuple[dict, list[str]]]:
+        '''
+        Return posts with unfinished jobs, oldest first, and their unfinished targets
+        '''
+        with self.__transaction():
+            rows = self.__db.execute(
+                'SELECT posts.id, posts.data, group_concat(jobs.target) FROM jobs '
+                'JOIN posts ON posts.id = jobs.post_id '
+                'WHERE jobs.state != ? GROUP BY posts.id ORDER BY posts.id',
+                (DONE,)
+            ).fetchall()
+        return [(json.loads(data), targets.split(',')) for _, data, targets in rows]
+
+    def recover(self) -> int:
+        '''
+        Return jobs, interrupted by crash, to pending state.
+        Such repost may be already published, so it is logged.
+        '''
+        with self.__transaction():
+            for post_id, target in self.__db.execute(
+                'SELECT post_id, target FROM jobs WHERE state = ?',
+                (RUNNING,)
+            ).fetchall():
+                logger.warning(
+                    'Repost of post %s to %s was interrupted and will be retried',
+                    post_id,
+                    target
+                )
+            return self.__db.execute(
+                'UPDATE jobs SET state = ?, updated = ? WHERE state = ?',
+                (PENDING, time.time(), RUNNING)
+            ).rowcount
+
+    def start(self, post_id: int, target: str) -> None:
+        '''Mark job as running'''
+        with self.__transaction():
+            self.__db.execute(
+                'UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? '
+                'WHERE post_id = ? AND target = ?',
+                (RUNNING, time.time(), post_id, target)
+            )
+
+    def finish(self, post_id: int, target: str) -> None:
+        '''
+        Mark job as done. Post is finished, when all its jobs are done.
+        '''
+        now = time.time()
+        with self.__transaction():
+            self.__db.execute(
+                'UPDATE jobs SET state = ?, error = NULL, updated = ? '
+                'WHERE post_id = ? AND target = ?',
+                (DONE, now, post_id, target)
+            )
+            self.__db.execute(
+                'UPDATE posts SET finished = ? WHERE id = ? AND NOT EXISTS '
+                '(SELECT 1 FROM jobs WHERE post_id = ? AND state != ?)',
+                (now, post_id, post_id, DONE)
+            )
+
+    def fail(self, post_id: int, target: str, error: str) -> None:
+        '''Return job to pending state with error'''
+        with self.__transaction():
+            self.__db.execute(
+                'UPDATE jobs SET state = ?, error = ?, updated = ? '
+                'WHERE post_id = ? AND target = ?',
+                (PENDING, error, time.time(), post_id, target)
+            )
+
+    def is_finished(self, post_id: int) -> bool:
+        '''Return True if all jobs of post are done'''
+        with self.__transaction():
+            row = self.__db.execute(
+                'SELECT finished FROM posts WHERE id = ?',
+                (post_id,)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def pending_targets(self, post_id: int) -> list[str]:
+        '''Return targets, post is not reposted to yet'''
+        with self.__transaction():
+            rows = self.__db.execute(
+                'SELECT target FROM jobs WHERE post_id = ? AND state != ? ORDER BY target',
+                (post_id, DONE)
+            ).fetchall()
+        return [target for target, in rows]
+
+    def unfinished_ids(self) -> set[int]:
+        '''Return ids of posts with jobs not done'''
+        with self.__transaction():
+            rows = self.__db.execute('SELECT id FROM posts WHERE finished IS NULL').fetchall()
+        return {post_id for post_id, in rows}
+
+    def compact(self, keep_days: float = 30) -> None:
+        '''
+        Remove posts finished more than keep_days ago and truncate WAL file
+        '''
+        with self.__transaction():
+            removed = self.__db.execute(
+                'DELETE FROM posts WHERE finished < ?',
+                (time.time() - keep_days * 24 * 3600,)
+            ).rowcount
+        with self.__lock:
+            self.__db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        if removed:
+            logger.info('%s finished posts removed from job store', removed)
+
+
+class _Transaction:
+    '''Serializes access to connection and wraps statements in transaction'''
+    def __init__(self, db: sqlite3.Connection, lock: threading.Lock):
+        self.__db = db
+        self.__lock = lock
+
+    def __enter__(self):
+        self.__lock.acquire()
+        self.__db.execute('BEGIN IMMEDIATE')
+        return self.__db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.__db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.__lock.release()
+
+
+_job_stores: dict[str, JobStore] = {}
+_job_stores_lock = threading.Lock()
+
+
+def get_job_store(config: dict) -> JobStore:
+    '''
+    Return process-wide job store of config route in config['temp_dir'].
+    Default route keeps jobs in jobs.sqlite, where last id from old .last file
+    is imported on first start, other routes in jobs-<route>.sqlite.
+    Jobs, interrupted by previous process, are recovered when store is opened.
+    '''
+    if (route := config.route) is None:
+        raise ValueError('Config with routes has no job store, use config of route')
+    with _job_stores_lock:
+        if route in _job_stores:
+            return _job_stores[route]
+        if route != DEFAULT_ROUTE:
+            job_store = JobStore(os.path.join(config['temp_dir'], f'jobs-{route}.sqlite'))
+        else:
+            job_store = JobStore(os.path.join(config['temp_dir'], 'jobs.sqlite'))
+            legacy_path = os.path.join(config['temp_dir'], '.last')
+            if os.path.exists(legacy_path):
+                # Last id only moves forward, so repeated import is harmless
+                with open(legacy_path, encoding='utf8') as legacy_file:
+                    if legacy_id := int(legacy_file.read().strip() or 0):
+                        job_store.last_id = legacy_id
+                        logger.debug('Last id %s imported from %s', legacy_id, legacy_path)
+        job_store.recover()
+        _job_stores[route] = job_store
+    return job_store
+
+
+def get_unfinished_ids() -> set[int]:
+    '''Return ids of unfinished posts of every route, served by process'''
+    with _job_stores_lock:
+        job_stores = list(_job_stores.values())
+    return set().union(*(job_store.unfinished_ids() for job_store in job_stores))
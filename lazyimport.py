@@ -0,0 +1,128 @@
+'''
+This module contains on-demand imports and their cost report.
+Modules, used only by some targets (Telegram bot, Instagram imaging
+and translation) or by async engine, are loaded on first use,
+so deployments without them start faster and use less memory.
+Enabled ones are loaded at startup by preload, which logs what every import cost.
+'''
+from __future__ import annotations
+
+import sys
+import time
+import logging
+import resource
+import threading
+import importlib.util
+from types import ModuleType
+from typing import NamedTuple
+
+
+logger = logging.getLogger(__name__)
+
+# Modules, needed by target or engine only
+TARGET_MODULES = {
+    'telegram': ('autoposter_tg',),
+    'instagram': ('autoposter_inst', 'translator', 'PIL.Image', 'PIL.ImageOps'),
+}
+ENGINE_MODULES = {
+    'sync': (),
+    'async': ('asyncio', 'httpx'),
+}
+
+
+class ImportCost(NamedTuple):
+    '''Time and peak memory growth of module import'''
+    module: str
+    seconds: float
+    rss_kb: int
+
+
+_costs: list[ImportCost] = []
+_costs_lock = threading.Lock()
+# Number of costs, logged by preload
+_reported = 0
+
+
+def _peak_rss_kb() -> int:
+    '''Return peak resident memory of process'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _MeasuredLoader:
+    '''Loader, recording cost of module execution'''
+    def __init__(self, loader, name: str):
+        self.__loader = loader
+        self.__name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.__loader, attr)
+
+    def create_module(self, spec):
+        '''Create module as wrapped loader does'''
+        return self.__loader.create_module(spec)
+
+    def exec_module(self, module: ModuleType) -> None:
+        '''Execute module and record its cost'''
+        started = time.perf_counter()
+        rss = _peak_rss_kb()
+        self.__loader.exec_module(module)
+        cost = ImportCost(self.__name, time.perf_counter() - started, _peak_rss_kb() - rss)
+        with _costs_lock:
+            _costs.append(cost)
+        logger.debug('Module %s loaded in %.1f ms', cost.module, cost.seconds * 1000)
+
+
+def lazy_import(name: str) -> ModuleType:
+    '''
+    Return module, which is loaded on first access to its attribute.
+    Module, imported before, is returned as is.
+    '''
+    if (module := sys.modules.get(name)) is not None:
+        return module
+    if (spec := importlib.util.find_spec(name)) is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    spec.loader = importlib.util.LazyLoader(_MeasuredLoader(spec.loader, name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        # As import statement does, so "from parent import child" finds it
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def preload(config: dict) -> list[ImportCost]:
+    '''
+    Load modules of enabled targets and engine and log import cost
+    of modules, loaded since previous call. Return costs of all modules, loaded on demand.
+    '''
+    global _reported # pylint: disable=global-statement
+    needed = {
+        name
+        for target in config.enabled_targets
+        for name in TARGET_MODULES.get(target, ())
+    } | set(ENGINE_MODULES.get(config.get('engine', 'sync'), ()))
+    for name in sorted(needed):
+        # Access to any attribute of lazy module loads it
+        getattr(lazy_import(name), '__name__')
+
+    with _costs_lock:
+        costs = list(_costs)
+    if len(costs) == _reported:
+        return costs
+    for cost in costs[_reported:]:
+        logger.info(
+            'Module %s imported in %.1f ms, peak memory +%.1f MB',
+            cost.module,
+            cost.seconds * 1000,
+            cost.rss_kb / 1024
+        )
+    _reported = len(costs)
+    if skipped := sorted({
+        name for modules in (*TARGET_MODULES.values(), *ENGINE_MODULES.values())
+        for name in modules
+    } - needed):
+        logger.info('Not needed by config: %s', ', '.join(skipped))
+    logger.info('Peak memory is %.1f MB', _peak_rss_kb() / 1024)
+    return costs
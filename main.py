@@ -1,93 +1,300 @@
 '''
 This is main module for autoposter
 '''
+from __future__ import annotations
 
 import os
-import time
 import logging
-import yaml
+import threading
 from requests import exceptions as WebErrors
-from autoposter_common import write_last_id, cleanup_content
-from autoposter_vk import get_new_vk_posts
+from autoposter_common import cleanup_content, restore_post
+from autoposter_vk import get_long_poll, get_new_vk_posts, get_new_vk_posts_async
+from dispatcher import AsyncTargetDispatcher, TargetDispatcher
+from downloader import get_async_downloader
+from jobstore import JobStore, get_job_store
+from lazyimport import lazy_import, preload
+from mediaserver import start_media_server
+from post import Post
+from renderer import prerender_posts
+from scheduler import CycleResult, get_scheduler
+from metrics import STAGE_SECONDS, BACKLOG, start_metrics
+from settings import AppConfig, ConfigWatcher, load_config
 
+asyncio = lazy_import('asyncio')
+httpx = lazy_import('httpx')
 
-def repost_cycle(config: dict, logger: logging.Logger) -> None:
+_async_runner: asyncio.Runner | None = None
+
+
+def repost_cycle(config: AppConfig, logger: logging.Logger) -> CycleResult:
     '''General cycle: import from VK, repost to TG and IG'''
+    job_store = get_job_store(config)
+    publishers = {
+        'telegram': lambda post: post.repost_to_tg(config),
+        'instagram': lambda post: tag_and_repost_to_instagram(config, post, logger),
+    }
+    publishers = {target: publishers[target] for target in config.enabled_targets}
+
+    source_error = False
     if config['source'] == 'vk':
         logger.debug('Getting new posts from VK')
         try:
-            new_posts = sorted(get_new_vk_posts(config), key=lambda post: post.id)
+            with STAGE_SECONDS.time('vk'):
+                new_posts = get_new_vk_posts(config)
         except WebErrors.ReadTimeout as err:
+            # Posts queued before are reposted anyway
             logger.warning('VK API timeout %s', err)
-            return
+            new_posts = []
+            source_error = True
         except Exception as err:
             logger.error('%s: Cannot get posts from VK: %s', type(err), err)
             raise
     else:
         logger.error(f'Source {config['source']} is unknown')
-        return
+        return CycleResult(0, source_error=True)
 
+    reposts = queue_reposts(config, job_store, new_posts, list(publishers), logger)
+    BACKLOG.set(len(reposts))
+    if not reposts:
+        return CycleResult(len(new_posts), source_error)
 
-    for post in new_posts:
-        logger.info('Processing post %s (%s photos)', post.id, len(post.photos))
-
-        need_to_repost = {
-            'vk': False,
-            'telegram': False,
-            'instagram': False
-        }
-
-        for target in need_to_repost:
-            need_to_repost[target] = config[target]['enabled']
-
-        need_to_repost[config['source']] = False
-        logger.info(
-            'Source is %s, reposting to %s',
-            config['source'],
-            ', '.join([key for key, val in need_to_repost.items() if val])
-        )
+    inst_posts = [post for post, targets in reposts if 'instagram' in targets]
+    prerender_posts(config, inst_posts)
+    if len(inst_posts) > 1:
+        logger.debug('Translating captions of %s posts', len(inst_posts))
+        Post.prefetch_translations(config, inst_posts)
+
+    logger.info('Source is %s, reposting to %s', config['source'], ', '.join(publishers))
 
+    with TargetDispatcher(publishers, config.get('max_posts_ahead', 1), job_store) as dispatcher:
+        futures = []
+        for post, targets in reposts:
+            logger.info(
+                'Processing post %s (%s photos) to %s',
+                post.id,
+                len(post.photos),
+                ', '.join(targets)
+            )
+            futures.append(dispatcher.submit(post, targets))
+
+        for index, ((post, _), post_futures) in enumerate(zip(reposts, futures)):
+            errors = dispatcher.wait(post_futures)
+            if job_store.is_finished(post.id):
+                cleanup_content(config, posts=[post])
+            BACKLOG.set(len(reposts) - index - 1)
+            log_post_done(logger, post, errors)
+
+    job_store.compact(config.get('jobs_keep_days', 30))
+    return CycleResult(len(new_posts), source_error)
+
+
+async def repost_cycle_async(config: AppConfig, logger: logging.Logger) -> CycleResult:
+    '''
+    Same as repost_cycle on event loop of async engine, so VK, downloads, imagga.com,
+    translation, Telegram and Instagram requests and retry pauses do not block each other
+    '''
+    job_store = get_job_store(config)
+    publishers = {
+        'telegram': lambda post: post.repost_to_tg_async(config),
+        'instagram': lambda post: tag_and_repost_to_instagram_async(config, post, logger),
+    }
+    publishers = {target: publishers[target] for target in config.enabled_targets}
+
+    source_error = False
+    if config['source'] == 'vk':
+        logger.debug('Getting new posts from VK')
         try:
-            post.add_tags(config=config)
+            with STAGE_SECONDS.time('vk'):
+                new_posts = await get_new_vk_posts_async(config)
+        except httpx.ReadTimeout as err:
+            # Posts queued before are reposted anyway
+            logger.warning('VK API timeout %s', err)
+            new_posts = []
+            source_error = True
         except Exception as err:
-            logger.error('%s: Error while adding tags to post %s: %s', type(err), post.id, err)
+            logger.error('%s: Cannot get posts from VK: %s', type(err), err)
             raise
+    else:
+        logger.error(f'Source {config['source']} is unknown')
+        return CycleResult(0, source_error=True)
+
+    reposts = queue_reposts(
+        config,
+        job_store,
+        new_posts,
+        list(publishers),
+        logger,
+        await get_async_downloader(config)
+    )
+    BACKLOG.set(len(reposts))
+    if not reposts:
+        return CycleResult(len(new_posts), source_error)
+
+    inst_posts = [post for post, targets in reposts if 'instagram' in targets]
+    prerender_posts(config, inst_posts)
+    if len(inst_posts) > 1:
+        logger.debug('Translating captions of %s posts', len(inst_posts))
+        await Post.prefetch_translations_async(config, inst_posts)
+
+    logger.info('Source is %s, reposting to %s', config['source'], ', '.join(publishers))
+
+    async with AsyncTargetDispatcher(
+        publishers,
+        config.get('max_posts_ahead', 1),
+        job_store
+    ) as dispatcher:
+        tasks = []
+        for post, targets in reposts:
+            logger.info(
+                'Processing post %s (%s photos) to %s',
+                post.id,
+                len(post.photos),
+                ', '.join(targets)
+            )
+            tasks.append(dispatcher.submit(post, targets))
+
+        for index, ((post, _), post_tasks) in enumerate(zip(reposts, tasks)):
+            errors = await dispatcher.wait(post_tasks)
+            if job_store.is_finished(post.id):
+                cleanup_content(config, posts=[post])
+            BACKLOG.set(len(reposts) - index - 1)
+            log_post_done(logger, post, errors)
 
-        while True in need_to_repost.values():
-            # To Telegram
-            if need_to_repost['telegram']:
-                try:
-                    post.repost_to_tg(config)
-                except Exception as err:
-                    logger.error('%s: Error while reposting to Telegram: %s', type(err), err)
-                    time.sleep(5)
-                    raise
-
-                need_to_repost['telegram'] = False
-
-            # To instagram
-            if need_to_repost['instagram']:
-                attempts_left = 3
-                while attempts_left > 0 and need_to_repost['instagram']:
-                    attempts_left -= 1
-                    try:
-                        post.repost_to_instagram(config)
-                    except Exception as err:
-                        logger.error('%s: Error while reposting to Instagram: %s', type(err), err)
-                        time.sleep(15)
-                        if attempts_left == 0:
-                            logger.error('No attempts left, skip reposting to Instagram')
-                            raise
-                    need_to_repost['instagram'] = False
-
-        write_last_id(config, post.id)
-        cleanup_content(config, posts=[post])
+    job_store.compact(config.get('jobs_keep_days', 30))
+    return CycleResult(len(new_posts), source_error)
+
+
+def log_post_done(logger: logging.Logger, post: Post, errors: dict[str, BaseException]) -> None:
+    '''Log post, processed by dispatcher. Failed targets repost it in next cycle.'''
+    if errors:
+        logger.warning(
+            'Processing post %s done, %s left for next cycle',
+            post.id,
+            ', '.join(errors)
+        )
+    else:
         logger.info('Processing post %s done', post.id)
 
+
+def get_async_runner() -> asyncio.Runner:
+    '''
+    Return runner of async engine. Its event loop lives as long as process,
+    so async clients are kept between cycles.
+    '''
+    global _async_runner # pylint: disable=global-statement
+    if _async_runner is None:
+        _async_runner = asyncio.Runner()
+    return _async_runner
+
+
+def run_cycle(
+    config: AppConfig,
+    logger: logging.Logger,
+    runner: asyncio.Runner | None = None
+) -> CycleResult:
+    '''
+    Run repost cycle of every route by engine, selected in config['engine'].
+    Async cycles are run by runner, process-wide one by default.
+    Routes are served one by one, first route error is raised after all routes.
+    '''
+    results = []
+    errors = []
+    for route, route_config in config.routes.items():
+        if len(config.routes) > 1:
+            logger.debug('Serving route %s', route)
+        try:
+            if config.get('engine', 'sync') == 'async':
+                results.append(
+                    (runner or get_async_runner()).run(repost_cycle_async(route_config, logger))
+                )
+            else:
+                results.append(repost_cycle(route_config, logger))
+        except Exception as err: # pylint: disable=broad-exception-caught
+            logger.error('%s: Route %s failed: %s', type(err), route, err)
+            errors.append(err)
+    if errors:
+        raise errors[0]
+    return CycleResult(
+        sum(result.new_posts for result in results),
+        any(result.source_error for result in results)
+    )
+
+
+def queue_reposts(
+    config: dict,
+    job_store: JobStore,
+    new_posts: list[Post],
+    enabled_targets: list[str],
+    logger: logging.Logger,
+    downloader=None
+) -> list[tuple[Post, list[str]]]:
+    '''
+    Add new posts to job store and return pending reposts.
+    Content of new posts without targets is released at once.
+    '''
+    for post in new_posts:
+        job_store.add_post(post.id, post.to_dict(), enabled_targets)
+
+    reposts = get_pending_reposts(config, job_store, new_posts, enabled_targets, logger, downloader)
+    for post in new_posts:
+        if job_store.is_finished(post.id):
+            # No target to repost to
+            cleanup_content(config, posts=[post])
+    return reposts
+
+
+def get_pending_reposts(
+    config: dict,
+    job_store: JobStore,
+    new_posts: list[Post],
+    enabled_targets: list[str],
+    logger: logging.Logger,
+    downloader=None
+) -> list[tuple[Post, list[str]]]:
+    '''
+    Return posts with unfinished jobs and their enabled unfinished targets, oldest first.
+    Posts, queued by previous runs, are restored from job store,
+    their missing photos are downloaded by downloader (process-wide one by default).
+    '''
+    fetched = {post.id: post for post in new_posts}
+    reposts = []
+    for post_data, targets in job_store.pending():
+        if not (targets := [target for target in targets if target in enabled_targets]):
+            logger.debug('Post %s waits for disabled targets', post_data['id'])
+            continue
+        if (post := fetched.get(post_data['id'])) is None:
+            post = restore_post(config, post_data, downloader)
+        reposts.append((post, targets))
+    return reposts
+
+
+def tag_and_repost_to_instagram(config: dict, post: Post, logger: logging.Logger) -> None:
+    '''Tags are used only by Instagram, so they are added in Instagram worker'''
+    try:
+        post.add_tags(config=config)
+    except Exception as err:
+        logger.error('%s: Error while adding tags to post %s: %s', type(err), post.id, err)
+        raise
+    post.repost_to_instagram(config)
+
+
+async def tag_and_repost_to_instagram_async(
+    config: dict,
+    post: Post,
+    logger: logging.Logger
+) -> None:
+    '''Same as tag_and_repost_to_instagram on event loop of async engine'''
+    try:
+        await post.add_tags_async(config=config)
+    except Exception as err:
+        logger.error('%s: Error while adding tags to post %s: %s', type(err), post.id, err)
+        raise
+    await post.repost_to_instagram_async(config)
+
+
 if __name__ == '__main__':
     os.chdir(os.path.dirname(__file__))
-    with open('config.yaml', encoding='utf-8') as config_file:
-        main_config = yaml.load(config_file, Loader=yaml.FullLoader)
+    main_config = load_config('config.yaml')
 
     main_logger = logging.getLogger(__name__)
     logging.basicConfig(
@@ -95,11 +302,37 @@ if __name__ == '__main__':
         format=main_config['log_format']
     )
     main_logger.info('Autoposter started')
-
+    preload(main_config)
 
     os.makedirs(main_config['temp_dir'], exist_ok=True)
+    for main_route_config in main_config.routes.values():
+        # Jobs, interrupted by previous run, are recovered
+        get_job_store(main_route_config)
+    start_metrics(main_config)
+    start_media_server(main_config)
+    wakeup = None
+    if main_config['source'] == 'vk' and main_config['vk'].get('long_poll'):
+        # One Long Poll per VK group, any of them wakes up cycle of all routes
+        wakeup = threading.Event()
+        for group_config in {
+            route_config['vk']['group_id']: route_config
+            for route_config in main_config.routes.values()
+        }.values():
+            get_long_poll(group_config, wakeup)
+    scheduler = get_scheduler(main_config, wakeup)
+    config_watcher = ConfigWatcher(main_config)
 
     while True:
-        repost_cycle(main_config, main_logger)
-        main_logger.debug('Sleep %s', {main_config['pool_interval']})
-        time.sleep(main_config['pool_interval'])
+        # Config is replaced between cycles only, so every cycle sees one config
+        if (new_config := config_watcher.reload()) is not None:
+            main_config = new_config
+            logging.getLogger().setLevel(str(main_config['log_level']).upper())
+            scheduler = get_scheduler(main_config, wakeup)
+            # Squares get new fill color and quality
+            start_media_server(main_config)
+            # Target or engine may be enabled
+            preload(main_config)
+        with STAGE_SECONDS.time('cycle'):
+            cycle_result = run_cycle(main_config, main_logger)
+        scheduler.update(cycle_result)
+        scheduler.wait()
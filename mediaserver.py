@@ -0,0 +1,264 @@
+'''
+This module contains built-in media server.
+Instagram fetches squares of photos from web_photo_location/<post id>/<photo id>_inst.jpg,
+server renders them from downloaded photos on first request, so squares are not written to disk.
+Encoded squares are kept in memory LRU, concurrent requests of one square wait for one render.
+Web server may proxy web_photo_location to it.
+'''
+from __future__ import annotations
+
+import os
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple
+from photo import INST_SIZE, JPEG_QUALITY, encode_square
+from metrics import MEDIA_REQUESTS, STAGE_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+# Any prefix, post folder and square of photo in it
+SQUARE_URL = re.compile(r'(?:/[^/]*)*/(\d+)/(\d+)_inst\.jpg')
+# Single range only, others are answered with whole content
+BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+CACHE_MB = 64
+
+
+class Square(NamedTuple):
+    '''Encoded square, its entity tag and modification time of source photo'''
+    body: bytes
+    etag: str
+    modified: float
+
+
+class SquareCache:
+    '''
+    Renders squares on demand and keeps recently used ones up to max_bytes in total.
+    Square is rendered again when its source photo or render settings are changed.
+    '''
+    def __init__(self, max_bytes: int, color: str, quality: int = JPEG_QUALITY):
+        self.__max_bytes = max_bytes
+        self.__settings = (INST_SIZE, color, quality)
+        self.__lock = threading.Lock()
+        # (source path, source mtime, settings): square, least recently used first
+        self.__squares: OrderedDict[tuple, Square] = OrderedDict()
+        self.__size = 0
+        # Same key: future of running render
+        self.__in_flight: dict[tuple, Future] = {}
+
+    def configure(self, color: str, quality: int = JPEG_QUALITY) -> None:
+        '''Change render settings, squares rendered before are not used any more'''
+        self.__settings = (INST_SIZE, color, quality)
+
+    def get(self, src_path: str) -> tuple[Square, bool]:
+        '''
+        Return square of photo and whether it is taken from cache.
+        OSError is raised if photo is not found.
+        '''
+        modified = os.stat(src_path).st_mtime
+        key = (src_path, modified, self.__settings)
+        with self.__lock:
+            if (square := self.__squares.get(key)) is not None:
+                self.__squares.move_to_end(key)
+                return square, True
+            if (render := self.__in_flight.get(key)) is not None:
+                owner = False
+            else:
+                render = Future()
+                self.__in_flight[key] = render
+                owner = True
+        if not owner:
+            return render.result(), True
+
+        try:
+            with STAGE_SECONDS.time('render'):
+                body = encode_square(src_path, *key[2])
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            square = Square(body, etag, modified)
+            render.set_result(square)
+        except Exception as err:
+            render.set_exception(err)
+            raise
+        finally:
+            with self.__lock:
+                del self.__in_flight[key]
+        self.__put(key, square)
+        return square, False
+
+    def __put(self, key: tuple, square: Square) -> None:
+        '''Keep square, evict least recently used ones over size limit'''
+        if len(square.body) > self.__max_bytes:
+            return
+        with self.__lock:
+            self.__squares[key] = square
+            self.__size += len(square.body)
+            while self.__size > self.__max_bytes:
+                _, evicted = self.__squares.popitem(last=False)
+                self.__size -= len(evicted.body)
+
+
+def byte_range(header: str | None, length: int) -> range | None:
+    '''
+    Return range of content bytes, requested by Range header, None for whole content.
+    ValueError is raised if range is not satisfiable.
+    '''
+    if not header or not (match := BYTE_RANGE.fullmatch(header.strip())):
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Last bytes
+        if (suffix := int(last)) == 0:
+            raise ValueError(f'Range {header} is empty')
+        return range(max(0, length - suffix), length)
+    start = int(first)
+    stop = min(int(last) + 1, length) if last else length
+    if start >= stop:
+        raise ValueError(f'Range {header} is not satisfiable for {length} bytes')
+    return range(start, stop)
+
+
+def _not_modified(headers, square: Square) -> bool:
+    '''Return True if client has the same square'''
+    if (etags := headers.get('If-None-Match')) is not None:
+        return etags.strip() == '*' or square.etag in (etag.strip() for etag in etags.split(','))
+    if since := headers.get('If-Modified-Since'):
+        try:
+            return int(square.modified) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''Serves squares of photos in content dir'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self): # pylint: disable=invalid-name
+        '''Return square or its range'''
+        self.__serve(with_body=True)
+
+    def do_HEAD(self): # pylint: disable=invalid-name
+        '''Return headers of square'''
+        self.__serve(with_body=False)
+
+    def __serve(self, with_body: bool) -> None:
+        '''Answer request of square'''
+        if not (match := SQUARE_URL.fullmatch(self.path.split('?', 1)[0])):
+            MEDIA_REQUESTS.inc('not_found')
+            self.send_error(404)
+            return
+        post_id, photo_id = match.groups()
+        try:
+            square, cached = self.server.squares.get(
+                os.path.join(self.server.content_dir, post_id, f'{photo_id}.jpg')
+            )
+        except FileNotFoundError:
+            MEDIA_REQUESTS.inc('not_found')
+            self.send_error(404)
+            return
+        except Exception as err: # pylint: disable=broad-exception-caught
+            MEDIA_REQUESTS.inc('error')
+            logger.error('%s: Cannot render square %s: %s', type(err), self.path, err)
+            self.send_error(500)
+            return
+        MEDIA_REQUESTS.inc('hit' if cached else 'render')
+
+        if _not_modified(self.headers, square):
+            self.send_response(304)
+            self.__send_validators(square)
+            self.end_headers()
+            return
+
+        length = len(square.body)
+        requested = None
+        if (if_range := self.headers.get('If-Range')) is None or if_range.strip() == square.etag:
+            try:
+                requested = byte_range(self.headers.get('Range'), length)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{length}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        if requested is None:
+            self.send_response(200)
+            body = square.body
+        else:
+            self.send_response(206)
+            self.send_header(
+                'Content-Range',
+                f'bytes {requested.start}-{requested.stop - 1}/{length}'
+            )
+            body = square.body[requested.start:requested.stop]
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.__send_validators(square)
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def __send_validators(self, square: Square) -> None:
+        '''Send headers, client revalidates square by'''
+        self.send_header('ETag', square.etag)
+        self.send_header('Last-Modified', formatdate(square.modified, usegmt=True))
+
+    def log_message(self, format, *args):
+        '''Requests are logged at debug level'''
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+_server: ThreadingHTTPServer | None = None
+
+
+def serves_squares(config: dict) -> bool:
+    '''Return True if Instagram squares are served by media server, not written to disk'''
+    return bool((config.get('media_server') or {}).get('enabled'))
+
+
+def start_media_server(config: dict) -> ThreadingHTTPServer | None:
+    '''
+    Start media server, configured by config['media_server'], if it is enabled.
+    Running server gets render settings of config['instagram'].
+    Server is not started, if its port is taken, e.g. by server of other process.
+    '''
+    global _server # pylint: disable=global-statement
+    if not serves_squares(config):
+        return None
+    color = config['instagram']['fill_color']
+    quality = config['instagram'].get('jpeg_quality', JPEG_QUALITY)
+    if _server is not None:
+        _server.squares.configure(color, quality)
+        return _server
+
+    server_config = config['media_server']
+    address = (server_config.get('host', '127.0.0.1'), server_config.get('port', 8765))
+    try:
+        server = ThreadingHTTPServer(address, _Handler)
+    except OSError as err:
+        logger.warning(
+            'Media server cannot listen on %s:%s, squares must be served by other process: %s',
+            *address,
+            err
+        )
+        return None
+    server.daemon_threads = True
+    server.content_dir = os.path.join(config['temp_dir'], 'content')
+    server.squares = SquareCache(
+        int(server_config.get('cache_mb', CACHE_MB) * 1024 * 1024),
+        color,
+        quality
+    )
+    threading.Thread(target=server.serve_forever, name='media-server', daemon=True).start()
+    _server = server
+    logger.info('Media server started on http://%s:%s', *address)
+    return server
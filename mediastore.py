@@ -0,0 +1,269 @@
+'''
+This module contains content-addressed media store.
+Downloaded photos are kept once per content in temp_dir/media
+and hard-linked into post folders under temp_dir/content, served by web server.
+Folders of finished posts are removed by background garbage collector
+after retention time or earlier when store exceeds its quota.
+Release time of post is modification time of marker file in its folder,
+so it is kept after restart.
+'''
+from __future__ import annotations
+
+import os
+import time
+import shutil
+import logging
+import threading
+from collections.abc import Callable
+from imagga_cache import file_digest
+from jobstore import get_unfinished_ids
+from metrics import directory_size
+
+
+logger = logging.getLogger(__name__)
+
+# Marker file in folder of released post
+RELEASED_MARKER = '.released'
+
+
+class MediaStore:
+    '''
+    Deduplicated photo storage with background cleanup.
+    Link count of stored object is its reference count:
+    object, linked to no post folder, is not used any more.
+    '''
+    def __init__(
+        self,
+        temp_dir: str,
+        unfinished_ids: Callable[[], set[int]],
+        retention: float = 24 * 3600,
+        orphan_age: float = 24 * 3600,
+        quota: int | None = None,
+        gc_interval: float = 300
+    ):
+        '''
+        unfinished_ids returns ids of posts, which content is still needed
+        '''
+        self.__content_dir = os.path.join(temp_dir, 'content')
+        self.__objects_dir = os.path.join(temp_dir, 'media')
+        self.__unfinished_ids = unfinished_ids
+        self.__retention = retention
+        self.__orphan_age = orphan_age
+        self.__quota = quota
+        self.__gc_interval = gc_interval
+        self.__gc_request = threading.Event()
+        os.makedirs(self.__objects_dir, exist_ok=True)
+
+    def start(self) -> None:
+        '''Start garbage collector thread'''
+        threading.Thread(
+            target=self.__run,
+            args=(self.__gc_request,),
+            name='media-gc',
+            daemon=True
+        ).start()
+        logger.debug('Media store GC started, quota %s bytes', self.__quota)
+
+    def ingest(self, file_path: str) -> str:
+        '''
+        Store downloaded file. If same content is already stored,
+        file is replaced by link to stored object.
+        '''
+        digest = file_digest(file_path)
+        object_path = os.path.join(
+            self.__objects_dir,
+            digest[:2],
+            digest + os.path.splitext(file_path)[1]
+        )
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        link_path = file_path + '.link'
+        while True:
+            try:
+                os.link(file_path, object_path)
+                return file_path
+            except FileExistsError:
+                pass
+            except OSError as err:
+                # E.g. file system without hard links, file stays as it is
+                logger.debug('Cannot link %s to media store: %s', file_path, err)
+                return file_path
+
+            try:
+                os.link(object_path, link_path)
+            except FileNotFoundError:
+                # Unused object is just removed by GC, store this file instead
+                continue
+            os.replace(link_path, file_path)
+            logger.debug('Photo %s is duplicate of %s', file_path, object_path)
+            return file_path
+
+    def release(self, post_id: int) -> None:
+        '''
+        Post content is not needed any more, it is removed by GC later
+        '''
+        try:
+            with open(os.path.join(self.__content_dir, str(post_id), RELEASED_MARKER), 'wb'):
+                pass
+        except FileNotFoundError:
+            # Post has no content
+            return
+        if not self.__retention:
+            self.__gc_request.set()
+
+    def __run(self, gc_request: threading.Event) -> None:
+        '''Collect garbage every gc_interval or when requested'''
+        while True:
+            gc_request.wait(self.__gc_interval)
+            gc_request.clear()
+            try:
+                self.collect()
+            except Exception as err: # pylint: disable=broad-exception-caught
+                logger.error('%s: Media store GC failed: %s', type(err), err)
+
+    def __post_dirs(self) -> list[tuple[int, str, float, float | None]]:
+        '''Return (post id, path, mtime, release time or None) of post folders'''
+        post_dirs = []
+        if not os.path.isdir(self.__content_dir):
+            return post_dirs
+        with os.scandir(self.__content_dir) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name.isdigit():
+                    try:
+                        released = os.stat(os.path.join(entry.path, RELEASED_MARKER)).st_mtime
+                    except FileNotFoundError:
+                        released = None
+                    post_dirs.append(
+                        (int(entry.name), entry.path, entry.stat().st_mtime, released)
+                    )
+        return post_dirs
+
+    def __objects(self) -> list[tuple[str, os.stat_result]]:
+        '''Return (path, stat) of stored objects'''
+        objects = []
+        for dir_path, _, file_names in os.walk(self.__objects_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    objects.append((path, os.stat(path)))
+                except FileNotFoundError:
+                    pass
+        return objects
+
+    def usage(self) -> int:
+        '''Return bytes used by post folders and objects, linked files are counted once'''
+        return directory_size(self.__content_dir, self.__objects_dir)
+
+    @staticmethod
+    def __remove_post(path: str) -> None:
+        '''Remove post folder'''
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info('Post content removed from %s', path)
+
+    def __free_post(self, path: str, objects: dict[tuple[int, int], str]) -> tuple[int, int]:
+        '''
+        Remove post folder and objects, linked to it only.
+        objects are paths of stored objects by (device, inode).
+        Return number of freed bytes and removed objects.
+        '''
+        stats = []
+        for dir_path, _, file_names in os.walk(path):
+            for file_name in file_names:
+                try:
+                    stats.append(os.stat(os.path.join(dir_path, file_name)))
+                except FileNotFoundError:
+                    pass
+        self.__remove_post(path)
+
+        freed = 0
+        removed_objects = 0
+        for stat in stats:
+            if stat.st_nlink <= 1:
+                freed += stat.st_size
+            elif stat.st_nlink == 2 and (object_path := objects.get((stat.st_dev, stat.st_ino))):
+                # The other link was object itself
+                try:
+                    os.remove(object_path)
+                except FileNotFoundError:
+                    continue
+                freed += stat.st_size
+                removed_objects += 1
+        return freed, removed_objects
+
+    def collect(self) -> None:
+        '''
+        Remove folders of finished posts after retention time, old orphaned folders
+        and objects not linked to any post. Over quota, released posts
+        are removed before retention time, oldest first.
+        '''
+        now = time.time()
+        unfinished = self.__unfinished_ids()
+
+        kept = []
+        for post_id, path, mtime, released in self.__post_dirs():
+            if post_id in unfinished:
+                continue
+            if released is not None:
+                if now - released >= self.__retention:
+                    self.__remove_post(path)
+                else:
+                    kept.append((released, path))
+            elif now - mtime >= self.__orphan_age:
+                # Crashed cycle or post, removed from job store
+                logger.warning('Orphaned post content found in %s', path)
+                self.__remove_post(path)
+
+        removed_objects = self.__remove_unlinked(now - self.__retention)
+
+        if self.__quota is not None and (usage := self.usage()) > self.__quota:
+            logger.info('Media store uses %s bytes, quota is %s', usage, self.__quota)
+            # Unused objects go first, then released posts, oldest first.
+            # Usage is counted once, freed bytes of every removed post are subtracted.
+            removed_objects += self.__remove_unlinked(now)
+            usage = self.usage()
+            objects = {(stat.st_dev, stat.st_ino): path for path, stat in self.__objects()}
+            for _, path in sorted(kept):
+                if usage <= self.__quota:
+                    break
+                freed, removed = self.__free_post(path, objects)
+                usage -= freed
+                removed_objects += removed
+            if usage > self.__quota:
+                logger.warning('Media store is over quota with content of unfinished posts')
+
+        if removed_objects:
+            logger.debug('%s unused media objects removed', removed_objects)
+
+    def __remove_unlinked(self, before: float) -> int:
+        '''Remove objects, not linked to posts and not changed since before'''
+        removed = 0
+        for path, stat in self.__objects():
+            if stat.st_nlink <= 1 and stat.st_mtime <= before:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+_media_store: MediaStore | None = None
+
+
+def get_media_store(config: dict) -> MediaStore:
+    '''
+    Return process-wide media store, configured by config['media']
+    '''
+    global _media_store # pylint: disable=global-statement
+    if _media_store is None:
+        media_config = config.get('media') or {}
+        quota_mb = media_config.get('quota_mb')
+        _media_store = MediaStore(
+            config['temp_dir'],
+            get_unfinished_ids,
+            retention=media_config.get('retention_hours', 24) * 3600,
+            orphan_age=media_config.get('orphan_hours', 24) * 3600,
+            quota=quota_mb * 1024 * 1024 if quota_mb else None,
+            gc_interval=media_config.get('gc_interval', 300)
+        )
+        _media_store.start()
+    return _media_store
@@ -0,0 +1,326 @@
+'''
+This module contains process metrics and their exporter.
+Stage durations, API calls, retries, failures and backlog are kept in memory
+and served over local HTTP in Prometheus text format.
+While metrics are disabled every update returns at once.
+'''
+from __future__ import annotations
+
+import os
+import time
+import logging
+import threading
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# Stage duration histogram buckets, seconds
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_DISABLED = nullcontext()
+
+
+def _escape(value: str) -> str:
+    '''Escape label value for text format'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    '''Return {name="value",...} or empty string'''
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    '''Return integers without fraction'''
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    '''
+    Base of labelled metrics. Values are kept by label values tuple.
+    '''
+    kind = 'untyped'
+
+    def __init__(self, registry: Registry, name: str, description: str, labels: tuple):
+        self._registry = registry
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+    def samples(self) -> list[str]:
+        '''Return sample lines'''
+        with self._lock:
+            return [
+                f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+                for labels, value in sorted(self._values.items())
+            ]
+
+    def render(self) -> str:
+        '''Return metric in text format'''
+        return (
+            f'# HELP {self.name} {self.description}\n'
+            f'# TYPE {self.name} {self.kind}\n'
+            + ''.join(line + '\n' for line in self.samples())
+        )
+
+
+class Counter(Metric):
+    '''Monotonically growing value'''
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        '''Add amount to counter of labels'''
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''Value, which goes up and down'''
+    kind = 'gauge'
+
+    def set(self, value: float, *labels) -> None:
+        '''Set gauge of labels'''
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function, *labels) -> None:
+        '''
+        Gauge of labels is returned by function, called when metrics are rendered
+        '''
+        with self._lock:
+            self._values[labels] = function
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f'{self.name}{_format_labels(self.labels, labels)} '
+            f'{_format_value(value() if callable(value) else value)}'
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Age(Gauge):
+    '''
+    Seconds since event, calculated when metrics are rendered
+    '''
+    def touch(self, *labels) -> None:
+        '''Event happened now'''
+        self.set(time.time(), *labels)
+
+    def samples(self) -> list[str]:
+        now = time.time()
+        with self._lock:
+            return [
+                f'{self.name}{_format_labels(self.labels, labels)} {now - happened:.3f}'
+                for labels, happened in sorted(self._values.items())
+            ]
+
+
+class Histogram(Metric):
+    '''Distribution of observed values by buckets'''
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        description: str,
+        labels: tuple,
+        buckets: tuple = STAGE_BUCKETS
+    ):
+        super().__init__(registry, name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        '''Add value to distribution of labels'''
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            if (state := self._values.get(labels)) is None:
+                # Counts by bucket, sum, count
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels):
+        '''Return context manager, observing duration of its block'''
+        if not self._registry.enabled:
+            return _DISABLED
+        return _Timer(self, labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+                for bound, bucket_count in zip(bounds, counts + [count - sum(counts)]):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(self.labels, labels, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+                label_string = _format_labels(self.labels, labels)
+                lines.append(f'{self.name}_sum{label_string} {total:.6f}')
+                lines.append(f'{self.name}_count{label_string} {count}')
+        return lines
+
+
+class _Timer:
+    '''Observes duration of with block'''
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.__histogram = histogram
+        self.__labels = labels
+        self.__started = 0.0
+
+    def __enter__(self):
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__histogram.observe(time.perf_counter() - self.__started, *self.__labels)
+
+
+class Registry:
+    '''Set of metrics, rendered together'''
+    def __init__(self):
+        self.enabled = False
+        self.__metrics: list[Metric] = []
+
+    def add(self, metric: Metric) -> Metric:
+        '''Register metric'''
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        '''Return all metrics in text format'''
+        return ''.join(metric.render() for metric in self.__metrics)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS: Histogram = REGISTRY.add(Histogram(
+    REGISTRY,
+    'autoposter_stage_seconds',
+    'Duration of pipeline stages',
+    ('stage',)
+))
+API_CALLS: Counter = REGISTRY.add(Counter(
+    REGISTRY,
+    'autoposter_api_calls_total',
+    'HTTP API calls by service and result',
+    ('service', 'result')
+))
+RETRIES: Counter = REGISTRY.add(Counter(
+    REGISTRY,
+    'autoposter_retries_total',
+    'Operations retried after error',
+    ('operation',)
+))
+FAILURES: Counter = REGISTRY.add(Counter(
+    REGISTRY,
+    'autoposter_failures_total',
+    'Operations failed',
+    ('operation',)
+))
+MEDIA_REQUESTS: Counter = REGISTRY.add(Counter(
+    REGISTRY,
+    'autoposter_media_requests_total',
+    'Requests to built-in media server by result',
+    ('result',)
+))
+BACKLOG: Gauge = REGISTRY.add(Gauge(
+    REGISTRY,
+    'autoposter_backlog_posts',
+    'Posts waiting to be reposted',
+    ()
+))
+CONTENT_BYTES: Gauge = REGISTRY.add(Gauge(
+    REGISTRY,
+    'autoposter_content_bytes',
+    'Size of downloaded and rendered content in temp_dir',
+    ()
+))
+SINCE_LAST_POST: Age = REGISTRY.add(Age(
+    REGISTRY,
+    'autoposter_seconds_since_last_post',
+    'Seconds since last successful repost to target',
+    ('target',)
+))
+
+
+def api_call(service: str, status_code: int) -> None:
+    '''Count API call by HTTP status'''
+    API_CALLS.inc(service, 'ok' if status_code < 400 else 'error')
+
+
+def directory_size(*paths: str) -> int:
+    '''Return size of files in directory trees, hard linked files are counted once'''
+    inodes = {}
+    for path in paths:
+        for dir_path, _, file_names in os.walk(path):
+            for file_name in file_names:
+                try:
+                    stat = os.stat(os.path.join(dir_path, file_name))
+                except OSError:
+                    # File is removed while walking
+                    continue
+                inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(inodes.values())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''Serves registry on /metrics'''
+    def do_GET(self): # pylint: disable=invalid-name
+        '''Return metrics'''
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''Scrapes are not logged'''
+
+
+_server: ThreadingHTTPServer | None = None
+
+
+def start_metrics(config: dict) -> None:
+    '''
+    Enable metrics and start exporter, configured by config['metrics'].
+    Nothing is done if metrics are disabled.
+    '''
+    global _server # pylint: disable=global-statement
+    metrics_config = config.get('metrics') or {}
+    if not metrics_config.get('enabled') or _server is not None:
+        return
+    REGISTRY.enabled = True
+    # Same as usage of media store: post folders and media objects, linked to them
+    content_dirs = [os.path.join(config['temp_dir'], name) for name in ('content', 'media')]
+    CONTENT_BYTES.set_function(lambda: directory_size(*content_dirs))
+    address = (metrics_config.get('host', '127.0.0.1'), metrics_config.get('port', 9464))
+    _server = ThreadingHTTPServer(address, _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Metrics are exported on http://%s:%s/metrics', *address)
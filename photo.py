@@ -1,30 +1,130 @@
 '''
 This class describes photo in post
 '''
+from __future__ import annotations
+import io
+import os
+import math
 import logging
-from time import sleep
+import tempfile
+from concurrent.futures import Future
 import requests
-from PIL import Image, ImageOps
+from autoposter_http import get_async_client, get_session
+from imagga_cache import file_digest, get_tag_cache
+from lazyimport import lazy_import
+from ratelimit import get_retrier
+from metrics import STAGE_SECONDS, FAILURES
+
+# Imaging is loaded by first render, so Telegram only deployment does not load it
+Image = lazy_import('PIL.Image')
+ImageOps = lazy_import('PIL.ImageOps')
+asyncio = lazy_import('asyncio')
+httpx = lazy_import('httpx')
 
 logger = logging.getLogger(__name__)
 
+# Instagram square side, px
+INST_SIZE = 1280
+# Instagram square encoder settings
+# Same quality as Pillow default, used before, optimized Huffman tables make file smaller
+JPEG_QUALITY = 75
+# 4:2:0 chroma subsampling
+JPEG_SUBSAMPLING = 2
+# Suffix of file with settings, square is rendered with
+RENDER_SUFFIX = '.render'
+
+IMAGGA_TAGS_URL = 'https://api.imagga.com/v2/tags'
+
 class Photo:
     '''
     This class describes photo in post
     '''
-    def __init__(self, photo_id, file_path: str, url: str):
-        ''' New photo '''
+    __slots__ = (
+        '__id',
+        '__file_path',
+        '__url',
+        '__tags',
+        '__squared_file_path',
+        '__download',
+        '__tg_file_id',
+        '__render',
+    )
+
+    def __init__(self, photo_id, file_path: str, url: str, download: Future | None = None):
+        '''
+        New photo. If download is given, file_path is ready
+        only when download future is done.
+        '''
         self.__id = photo_id
         self.__file_path = file_path
         self.__url = url
         self.__tags = []
         self.__squared_file_path = None
+        self.__download = download
+        self.__tg_file_id = None
+        self.__render = None
+
+    @property
+    def id(self):
+        ''' Return photo id '''
+        return self.__id
+
+    @property
+    def file_path(self):
+        ''' Return local photo file path '''
+        return self.__file_path
 
     @property
     def url(self):
         ''' Return photo url '''
         return self.__url
 
+    def wait_download(self) -> str:
+        '''
+        Block until photo file is on disk, return its path.
+        Download error is raised here.
+        '''
+        if self.__download is not None:
+            self.__download.result()
+            self.__download = None
+        return self.__file_path
+
+    async def wait_download_async(self) -> str:
+        '''
+        Same as wait_download, but event loop is not blocked.
+        Download may be thread future or task of async downloader.
+        '''
+        if (download := self.__download) is not None:
+            await asyncio.wrap_future(download)
+            self.__download = None
+        return self.__file_path
+
+    def when_downloaded(self, callback) -> None:
+        '''
+        Call callback() when photo file is on disk or download failed.
+        Callback is called at once if there is no pending download.
+        '''
+        if (download := self.__download) is None:
+            callback()
+        else:
+            download.add_done_callback(lambda _: callback())
+
+    def prerender(self, render: Future) -> None:
+        '''
+        Set pending render of Instagram square, it is waited by squarefy
+        '''
+        self.__render = render
+
+    @property
+    def tg_file_id(self):
+        ''' Return Telegram file_id of uploaded photo '''
+        return self.__tg_file_id
+
+    @tg_file_id.setter
+    def tg_file_id(self, file_id: str):
+        ''' Set Telegram file_id of uploaded photo '''
+        self.__tg_file_id = file_id
+
     @property
     def tags(self):
         ''' Return photo tags '''
@@ -35,73 +135,67 @@ class Photo:
         ''' Set photo tags '''
         self.__tags = tags
 
-    def get_imagga_tags(self, config) -> list[str]:
+    def to_dict(self) -> dict:
+        '''Return photo as dict, accepted by from_dict'''
+        return {
+            'id': self.__id,
+            'file_path': self.__file_path,
+            'url': self.__url,
+            'tags': self.__tags,
+            'tg_file_id': self.__tg_file_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Photo:
         '''
-        Receive photo tags from imagga.com
+        Create photo from to_dict result.
+        Pending download may be added to it as 'download'.
         '''
-        imagga_auth = (config['imagga']['api_key'], config['imagga']['api_secret'])
+        photo = cls(data['id'], data['file_path'], data['url'], data.get('download'))
+        photo.tags = data.get('tags', [])
+        photo.tg_file_id = data.get('tg_file_id')
+        return photo
 
+    def get_imagga_tags(self, config) -> list[str]:
+        '''
+        Receive photo tags from cache or imagga.com
+        '''
         logger.info('Getting tags for photo %s', self.__id)
+        digest, photo_tags = self.__cached_tags(config, self.wait_download())
+        if photo_tags is None:
+            with STAGE_SECONDS.time('imagga'):
+                photo_tags = self.__request_imagga_tags(config)
+            if digest:
+                get_tag_cache(config).put(digest, photo_tags)
+        return self.__set_tags(photo_tags)
 
-        attempts_left = 3
-        need_retry = True
-        tag_response = None
-
-        while attempts_left > 0 and need_retry:
-            attempts_left -= 1
-            try:
-                with open(self.__file_path, 'rb') as image:
-                    tag_response = requests.post(
-                        'https://api.imagga.com/v2/tags',
-                        auth=imagga_auth,
-                        files={'image': image},
-                        timeout=config['imagga']['timeout']
-                    )
-
-                logger.info(
-                    '%s tags received for photo %s',
-                    len(tag_response.json()['result'].get('tags')),
-                    self.__id
-                )
-            except requests.exceptions.ConnectionError as err:
-                logger.warning(
-                    '%s error receiving tags for photo %s (attempts left %s): %s',
-                    type(err),
-                    self.__id,
-                    attempts_left,
-                    err
-                )
-                if attempts_left == 0:
-                    logger.error('All attempts to receive tags for photo %s failed', self.__id)
-                    raise err
-                sleep(60)
-            except Exception as err:
-                logger.error(
-                    '%s Error receiving tags for photo %s: %s\n%s',
-                    type(err),
-                    self.__id,
-                    err,
-                    tag_response.text if tag_response is not None else ''
-                )
-                raise err
-            need_retry = False
+    async def get_imagga_tags_async(self, config) -> list[str]:
+        '''
+        Same as get_imagga_tags on event loop of async engine
+        '''
+        logger.info('Getting tags for photo %s', self.__id)
+        digest, photo_tags = self.__cached_tags(config, await self.wait_download_async())
+        if photo_tags is None:
+            with STAGE_SECONDS.time('imagga'):
+                photo_tags = await self.__request_imagga_tags_async(config)
+            if digest:
+                get_tag_cache(config).put(digest, photo_tags)
+        return self.__set_tags(photo_tags)
 
-        if tag_response is None:
-            logger.error(
-                'Error receiving tags for photo %s',
-                self.__id
-            )
-            raise ValueError('No valid response from imagga.com')
+    def __cached_tags(self, config, file_path: str) -> tuple[str | None, list[dict] | None]:
+        '''
+        Return photo digest and its cached raw tags.
+        Digest is None if cache is disabled, tags are None if photo is not cached.
+        '''
+        if not (tag_cache := get_tag_cache(config)):
+            return None, None
+        digest = file_digest(file_path)
+        if (photo_tags := tag_cache.get(digest)) is not None:
+            logger.info('%s tags for photo %s found in cache', len(photo_tags), self.__id)
+        return digest, photo_tags
 
-        try:
-            photo_tags = tag_response.json()['result'].get('tags')
-        except KeyError as err:
-            logger.error(
-                'Error parsing tags response for photo %s: %s',
-                self.__id,
-                tag_response.text
-            )
-            raise err
+    def __set_tags(self, photo_tags: list[dict]) -> list[str]:
+        '''Set photo tags from raw imagga tags, most confident first'''
         tags_string = ', '.join(
             set(
                 tag_data['tag']['en'] for tag_data in sorted(
@@ -114,27 +208,222 @@ class Photo:
 
         logger.info('Photo %s tags are: %s', self.__id, tags_string)
 
-        for tag in photo_tags:
-            self.__tags.append(tag['tag']['en'])
+        # Equal confidence tags are ordered by name, so result is stable between runs
+        self.__tags = [
+            tag['tag']['en'] for tag in sorted(
+                photo_tags,
+                key=lambda tag_data: (-tag_data['confidence'], tag_data['tag']['en'])
+            )
+        ]
         logger.debug('tags: %s', self.__tags)
         return self.__tags
 
+    def __request_imagga_tags(self, config) -> list[dict]:
+        '''
+        Upload photo to imagga.com and return raw tags list
+        '''
+        imagga_auth = (config['imagga']['api_key'], config['imagga']['api_secret'])
+        session = get_session(config, 'imagga')
 
-    def squarefy(self, size: int, color: str):
+        def request() -> requests.Response:
+            with open(self.__file_path, 'rb') as image:
+                response = session.post(
+                    IMAGGA_TAGS_URL,
+                    auth=imagga_auth,
+                    files={'image': image},
+                    timeout=config['imagga']['timeout']
+                )
+            response.raise_for_status()
+            return response
+
+        tag_response = None
+        try:
+            tag_response = get_retrier(config, 'imagga').call(request)
+            photo_tags = tag_response.json()['result'].get('tags')
+        except Exception as err:
+            self.__log_imagga_error(err, tag_response)
+            raise
+        logger.info('%s tags received for photo %s', len(photo_tags), self.__id)
+        return photo_tags
+
+    async def __request_imagga_tags_async(self, config) -> list[dict]:
         '''
-        Create sqare image with white fields. For IG
+        Upload photo to imagga.com and return raw tags list.
+        Retries and rate limit wait do not block event loop.
         '''
-        photo = Image.open(self.__file_path)
-        resized_photo = ImageOps.contain(photo, (size, size))
-        logger.debug('Photo %s resized to %s', self.__file_path, resized_photo.size)
-        squared_photo = ImageOps.pad(resized_photo, (size, size), color=color)
-        logger.debug(
-            'Photo %s squared to %s and filled with %s',
-            self.__file_path,
-            squared_photo.size,
-            color
+        client = await get_async_client(config, 'imagga')
+        imagga_auth = (config['imagga']['api_key'], config['imagga']['api_secret'])
+
+        async def request() -> httpx.Response:
+            with open(self.__file_path, 'rb') as image:
+                response = await client.post(
+                    IMAGGA_TAGS_URL,
+                    auth=imagga_auth,
+                    files={'image': image},
+                    timeout=config['imagga']['timeout']
+                )
+            response.raise_for_status()
+            return response
+
+        tag_response = None
+        try:
+            tag_response = await get_retrier(config, 'imagga').call_async(request)
+            photo_tags = tag_response.json()['result'].get('tags')
+        except Exception as err:
+            self.__log_imagga_error(err, tag_response)
+            raise
+        logger.info('%s tags received for photo %s', len(photo_tags), self.__id)
+        return photo_tags
+
+    def __log_imagga_error(self, err: Exception, tag_response) -> None:
+        '''Log error of tags request with response body, if any'''
+        FAILURES.inc('imagga')
+        if (response := getattr(err, 'response', None)) is not None:
+            tag_response = response
+        logger.error(
+            '%s Error receiving tags for photo %s: %s\n%s',
+            type(err),
+            self.__id,
+            err,
+            tag_response.text if tag_response is not None else ''
         )
-        self.__squared_file_path  = self.__file_path.replace('.jpg','_inst.jpg')
-        squared_photo.save(self.__squared_file_path )
-        logger.debug('Squared photo saved to %s', self.__squared_file_path)
+
+    def squarefy(self, size: int, color: str, quality: int = JPEG_QUALITY):
+        '''
+        Create sqare image with white fields. For IG
+        '''
+        if (render := self.__render) is not None:
+            self.__render = None
+            try:
+                self.__squared_file_path = render.result()
+                return self.__squared_file_path
+            except Exception as err:
+                logger.warning('%s: Photo %s was not prerendered: %s', type(err), self.__id, err)
+
+        with STAGE_SECONDS.time('render'):
+            self.__squared_file_path = render_square(
+                self.wait_download(),
+                square_path(self.__file_path),
+                size,
+                color,
+                quality
+            )
         return self.__squared_file_path
+
+    async def squarefy_async(self, size: int, color: str, quality: int = JPEG_QUALITY) -> str:
+        '''
+        Same as squarefy, event loop is not blocked while photo is rendered
+        '''
+        file_path = await self.wait_download_async()
+        if (render := self.__render) is not None:
+            self.__render = None
+            try:
+                self.__squared_file_path = await asyncio.wrap_future(render)
+                return self.__squared_file_path
+            except Exception as err:
+                logger.warning('%s: Photo %s was not prerendered: %s', type(err), self.__id, err)
+
+        with STAGE_SECONDS.time('render'):
+            self.__squared_file_path = await asyncio.to_thread(
+                render_square,
+                file_path,
+                square_path(self.__file_path),
+                size,
+                color,
+                quality
+            )
+        return self.__squared_file_path
+
+
+def square_path(file_path: str) -> str:
+    '''Return path of Instagram square of photo file, its name is used in web url too'''
+    return file_path.replace('.jpg', '_inst.jpg')
+
+
+def render_square(src_path: str, dst_path: str, size: int, color: str, quality: int) -> str:
+    '''
+    Fit photo into size x size square filled with color and save it as JPEG.
+    Rendered file is reused while it is newer than source and rendered with the same settings,
+    they are kept in dst_path + RENDER_SUFFIX.
+    '''
+    settings = f'{size} {color} {quality}'
+    if _is_rendered(src_path, dst_path, settings):
+        logger.debug('Squared photo %s is up to date', dst_path)
+        return dst_path
+
+    _write_file(dst_path, encode_square(src_path, size, color, quality))
+    _write_file(dst_path + RENDER_SUFFIX, settings.encode('utf-8'))
+    logger.debug('Squared photo saved to %s', dst_path)
+    return dst_path
+
+
+def _is_rendered(src_path: str, dst_path: str, settings: str) -> bool:
+    '''Return True if dst_path is rendered from current src_path with settings'''
+    try:
+        with open(dst_path + RENDER_SUFFIX, encoding='utf-8') as settings_file:
+            if settings_file.read() != settings:
+                return False
+        return os.path.getmtime(dst_path) >= os.path.getmtime(src_path)
+    except OSError:
+        return False
+
+
+def _write_file(path: str, data: bytes) -> None:
+    '''
+    Write data to unique temp file and rename it to path,
+    so concurrent writers of one path never mix their data
+    '''
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path),
+        prefix=os.path.basename(path) + '.',
+        suffix='.tmp',
+        delete=False
+    ) as temp_file:
+        try:
+            temp_file.write(data)
+        except OSError:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+    os.replace(temp_file.name, path)
+
+
+def encode_square(src_path: str, size: int, color: str, quality: int) -> bytes:
+    '''
+    Fit photo into size x size square filled with color, return it encoded as JPEG
+    '''
+    with Image.open(src_path) as photo:
+        icc_profile = photo.info.get('icc_profile')
+        # Only the longest side must fit, so JPEG may be decoded
+        # at 1/2, 1/4 or 1/8 scale, that is still not less than target
+        scale = size / max(photo.size)
+        photo.draft('RGB', (math.ceil(photo.width * scale), math.ceil(photo.height * scale)))
+        logger.debug('Photo %s is decoded at %s', src_path, photo.size)
+        photo = ImageOps.exif_transpose(photo)
+
+    if photo.mode != 'RGB':
+        photo = photo.convert('RGB')
+    scale = size / max(photo.size)
+    resized_size = (
+        max(1, round(photo.width * scale)),
+        max(1, round(photo.height * scale))
+    )
+    if photo.size != resized_size:
+        photo = photo.resize(resized_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    logger.debug('Photo %s resized to %s', src_path, photo.size)
+
+    squared_photo = Image.new('RGB', (size, size), color)
+    squared_photo.paste(photo, ((size - photo.width) // 2, (size - photo.height) // 2))
+    logger.debug('Photo %s squared to %s and filled with %s', src_path, squared_photo.size, color)
+
+    encoded = io.BytesIO()
+    squared_photo.save(
+        encoded,
+        'JPEG',
+        quality=quality,
+        optimize=True,
+        progressive=True,
+        subsampling=JPEG_SUBSAMPLING,
+        icc_profile=icc_profile
+    )
+    return encoded.getvalue()
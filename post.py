@@ -1,42 +1,67 @@
 '''
-This class describes post with one or more photos in it
+This class describes post with one or more photos in it.
+Posts are serialized to versioned dicts, JSON or msgpack (if installed),
+many posts are dumped and loaded as stream by dump_posts and load_posts.
 '''
+from __future__ import annotations
 
 import os
 import logging
 import json
-import asyncio
-import re
-from time import sleep
-import requests
-import telebot
-from telebot.types import InputMediaPhoto
-from googletrans import Translator
-from photo import Photo
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO
+from autoposter_http import get_async_client
+from lazyimport import lazy_import
+from mediaserver import serves_squares
+from photo import Photo, square_path, INST_SIZE, JPEG_QUALITY
+from ratelimit import get_retrier
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Target modules are loaded when post is reposted to target for the first time
+asyncio = lazy_import('asyncio')
+autoposter_inst = lazy_import('autoposter_inst')
+autoposter_tg = lazy_import('autoposter_tg')
+translator = lazy_import('translator')
 
 
 logger = logging.getLogger(__name__)
 
+# Version of dicts, returned by Post.to_dict.
+# Dicts without version were saved before it was added and have the same keys.
+SCHEMA_VERSION = 1
+FORMATS = ('json', 'msgpack')
+
+
+class SchemaError(ValueError):
+    '''Post data is written by newer version or is not post at all'''
+
+
 class Post:
     '''
     This class describes post with one or more photos in it
     '''
+    __slots__ = ('__id', '__text', '__tags', '__photos')
+
     def __init__(self, post):
+        '''
+        New post with id or post from to_dict result
+        '''
         self.__text: str = ''
         self.__tags: list[str] = []
         self.__photos: list[Photo] = []
 
         if isinstance(post, dict):
+            if (version := post.get('v', 1)) != SCHEMA_VERSION:
+                raise SchemaError(f'Post schema version {version} is not supported')
             self.__id = post.get('id')
             self.__text = post.get('text', '')
             self.__tags = post.get('tags', [])
-            self.__photos = []
-            post_photos = post.get('photos', [])
-
-            for photo_dict in post_photos:
-                photo = Photo(photo_dict['id'], photo_dict['file_path'], photo_dict['url'])
-                photo.tags = photo_dict['tags']
-                self.__photos.append(photo)
+            self.__photos = [Photo.from_dict(photo_dict) for photo_dict in post.get('photos', [])]
         else:
             self.__id = post
 
@@ -62,24 +87,76 @@ class Post:
     def text(self, text: str):
         self.__text = text
 
-    def add_photo(self, photo_id: int, file: str, url: str ) -> None:
-        "Add photo to post"
-        self.__photos.append(Photo(photo_id, file, url))
-
+    def add_photo(
+        self,
+        photo_id: int,
+        file: str,
+        url: str,
+        download: Future | None = None
+    ) -> None:
+        '''
+        Add photo to post.
+        download is pending transfer of url to file (future or task), if any
+        '''
+        self.__photos.append(Photo(photo_id, file, url, download))
+
+
+    def to_dict(self) -> dict:
+        '''Return post as dict, accepted by constructor'''
+        return {
+            'v': SCHEMA_VERSION,
+            'id': self.__id,
+            'text': self.__text,
+            'tags': self.__tags,
+            'photos': [photo.to_dict() for photo in self.__photos],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Post:
+        '''Create post from to_dict result'''
+        if not isinstance(data, dict):
+            raise SchemaError(f'Post must be dict, not {type(data).__name__}')
+        return cls(data)
+
+    def to_json(self) -> str:
+        '''Return post as JSON, accepted by from_json'''
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text: str | bytes) -> Post:
+        '''Create post from to_json result'''
+        return cls.from_dict(json.loads(text))
 
-    def to_json(self):
-        '''converts post to serializable json'''
-        return json.dumps(self, default=lambda o: o.__dict__)
+    @staticmethod
+    def prefetch_translations(config: dict, posts: list[Post]) -> None:
+        '''
+        Translate Instagram captions of several posts at once.
+        Translations are memoized, so reposts later use them without requests.
+        '''
+        try:
+            translator.get_translation_service(config).translate_many([
+                post.__reformat_text(config, 'inst', translate=False) # pylint: disable=protected-access
+                for post in posts
+            ])
+        except Exception as err:
+            # Captions will be translated one by one while reposting
+            logger.warning('%s: Cannot translate captions in batch: %s', type(err), err)
 
     @staticmethod
-    async def __translate_text(text, src_lang = 'ru', dst_lang = 'en'):
-        '''Translate photo title with google translate'''
-        async with Translator() as translator:
-            result = await translator.translate(text, src=src_lang, dest=dst_lang)
-        logger.info('Text %s translated as %s', text, result.text)
-        return result.text
-
-    def __reformat_text(self, config: dict, target: str) -> str:
+    async def prefetch_translations_async(config: dict, posts: list[Post]) -> None:
+        '''
+        Same as prefetch_translations on event loop of async engine
+        '''
+        try:
+            await translator.get_translation_service(config).translate_many_async([
+                post.__reformat_text(config, 'inst', translate=False) # pylint: disable=protected-access
+                for post in posts
+            ])
+        except Exception as err:
+            # Captions will be translated one by one while reposting
+            logger.warning('%s: Cannot translate captions in batch: %s', type(err), err)
+
+    def __reformat_text(self, config: dict, target: str, translate: bool = True) -> str:
         '''
         Replace vk links to markdown links.
         Apply customization, described in config['replaces']
@@ -88,42 +165,48 @@ class Post:
         # text = post.text
         if not (text := self.__text):
             return ''
-        replaces = config['replaces']
-        vk_link_pattern = re.compile(r'\[id\d+\|[\w\s]+\]')
-        vk_links = re.findall(vk_link_pattern, text)
-
-        if target == 'tg':
-            for vk_link in vk_links:
-                vk_id, vk_name = vk_link.strip('[]').split('|')
-                if vk_id in replaces.keys():
-                    text = text.replace(vk_link, replaces[vk_id]['tg'])
-                    logger.debug('VK link %s replaced with %s', vk_link, replaces[vk_id]["tg"])
-                else:
-                    text = text.replace(vk_link, f'[{vk_name}](https://vk.com/{vk_id})')
-                    logger.debug(
-                        'VK link %s replaced with [%s](https://vk.com/%s)',
-                        vk_link,
-                        vk_name,
-                        vk_id
-
-                    )
-        elif target == 'inst':
-            text = text.replace('В кадре:', 'Md:')
-            for vk_link in vk_links:
-                vk_id, vk_name = vk_link.strip('[]').split('|')
-                if vk_id in replaces.keys():
-                    text = text.replace(vk_link, replaces[vk_id]['inst'])
-                    logger.debug('VK link %s replaced with %s', vk_link, replaces[vk_id]["inst"])
-                else:
-                    text = text.replace(vk_link, vk_name)
-                    logger.debug('VK link %s replaced with %s', vk_link, vk_name)
-            text = asyncio.run(self.__translate_text(text))
+        text = config.rewriters[target].rewrite(text)
+
+        if target == 'inst' and translate:
+            text = translator.get_translation_service(config).translate(text)
         return text
 
     def add_tags(self, config: dict) -> None:
         '''
         Add photo tags to post tags
         '''
+        custom_tags = []
+        if self.__photos:
+            workers = min(config['imagga'].get('concurrency', 4), len(self.__photos))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imagga') as executor:
+                # map keeps photo order, so tag order does not depend on response timing
+                for photo_tags in executor.map(
+                    lambda photo: photo.get_imagga_tags(config),
+                    self.__photos
+                ):
+                    custom_tags.extend(photo_tags)
+        self.__select_tags(config, custom_tags)
+
+    async def add_tags_async(self, config: dict) -> None:
+        '''
+        Same as add_tags, photos are tagged concurrently on event loop
+        '''
+        slots = asyncio.Semaphore(config['imagga'].get('concurrency', 4))
+
+        async def get_tags(photo: Photo) -> list[str]:
+            async with slots:
+                return await photo.get_imagga_tags_async(config)
+
+        # gather keeps photo order, so tag order does not depend on response timing
+        custom_tags = []
+        for photo_tags in await asyncio.gather(*(get_tags(photo) for photo in self.__photos)):
+            custom_tags.extend(photo_tags)
+        self.__select_tags(config, custom_tags)
+
+    def __select_tags(self, config: dict, custom_tags: list[str]) -> None:
+        '''
+        Set post tags: default ones and most relevant photo tags
+        '''
         self.__tags = config['instagram']['default_tags'].copy()
         logger.debug('Source post %s tags are %s', self.__id, self.__tags)
         custom_tags_count = config['instagram']['total_tags_count'] - len(self.__tags) - 1
@@ -133,12 +216,11 @@ class Post:
             len(self.__tags),
             custom_tags_count
         )
-        custom_tags = []
 
-        for photo in self.__photos:
-            custom_tags.extend(photo.get_imagga_tags(config))
-
-        top_post_tags = list(filter(lambda tag: ' ' not in tag, custom_tags))[0:custom_tags_count]
+        top_post_tags = [
+            tag for tag in dict.fromkeys(custom_tags)
+            if ' ' not in tag and tag not in self.__tags
+        ][0:custom_tags_count]
         self.__tags.extend(top_post_tags)
         self.__tags = [f'#{tag}' for tag in self.__tags]
         logger.info('Post %s final tags are %s', self.__id, self.__tags)
@@ -147,181 +229,164 @@ class Post:
         '''
         Repost to IG as single photo or carousel
         '''
-        ig_token = config['instagram']['app_token']
-        if config["instagram"]["proxy"]:
-            proxies = {
-                'http': config["instagram"]["proxy"],
-                'https': config["instagram"]["proxy"]
-            }
-            logger.debug('Using proxy %s', config["instagram"]["proxy"])
+        ig_id = autoposter_inst.get_user_id(config)
+        inst_text = self.__inst_text(self.__reformat_text(config, 'inst'))
+
+        # prepare photo list
+        if serves_squares(config):
+            # Media server renders squares, when Instagram fetches them
+            squares = [square_path(photo.wait_download()) for photo in self.__photos]
         else:
-            logger.debug('No proxy for Instagram will be used')
-            proxies = None
-
-        inst_me = requests.get(
-            'https://graph.instagram.com/v21.0/me',
-            params={
-                'access_token': ig_token,
-                'fields': 'user_id,username,account_type,name'
-            },
-            proxies=proxies,
-            timeout=10
+            squares = [
+                photo.squarefy(
+                    INST_SIZE,
+                    config['instagram']['fill_color'],
+                    config['instagram'].get('jpeg_quality', JPEG_QUALITY)
+                )
+                for photo in self.__photos
+            ]
+        inst_photos = self.__web_urls(config, squares)
+
+        # https://developers.facebook.com/docs/instagram-platform/instagram-api-with-instagram-login/content-publishing
+        # https://developers.facebook.com/docs/instagram-platform/instagram-graph-api/reference/ig-user/media?locale=en_US
+        media_id = autoposter_inst.ContainerPipeline(config, ig_id).publish(
+            inst_photos,
+            inst_text
+        )
+
+        logger.info(
+            'Post %s is reposted to Instagram with ID %s',
+            self.__id,
+            media_id
         )
 
-        ig_id = inst_me.json()['user_id']
-        logger.debug('Instagram user ID is %s', ig_id)
+    async def repost_to_instagram_async(self, config: dict) -> None:
+        '''
+        Same as repost_to_instagram on event loop of async engine
+        '''
+        ig_id = await autoposter_inst.get_user_id_async(config)
+        if text := self.__reformat_text(config, 'inst', translate=False):
+            service = translator.get_translation_service(config)
+            text = (await service.translate_many_async([text]))[0]
+        inst_text = self.__inst_text(text)
+
+        if serves_squares(config):
+            # Media server renders squares, when Instagram fetches them
+            squares = [square_path(await photo.wait_download_async()) for photo in self.__photos]
+        else:
+            # Prerendered photos are already in flight, others are rendered one by one
+            squares = [
+                await photo.squarefy_async(
+                    INST_SIZE,
+                    config['instagram']['fill_color'],
+                    config['instagram'].get('jpeg_quality', JPEG_QUALITY)
+                )
+                for photo in self.__photos
+            ]
+        inst_photos = self.__web_urls(config, squares)
 
-        # prepare text
-        inst_text = self.__reformat_text(config, 'inst') + '\n\n' + ' '.join(self.__tags)
+        client = await get_async_client(config, 'instagram')
+        media_id = await autoposter_inst.AsyncContainerPipeline(config, ig_id, client).publish(
+            inst_photos,
+            inst_text
+        )
 
+        logger.info(
+            'Post %s is reposted to Instagram with ID %s',
+            self.__id,
+            media_id
+        )
+
+    def __inst_text(self, text: str) -> str:
+        '''Return Instagram caption: reformatted text and tags'''
+        inst_text = text + '\n\n' + ' '.join(self.__tags)
         logger.info(
             'Final text is:\n%s\n',
             inst_text
         )
+        return inst_text
 
-        # prepare photo list
-        inst_photos = []
-        for photo in self.__photos:
-            local_photo_path = photo.squarefy(
-                1280,
-                config['instagram']['fill_color']
-            )
-            web_photo_path = '/'.join(
+    def __web_urls(self, config: dict, local_photo_paths: list[str]) -> list[str]:
+        '''Return web urls of squared photos'''
+        inst_photos = [
+            '/'.join(
                 [
                     config["instagram"]['web_photo_location'],
                     str(self.__id),
                     os.path.basename(local_photo_path)
                 ]
             )
-            inst_photos.append(web_photo_path)
-
+            for local_photo_path in local_photo_paths
+        ]
         logger.debug('Post %s photo web urls: %s', self.__id, inst_photos)
-
-        # https://developers.facebook.com/docs/instagram-platform/instagram-api-with-instagram-login/content-publishing
-        # https://developers.facebook.com/docs/instagram-platform/instagram-graph-api/reference/ig-user/media?locale=en_US
-
-        if len(inst_photos) > 1:
-            # Carousel
-            child_containers = []
-
-            for photo in inst_photos:
-                logger.info('Uploading photo %s', photo)
-                photo_container = requests.post(
-                    f'https://graph.instagram.com/v21.0/{ig_id}/media',
-                    params={
-                        'image_url': photo,
-                        'is_carousel_item': 'true',
-                        'access_token': ig_token
-                    },
-                    proxies=proxies,
-                    timeout=config['instagram']['timeout']
-                )
-                sleep(3) # to avoid 9007 error
-                logger.info(
-                    'Photo container with photo %s post result: %s',
-                    photo,
-                    photo_container.json()
-                )
-
-                child_containers.append(photo_container)
-
-            media_container = requests.post(
-                f'https://graph.instagram.com/v21.0/{ig_id}/media',
-                params={
-                    'caption': inst_text,
-                    'media_type': 'CAROUSEL',
-                    'children': ','.join(
-                        [child_container.json()['id'] for child_container in child_containers]
-                    ),
-                    'access_token': ig_token
-                },
-                proxies=proxies,
-                timeout=config['instagram']['timeout']
-            )
-
-            sleep(3) # to avoid 9007 error
-            logger.info(
-                'Carousel container with photos %s post result: %s',
-                child_containers,
-                media_container.json()
-            )
-        else:
-            media_container = requests.post(
-                f'https://graph.instagram.com/v21.0/{ig_id}/media',
-                params={
-                    'image_url': inst_photos[0],
-                    'caption': inst_text,
-                    'access_token': ig_token
-                },
-                proxies=proxies,
-                timeout=config['instagram']['timeout']
-            )
-            sleep(3) # to avoid 9007 error
-
-            logger.info(
-                'Single photo container with photo %s post result: %s',
-                inst_photos[0],
-                media_container.json()
-            )
-
-        inst_post = requests.post(
-            f'https://graph.instagram.com/v21.0/{ig_id}/media_publish',
-            params={
-                'creation_id': media_container.json()['id'],
-                'access_token': ig_token
-            },
-            proxies=proxies,
-            timeout=config['instagram']['timeout']
-        )
-
-        logger.info(
-            'Instagram post result: %s',
-            inst_post.json()
-        )
-
-
-        try:
-            logger.info(
-                'Post %s is reposted to Instagram with ID %s',
-                self.__id,
-                inst_post.json()['id']
-            )
-        except Exception as err:
-            logger.error(
-                'Instagram API error %s: %s',
-                err,
-                inst_post.json()
-            )
-            raise
+        return inst_photos
 
     def repost_to_tg(self, config: dict):
         '''Repost to telegram'''
-        bot = telebot.TeleBot(config['telegram']['token'])
-
         post_text = self.__reformat_text(config, 'tg')
 
-        medias = []
-
-        for photo in self.__photos:
-            medias.append(InputMediaPhoto(media=photo.url))
-
-        medias[0].caption = post_text
-        medias[0].parse_mode = 'markdown'
-
-        bot.send_media_group(
-            chat_id=config['telegram']['channel_id'],
-            media=medias
+        autoposter_tg.get_telegram_publisher(config).publish(
+            get_retrier(config, 'telegram'),
+            self.__id,
+            config.channel_ids,
+            post_text,
+            self.__photos
         )
 
-        logger.info(
-            "Post id=%s (%s photos) reposted to Telegram channel %s",
+    async def repost_to_tg_async(self, config: dict):
+        '''Same as repost_to_tg on event loop of async engine'''
+        await autoposter_tg.get_telegram_publisher(config).publish_async(
+            await get_async_client(config, 'telegram'),
+            get_retrier(config, 'telegram'),
             self.__id,
-            len(medias),
-            config['telegram']['channel_id']
+            config.channel_ids,
+            self.__reformat_text(config, 'tg'),
+            self.__photos
         )
 
 
 class PostEncoder(json.JSONEncoder):
-    '''Service class'''
+    '''Encodes posts and photos as their dicts'''
     def default(self, o):
-        return o.__dict__
+        if isinstance(o, (Post, Photo)):
+            return o.to_dict()
+        return super().default(o)
+
+
+def _check_format(fmt: str) -> None:
+    '''Raise error if posts cannot be serialized in fmt'''
+    if fmt not in FORMATS:
+        raise ValueError(f'Format must be one of {", ".join(FORMATS)}, not {fmt}')
+    if fmt == 'msgpack' and msgpack is None:
+        raise RuntimeError('msgpack is not installed')
+
+
+def dump_posts(posts: Iterable[Post], stream: BinaryIO, fmt: str = 'json') -> int:
+    '''
+    Write posts to binary stream one by one: JSON lines or msgpack objects.
+    Return number of written posts.
+    '''
+    _check_format(fmt)
+    packer = msgpack.Packer() if fmt == 'msgpack' else None
+    count = 0
+    for post in posts:
+        if packer:
+            stream.write(packer.pack(post.to_dict()))
+        else:
+            stream.write(post.to_json().encode('utf-8') + b'\n')
+        count += 1
+    return count
+
+
+def load_posts(stream: BinaryIO, fmt: str = 'json') -> Iterator[Post]:
+    '''
+    Read posts, written by dump_posts, from binary stream one by one
+    '''
+    _check_format(fmt)
+    if fmt == 'msgpack':
+        for data in msgpack.Unpacker(stream, raw=False):
+            yield Post.from_dict(data)
+    else:
+        for line in stream:
+            if line.strip():
+                yield Post.from_json(line)
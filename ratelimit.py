@@ -0,0 +1,344 @@
+'''
+This module contains request rate limiters and retry policies shared by all callers of a service.
+Retrier of service waits for its rate limit before every request and repeats requests,
+failed with transient errors, with exponential backoff and jitter.
+Pause, asked by service (Retry-After, Telegram retry_after), holds back all its callers.
+'''
+from __future__ import annotations
+
+import time
+import random
+import logging
+import threading
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple, TypeVar
+import requests
+from vk.exceptions import VkAPIError
+from lazyimport import lazy_import
+from metrics import RETRIES
+
+asyncio = lazy_import('asyncio')
+httpx = lazy_import('httpx')
+
+logger = logging.getLogger(__name__)
+
+Result = TypeVar('Result')
+
+# HTTP statuses of throttling and temporary server problems
+TRANSIENT_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# Statuses, meaning that request was rejected before it was processed
+REJECTED_STATUSES = frozenset({429, 503})
+# Network errors, after which request may be repeated
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+# VK API errors: unknown error, too many requests per second, internal server error
+VK_TRANSIENT_CODES = frozenset({1, 6, 10})
+VK_THROTTLED_CODES = frozenset({6})
+
+
+class RateLimiter:
+    '''
+    Thread-safe token bucket: rate requests per second, up to burst at once
+    '''
+    def __init__(self, rate: float, burst: int = 1):
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __take(self) -> float:
+        '''Take one token if it is available, otherwise return delay until it is'''
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(
+                self.__burst,
+                self.__tokens + (now - self.__updated) * self.__rate
+            )
+            self.__updated = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0
+            return (1 - self.__tokens) / self.__rate
+
+    def acquire(self) -> float:
+        '''
+        Take one token, sleeping until it is available.
+        Return time spent waiting.
+        '''
+        waited = 0.0
+        while delay := self.__take():
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    async def acquire_async(self) -> float:
+        '''Same as acquire, but event loop is not blocked while waiting'''
+        waited = 0.0
+        while delay := self.__take():
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+
+class RetryPolicy(NamedTuple):
+    '''
+    How many times request is tried and pauses between attempts, seconds.
+    Pause after n-th failed attempt is delay * 2 ** (n - 1), up to max_delay,
+    half of it is random, so callers, failed at once, do not retry at once.
+    '''
+    attempts: int = 3
+    delay: float = 1
+    max_delay: float = 60
+
+    def backoff(self, attempt: int) -> float:
+        '''Return pause after failed attempt (1-based)'''
+        limit = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        return limit / 2 + random.uniform(0, limit / 2)
+
+
+# service: default retry policy, config['retry'][service] overrides it
+RETRY_POLICIES = {
+    'vk': RetryPolicy(attempts=3, delay=1, max_delay=30),
+    'imagga': RetryPolicy(attempts=3, delay=5, max_delay=60),
+    'telegram': RetryPolicy(attempts=3, delay=1, max_delay=60),
+    'instagram': RetryPolicy(attempts=3, delay=2, max_delay=60),
+    'download': RetryPolicy(attempts=3, delay=0.5, max_delay=10),
+}
+# service: requests per second, unless set in config
+DEFAULT_RATES = {
+    # VK API limit of user token
+    'vk': 3,
+}
+# service: config section, where its attempts and rate were set before retry section
+LEGACY_SECTIONS = {
+    'download': 'downloader',
+}
+
+
+class Verdict(NamedTuple):
+    '''Whether failed request may succeed if repeated and pause, asked by service, seconds'''
+    retryable: bool
+    retry_after: float | None = None
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    '''Return seconds of Retry-After header: number of seconds or HTTP date'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(err: BaseException, idempotent: bool = True) -> Verdict:
+    '''
+    Tell whether request, failed with err, may be repeated.
+    Network failures, throttling and server errors are transient, others are fatal.
+    Request, which is not idempotent, is repeated only if service surely has not processed it.
+    '''
+    if (retryable := getattr(err, 'retryable', None)) is not None:
+        # Errors of this application tell it themselves
+        return Verdict(bool(retryable), getattr(err, 'retry_after', None))
+    if isinstance(err, VkAPIError):
+        return Verdict(err.code in (VK_TRANSIENT_CODES if idempotent else VK_THROTTLED_CODES))
+    if isinstance(code := getattr(err, 'error_code', None), int):
+        # Telegram Bot API error. It is recognized by fields, so telebot is not loaded here.
+        parameters = (getattr(err, 'result_json', None) or {}).get('parameters') or {}
+        return Verdict(
+            code in (TRANSIENT_STATUSES if idempotent else REJECTED_STATUSES),
+            parameters.get('retry_after')
+        )
+    if isinstance(err, TRANSIENT_ERRORS):
+        return Verdict(idempotent or isinstance(err, requests.exceptions.ConnectTimeout))
+    if isinstance(status := getattr(getattr(err, 'response', None), 'status_code', None), int):
+        # Error status, raised by requests or httpx
+        return Verdict(
+            status in (TRANSIENT_STATUSES if idempotent else REJECTED_STATUSES),
+            parse_retry_after(err.response.headers.get('Retry-After'))
+        )
+    # httpx is loaded by async engine only, so its errors are checked last
+    if type(err).__module__.startswith('httpx') and isinstance(err, httpx.TransportError):
+        return Verdict(idempotent or isinstance(err, (httpx.ConnectError, httpx.ConnectTimeout)))
+    return Verdict(False)
+
+
+class Retrier:
+    '''
+    Sends requests of service: waits for its rate limit and pause, asked by service,
+    and repeats requests, failed with transient errors, by policy
+    '''
+    def __init__(self, service: str, policy: RetryPolicy, limiter: RateLimiter | None = None):
+        self.__service = service
+        self.__policy = policy
+        self.__limiter = limiter
+        self.__paused_until = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def policy(self) -> RetryPolicy:
+        ''' Return retry policy '''
+        return self.__policy
+
+    def __pause_left(self) -> float:
+        '''Return time left until end of pause, asked by service'''
+        with self.__lock:
+            return max(0.0, self.__paused_until - time.monotonic())
+
+    def __retry_delay(
+        self,
+        err: Exception,
+        attempt: int,
+        idempotent: bool,
+        deadline: float | None
+    ) -> float | None:
+        '''Return pause before next attempt, None if request is not repeated'''
+        verdict = classify(err, idempotent)
+        if not verdict.retryable:
+            if not idempotent and classify(err).retryable:
+                # Service may have processed request, so callers must not repeat it either
+                err.retryable = False
+            return None
+        if attempt >= self.__policy.attempts:
+            return None
+        delay = self.__policy.backoff(attempt)
+        if verdict.retry_after is not None:
+            if verdict.retry_after > self.__policy.max_delay:
+                logger.warning(
+                    '%s asks to wait %s s, more than %s s allowed',
+                    self.__service,
+                    verdict.retry_after,
+                    self.__policy.max_delay
+                )
+                return None
+            delay = max(delay, verdict.retry_after)
+            with self.__lock:
+                self.__paused_until = max(
+                    self.__paused_until,
+                    time.monotonic() + verdict.retry_after
+                )
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        RETRIES.inc(self.__service)
+        logger.warning(
+            '%s: %s request failed (attempt %s of %s), retry in %.1f s: %s',
+            type(err),
+            self.__service,
+            attempt,
+            self.__policy.attempts,
+            delay,
+            err
+        )
+        return delay
+
+    def call(
+        self,
+        request: Callable[[], Result],
+        idempotent: bool = True,
+        deadline: float | None = None
+    ) -> Result:
+        '''
+        Return result of request, repeated after transient errors.
+        Last error is raised, when attempts are over or next one would start after deadline
+        (time.monotonic value).
+        '''
+        attempt = 0
+        while True:
+            attempt += 1
+            while pause := self.__pause_left():
+                time.sleep(pause)
+            if self.__limiter:
+                self.__limiter.acquire()
+            try:
+                return request()
+            except Exception as err:
+                if (delay := self.__retry_delay(err, attempt, idempotent, deadline)) is None:
+                    raise
+            time.sleep(delay)
+
+    async def call_async(
+        self,
+        request: Callable[[], Awaitable[Result]],
+        idempotent: bool = True,
+        deadline: float | None = None
+    ) -> Result:
+        '''Same as call, but event loop is not blocked by pauses'''
+        attempt = 0
+        while True:
+            attempt += 1
+            while pause := self.__pause_left():
+                await asyncio.sleep(pause)
+            if self.__limiter:
+                await self.__limiter.acquire_async()
+            try:
+                return await request()
+            except Exception as err:
+                if (delay := self.__retry_delay(err, attempt, idempotent, deadline)) is None:
+                    raise
+            await asyncio.sleep(delay)
+
+
+# service: ((rate, burst), limiter)
+_limiters: dict[str, tuple[tuple[float, int], RateLimiter]] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(service: str, rate: float | None, burst: int = 1) -> RateLimiter | None:
+    '''
+    Return process-wide limiter for service, None if rate is not limited.
+    Limiter is recreated when rate or burst is changed.
+    '''
+    if not rate:
+        return None
+    with _limiters_lock:
+        cached = _limiters.get(service)
+        if cached is None or cached[0] != (rate, burst):
+            logger.debug('Rate limit for %s is %s requests/s', service, rate)
+            cached = ((rate, burst), RateLimiter(rate, burst))
+            _limiters[service] = cached
+        return cached[1]
+
+
+# service: ((policy, limiter), retrier)
+_retriers: dict[str, tuple[tuple, Retrier]] = {}
+_retriers_lock = threading.Lock()
+
+
+def _retry_settings(config: dict, service: str) -> dict:
+    '''Return retry settings of service, config['retry'] ones override older section keys'''
+    section = config.get(LEGACY_SECTIONS.get(service, service)) or {}
+    return {
+        **{key: section[key] for key in ('attempts', 'requests_per_second') if key in section},
+        **((config.get('retry') or {}).get(service) or {}),
+    }
+
+
+def get_retrier(config: dict, service: str) -> Retrier:
+    '''
+    Return process-wide retrier of service with policy and rate from config['retry'][service].
+    Retrier is recreated when they are changed.
+    '''
+    settings = _retry_settings(config, service)
+    policy = RETRY_POLICIES.get(service, RetryPolicy())._replace(**{
+        key: settings[key] for key in RetryPolicy._fields if key in settings
+    })
+    limiter = get_rate_limiter(
+        service,
+        settings.get('requests_per_second', DEFAULT_RATES.get(service))
+    )
+    with _retriers_lock:
+        cached = _retriers.get(service)
+        if cached is None or cached[0] != (policy, limiter):
+            logger.debug('Retry policy for %s is %s', service, policy)
+            cached = ((policy, limiter), Retrier(service, policy, limiter))
+            _retriers[service] = cached
+        return cached[1]
@@ -0,0 +1,126 @@
+'''
+This module contains Instagram squares rendering stage.
+Photos are rendered in worker processes as soon as they are downloaded,
+number of photos in flight is bounded to keep memory capped.
+'''
+from __future__ import annotations
+
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from mediaserver import serves_squares
+from photo import Photo, render_square, square_path, INST_SIZE, JPEG_QUALITY
+from metrics import STAGE_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+
+def _render(*args) -> tuple[str, float]:
+    '''Run render_square in worker, return its result and duration'''
+    started = time.perf_counter()
+    return render_square(*args), time.perf_counter() - started
+
+
+class RenderStage:
+    '''
+    Process pool, rendering Instagram squares ahead of publishing
+    '''
+    def __init__(self, workers: int, max_in_flight: int):
+        # Parent has running threads, so workers are spawned, not forked
+        self.__executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        # Waits for free slots, so neither caller nor downloader is blocked
+        self.__feeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render-feeder')
+        logger.debug('Render stage started with %s workers', workers)
+
+    def submit(self, photo: Photo, size: int, color: str, quality: int) -> Future:
+        '''
+        Render photo when it is downloaded.
+        Future result is path of rendered file.
+        '''
+        result = Future()
+        result.set_running_or_notify_cancel()
+
+        def finish(render: Future) -> None:
+            self.__slots.release()
+            if (err := render.exception()) is not None:
+                result.set_exception(err)
+            else:
+                dst_path, duration = render.result()
+                STAGE_SECONDS.observe(duration, 'render')
+                result.set_result(dst_path)
+
+        def start() -> None:
+            try:
+                src_path = photo.wait_download()
+            except Exception as err:
+                result.set_exception(err)
+                return
+            # Waits while too many photos are in flight
+            self.__slots.acquire() # pylint: disable=consider-using-with
+            try:
+                render = self.__executor.submit(
+                    _render,
+                    src_path,
+                    square_path(src_path),
+                    size,
+                    color,
+                    quality
+                )
+            except Exception as err:
+                self.__slots.release()
+                result.set_exception(err)
+                return
+            render.add_done_callback(finish)
+
+        photo.when_downloaded(lambda: self.__feeder.submit(start))
+        return result
+
+    def close(self) -> None:
+        '''Stop worker processes'''
+        self.__feeder.shutdown(wait=True, cancel_futures=True)
+        self.__executor.shutdown(wait=True, cancel_futures=True)
+
+
+_render_stage: RenderStage | None = None
+
+
+def get_render_stage(config: dict) -> RenderStage:
+    '''
+    Return process-wide render stage, configured by config['instagram']
+    '''
+    global _render_stage # pylint: disable=global-statement
+    if _render_stage is None:
+        workers = config['instagram'].get('render_workers') or os.cpu_count() or 1
+        _render_stage = RenderStage(
+            workers,
+            config['instagram'].get('render_in_flight') or workers * 2
+        )
+    return _render_stage
+
+
+def prerender_posts(config: dict, posts: list) -> None:
+    '''
+    Start rendering Instagram squares of posts photos.
+    Nothing is rendered ahead, when squares are served by media server.
+    '''
+    if not posts or serves_squares(config):
+        return
+    stage = get_render_stage(config)
+    for post in posts:
+        for photo in post.photos:
+            photo.prerender(
+                stage.submit(
+                    photo,
+                    INST_SIZE,
+                    config['instagram']['fill_color'],
+                    config['instagram'].get('jpeg_quality', JPEG_QUALITY)
+                )
+            )
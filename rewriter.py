@@ -0,0 +1,93 @@
+'''
+This module contains caption rewriter.
+VK links and plain substitutions are applied in one regex pass,
+rules are compiled once per target from config['replaces'].
+'''
+from __future__ import annotations
+
+import re
+import logging
+from collections.abc import Callable
+from typing import NamedTuple
+
+
+logger = logging.getLogger(__name__)
+
+VK_LINK_PATTERN = r'\[(?P<vk_id>id\d+)\|(?P<vk_name>[\w\s]+)\]'
+
+
+class TargetRules(NamedTuple):
+    '''
+    Caption rules of one target:
+    link - how to show VK link without replace in config['replaces'],
+    substitutions - plain text replaces
+    '''
+    link: Callable[[str, str], str]
+    substitutions: dict[str, str]
+
+
+TARGET_RULES: dict[str, TargetRules] = {
+    'tg': TargetRules(
+        link=lambda vk_id, vk_name: f'[{vk_name}](https://vk.com/{vk_id})',
+        substitutions={}
+    ),
+    'inst': TargetRules(
+        link=lambda vk_id, vk_name: vk_name,
+        substitutions={'В кадре:': 'Md:'}
+    ),
+}
+
+
+def register_target(
+    target: str,
+    link: Callable[[str, str], str],
+    substitutions: dict[str, str] | None = None
+) -> None:
+    '''
+    Add or redefine caption rules for target.
+    Rules are used by configs, loaded after this call.
+    '''
+    TARGET_RULES[target] = TargetRules(link, substitutions or {})
+
+
+class CaptionRewriter:
+    '''
+    Rewrites caption for one target in single re.sub pass
+    '''
+    def __init__(self, replaces: dict, target: str):
+        rules = TARGET_RULES[target]
+        self.__target = target
+        self.__link = rules.link
+        self.__substitutions = rules.substitutions
+        # Configured replaces for this target only
+        self.__replaces = {
+            vk_id: replace[target]
+            for vk_id, replace in (replaces or {}).items()
+            if target in replace
+        }
+
+        alternatives = [VK_LINK_PATTERN]
+        if self.__substitutions:
+            # Longest first, so overlapping substitutions match greedily
+            plains = sorted(self.__substitutions, key=len, reverse=True)
+            alternatives.append(
+                '(?P<plain>' + '|'.join(re.escape(plain) for plain in plains) + ')'
+            )
+        self.__pattern = re.compile('|'.join(alternatives))
+
+    def __replace(self, match: re.Match) -> str:
+        '''re.sub callback'''
+        if (plain := match.group('plain') if self.__substitutions else None) is not None:
+            return self.__substitutions[plain]
+
+        vk_id, vk_name = match.group('vk_id', 'vk_name')
+        if vk_id in self.__replaces:
+            replace = self.__replaces[vk_id]
+        else:
+            replace = self.__link(vk_id, vk_name)
+        logger.debug('VK link %s replaced with %s for %s', match.group(0), replace, self.__target)
+        return replace
+
+    def rewrite(self, text: str) -> str:
+        '''Return text with all target rules applied'''
+        return self.__pattern.sub(self.__replace, text)
@@ -0,0 +1,94 @@
+'''
+This module contains adaptive polling scheduler.
+Interval is short right after new posts and grows with jitter
+while source is quiet or unavailable.
+'''
+from __future__ import annotations
+
+import time
+import random
+import logging
+import threading
+from typing import NamedTuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class CycleResult(NamedTuple):
+    '''Outcome of one repost cycle, used to choose next interval'''
+    new_posts: int
+    source_error: bool = False
+
+
+class PollScheduler:
+    '''
+    Chooses pause between repost cycles within min and max interval.
+    Pause is interrupted when wakeup event is set, e.g. by VK Long Poll.
+    '''
+    def __init__(
+        self,
+        start_interval: float,
+        min_interval: float,
+        max_interval: float,
+        backoff: float = 2,
+        jitter: float = 0.1,
+        wakeup: threading.Event | None = None
+    ):
+        self.__min_interval = min_interval
+        self.__max_interval = max(max_interval, min_interval)
+        self.__interval = min(max(start_interval, min_interval), self.__max_interval)
+        self.__backoff = backoff
+        self.__jitter = jitter
+        self.__wakeup = wakeup
+
+    @property
+    def interval(self) -> float:
+        ''' Return current interval without jitter '''
+        return self.__interval
+
+    def update(self, result: CycleResult) -> float:
+        '''
+        Tighten interval after new posts, back off after idle or failed cycle
+        '''
+        if result.new_posts and not result.source_error:
+            self.__interval = self.__min_interval
+        else:
+            self.__interval = min(self.__interval * self.__backoff, self.__max_interval)
+        logger.debug(
+            'Cycle result %s, next interval %.1f s',
+            result,
+            self.__interval
+        )
+        return self.__interval
+
+    def wait(self) -> bool:
+        '''
+        Sleep for jittered interval. Return True if pause was interrupted by wakeup.
+        '''
+        pause = self.__interval * random.uniform(1 - self.__jitter, 1 + self.__jitter)
+        logger.debug('Sleep %.1f s', pause)
+        if self.__wakeup is None:
+            time.sleep(pause)
+            return False
+        if woken := self.__wakeup.wait(pause):
+            self.__wakeup.clear()
+            logger.debug('Pause interrupted by wakeup')
+        return woken
+
+
+def get_scheduler(config: dict, wakeup: threading.Event | None = None) -> PollScheduler:
+    '''
+    Return scheduler, configured by config['schedule'].
+    config['pool_interval'] is interval after start.
+    '''
+    schedule_config = config.get('schedule') or {}
+    pool_interval = config['pool_interval']
+    return PollScheduler(
+        start_interval=pool_interval,
+        min_interval=schedule_config.get('min_interval', pool_interval),
+        max_interval=schedule_config.get('max_interval', pool_interval),
+        backoff=schedule_config.get('backoff', 2),
+        jitter=schedule_config.get('jitter', 0.1),
+        wakeup=wakeup
+    )
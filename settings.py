@@ -0,0 +1,409 @@
+'''
+This module contains validated application config.
+YAML is checked once when it is loaded, structures derived from it
+(enabled targets, proxies, caption rewriters) are built at the same time.
+Config file is watched and replaced between repost cycles.
+'''
+from __future__ import annotations
+
+import os
+import re
+import logging
+from typing import NamedTuple
+import yaml
+from autoposter_http import PROXIED_SERVICES
+from ratelimit import RETRY_POLICIES
+from rewriter import TARGET_RULES, CaptionRewriter
+
+
+logger = logging.getLogger(__name__)
+
+TARGETS = ('telegram', 'instagram')
+SOURCES = ('vk',)
+ENGINES = ('sync', 'async')
+# Route of config without routes section, its job store is kept in jobs.sqlite
+DEFAULT_ROUTE = 'default'
+ROUTE_NAME = re.compile(r'[\w-]+')
+
+NUMBER = (int, float)
+TEXT = (str,)
+FLAG = (bool,)
+INTEGER = (int,)
+SECTION = (dict,)
+
+
+class ConfigError(ValueError):
+    '''Config is invalid'''
+
+
+class Field(NamedTuple):
+    '''
+    Config value types. Value is required if required is True
+    or if target, named by required_by, is enabled.
+    Routed value is not required, when config has routes, every route sets its own.
+    '''
+    types: tuple
+    required: bool = False
+    required_by: str | None = None
+    routed: bool = False
+
+
+# section (None for top level): key: field
+SCHEMA: dict[str | None, dict[str, Field]] = {
+    None: {
+        'temp_dir': Field(TEXT, required=True),
+        'source': Field(TEXT, required=True),
+        'pool_interval': Field(NUMBER, required=True),
+        'engine': Field(TEXT),
+        'max_posts_ahead': Field(INTEGER),
+        'jobs_keep_days': Field(NUMBER),
+        'log_level': Field(TEXT, required=True),
+        'log_format': Field(TEXT, required=True),
+        'schedule': Field(SECTION),
+        'telegram': Field(SECTION, required=True),
+        'vk': Field(SECTION, required=True),
+        'instagram': Field(SECTION, required=True),
+        'imagga': Field(SECTION, required_by='instagram'),
+        'translation': Field(SECTION),
+        'replaces': Field(SECTION),
+        'metrics': Field(SECTION),
+        'media_server': Field(SECTION),
+        'downloader': Field(SECTION),
+        'media': Field(SECTION),
+        'backfill': Field(SECTION),
+        'retry': Field(SECTION),
+        'routes': Field(SECTION),
+    },
+    'schedule': {
+        'min_interval': Field(NUMBER),
+        'max_interval': Field(NUMBER),
+        'backoff': Field(NUMBER),
+        'jitter': Field(NUMBER),
+    },
+    'telegram': {
+        'enabled': Field(FLAG, required=True),
+        'channel_id': Field((int, str, list), required_by='telegram', routed=True),
+        'token': Field(TEXT, required_by='telegram'),
+    },
+    'vk': {
+        'enabled': Field(FLAG),
+        'token': Field(TEXT, required=True),
+        'group_id': Field(INTEGER, required=True, routed=True),
+        'first_page_size': Field(INTEGER),
+        'long_poll': Field(FLAG),
+    },
+    'instagram': {
+        'enabled': Field(FLAG, required=True),
+        'app_token': Field(TEXT, required_by='instagram', routed=True),
+        'timeout': Field(NUMBER, required_by='instagram'),
+        'concurrency': Field(INTEGER),
+        'container_timeout': Field(NUMBER),
+        'proxy': Field(TEXT),
+        'web_photo_location': Field(TEXT, required_by='instagram'),
+        'fill_color': Field(TEXT, required_by='instagram'),
+        'jpeg_quality': Field(INTEGER),
+        'render_workers': Field(INTEGER),
+        'render_in_flight': Field(INTEGER),
+        'default_tags': Field((list,)),
+        'total_tags_count': Field(INTEGER, required_by='instagram'),
+    },
+    'imagga': {
+        'api_key': Field(TEXT, required_by='instagram'),
+        'api_secret': Field(TEXT, required_by='instagram'),
+        'timeout': Field(NUMBER, required_by='instagram'),
+        'concurrency': Field(INTEGER),
+        'requests_per_second': Field(NUMBER),
+        'cache': Field(SECTION),
+    },
+    'translation': {
+        'src_lang': Field(TEXT),
+        'dst_lang': Field(TEXT),
+        'cache_size': Field(INTEGER),
+        'timeout': Field(NUMBER),
+    },
+    'metrics': {
+        'enabled': Field(FLAG),
+        'host': Field(TEXT),
+        'port': Field(INTEGER),
+    },
+    'media_server': {
+        'enabled': Field(FLAG),
+        'host': Field(TEXT),
+        'port': Field(INTEGER),
+        'cache_mb': Field(NUMBER),
+    },
+    'downloader': {
+        'workers': Field(INTEGER),
+        'timeout': Field(NUMBER),
+        'max_time': Field(NUMBER),
+        'max_size_mb': Field(NUMBER),
+        'attempts': Field(INTEGER),
+    },
+    'media': {
+        'retention_hours': Field(NUMBER),
+        'orphan_hours': Field(NUMBER),
+        'quota_mb': Field(NUMBER),
+        'gc_interval': Field(NUMBER),
+    },
+    'backfill': {
+        'batch': Field(INTEGER),
+        'download_workers': Field(INTEGER),
+        'tag_concurrency': Field(INTEGER),
+        'render_workers': Field(INTEGER),
+        'posts_ahead': Field(INTEGER),
+        'rate_per_hour': Field(SECTION),
+        'report_interval': Field(NUMBER),
+    },
+}
+
+# Route key: field of every route in config['routes']
+ROUTE_SCHEMA: dict[str, Field] = {
+    'vk_group_id': Field(INTEGER, required=True),
+    'vk_token': Field(TEXT),
+    'telegram_channel_id': Field((int, str, list)),
+    'instagram_token': Field(TEXT),
+}
+
+# Retry key: field of every service in config['retry']
+RETRY_SCHEMA: dict[str, Field] = {
+    'attempts': Field(INTEGER),
+    'delay': Field(NUMBER),
+    'max_delay': Field(NUMBER),
+    'requests_per_second': Field(NUMBER),
+}
+
+# Settings, used to create process-wide services, are applied after restart only
+RESTART_KEYS = (
+    ('temp_dir',),
+    ('downloader',),
+    ('media',),
+    ('translation',),
+    ('metrics',),
+    ('media_server',),
+    ('vk', 'long_poll'),
+    ('instagram', 'render_workers'),
+    ('instagram', 'render_in_flight'),
+    ('imagga', 'cache'),
+)
+
+
+def validate(raw: dict) -> list[str]:
+    '''Return list of config problems, empty if config is valid'''
+    if not isinstance(raw, dict):
+        return ['config must be a mapping']
+
+    def is_required(field: Field) -> bool:
+        if field.routed and raw.get('routes'):
+            return False
+        return field.required or bool(
+            field.required_by
+            and isinstance(raw.get(field.required_by), dict)
+            and raw[field.required_by].get('enabled') is True
+        )
+
+    errors = []
+    for section, fields in SCHEMA.items():
+        values = raw if section is None else raw.get(section)
+        if not isinstance(values, dict):
+            # Missing section is reported by top level check
+            continue
+        errors.extend(_check_fields(values, fields, section, is_required))
+    for route, values in (raw.get('routes') or {}).items():
+        if not isinstance(route, str) or not ROUTE_NAME.fullmatch(route):
+            errors.append(f'route name {route} must be letters, digits, "_" or "-"')
+        elif not isinstance(values, dict):
+            errors.append(f'routes.{route} must be mapping')
+        else:
+            errors.extend(_check_fields(values, ROUTE_SCHEMA, f'routes.{route}', is_required))
+    for service, values in (raw.get('retry') or {}).items():
+        if service not in RETRY_POLICIES:
+            errors.append(f'retry.{service} must be one of {", ".join(RETRY_POLICIES)}')
+        elif not isinstance(values, dict):
+            errors.append(f'retry.{service} must be mapping')
+        else:
+            errors.extend(_check_fields(values, RETRY_SCHEMA, f'retry.{service}', is_required))
+
+    if not errors:
+        if raw['source'] not in SOURCES:
+            errors.append(f'source must be one of {", ".join(SOURCES)}')
+        if raw.get('engine', 'sync') not in ENGINES:
+            errors.append(f'engine must be one of {", ".join(ENGINES)}')
+        if raw['pool_interval'] <= 0:
+            errors.append('pool_interval must be positive')
+        if not 1 <= raw['instagram'].get('jpeg_quality', 75) <= 95:
+            errors.append('instagram.jpeg_quality must be 1..95')
+        for vk_id, replace in (raw.get('replaces') or {}).items():
+            if not isinstance(replace, dict):
+                errors.append(f'replaces.{vk_id} must be mapping of target to text')
+    return errors
+
+
+def _check_fields(
+    values: dict,
+    fields: dict[str, Field],
+    section: str | None,
+    is_required
+) -> list[str]:
+    '''Return problems of section values'''
+    errors = []
+    for key, field in fields.items():
+        name = key if section is None else f'{section}.{key}'
+        if (value := values.get(key)) is None:
+            if is_required(field):
+                errors.append(f'{name} is required')
+        elif not isinstance(value, field.types) or (
+            isinstance(value, bool) and bool not in field.types
+        ):
+            expected = ' or '.join(value_type.__name__ for value_type in field.types)
+            errors.append(f'{name} must be {expected}, not {type(value).__name__}')
+    return errors
+
+
+def route_raw(raw: dict, route: dict) -> dict:
+    '''
+    Return raw config of route: VK group (and its token, if set)
+    and destinations are replaced by route ones.
+    Target is disabled for route without its destination.
+    '''
+    channel_id = route.get('telegram_channel_id')
+    app_token = route.get('instagram_token')
+    return {
+        **{key: value for key, value in raw.items() if key != 'routes'},
+        'vk': {
+            **raw['vk'],
+            'group_id': route['vk_group_id'],
+            'token': route.get('vk_token') or raw['vk']['token'],
+        },
+        'telegram': {
+            **raw['telegram'],
+            'enabled': raw['telegram']['enabled'] and channel_id is not None,
+            'channel_id': channel_id,
+        },
+        'instagram': {
+            **raw['instagram'],
+            'enabled': raw['instagram']['enabled'] and app_token is not None,
+            'app_token': app_token,
+        },
+    }
+
+
+class AppConfig(dict):
+    '''
+    Validated config. Sections are read as before by config['section']['key'],
+    derived structures are attributes.
+    Every route has its own config: routes is mapping of route name to it.
+    Config with routes section serves no route itself, its route is None.
+    '''
+    def __init__(self, raw: dict, path: str | None = None, route: str = DEFAULT_ROUTE):
+        if errors := validate(raw):
+            raise ConfigError(f'Invalid config {path or "(no path)"}: ' + '; '.join(errors))
+        super().__init__(raw)
+        self.path = path
+        self.route: str | None = route
+        self.routes: dict[str, AppConfig] = {route: self}
+        if raw.get('routes'):
+            self.route = None
+            self.routes = {
+                name: AppConfig(route_raw(raw, values), path, name)
+                for name, values in raw['routes'].items()
+            }
+            for route_config in self.routes.values():
+                route_config.routes = self.routes
+        self.enabled_targets: tuple[str, ...] = tuple(
+            target for target in TARGETS
+            if raw[target]['enabled'] and target != raw['source']
+        )
+        self.proxies: dict[str, dict | None] = {
+            service: {'http': proxy, 'https': proxy}
+            if (proxy := (raw.get(service) or {}).get('proxy')) else None
+            for service in PROXIED_SERVICES
+        }
+        channel_ids = raw['telegram'].get('channel_id')
+        self.channel_ids: tuple = tuple(
+            channel_ids if isinstance(channel_ids, list)
+            else [] if channel_ids is None else [channel_ids]
+        )
+        self.rewriters: dict[str, CaptionRewriter] = {
+            target: CaptionRewriter(raw.get('replaces'), target)
+            for target in TARGET_RULES
+        }
+
+
+def read_config(path: str) -> dict:
+    '''Return raw config from YAML file'''
+    with open(path, encoding='utf-8') as config_file:
+        return yaml.load(config_file, Loader=yaml.FullLoader)
+
+
+def load_config(path: str) -> AppConfig:
+    '''Read and validate config file'''
+    return AppConfig(read_config(path), path)
+
+
+def keep_restart_settings(old: dict, new: dict) -> list[str]:
+    '''
+    Copy settings, which are applied after restart only, from old config to new one.
+    Return names of such settings, changed in new config.
+    '''
+    changed = []
+    if not isinstance(new, dict):
+        return changed
+    for keys in RESTART_KEYS:
+        old_value, new_value = old, new
+        for key in keys:
+            old_value = old_value.get(key) if isinstance(old_value, dict) else None
+            new_value = new_value.get(key) if isinstance(new_value, dict) else None
+        if old_value == new_value:
+            continue
+        changed.append('.'.join(keys))
+        section = new
+        for key in keys[:-1]:
+            if not isinstance(section.get(key), dict):
+                section[key] = {}
+            section = section[key]
+        section[keys[-1]] = old_value
+    return changed
+
+
+class ConfigWatcher:
+    '''
+    Reloads config file when it is changed.
+    Invalid file is reported once and current config is kept.
+    '''
+    def __init__(self, config: AppConfig):
+        self.__config = config
+        self.__stat = self.__file_stat()
+
+    @property
+    def config(self) -> AppConfig:
+        ''' Return current config '''
+        return self.__config
+
+    def __file_stat(self) -> tuple | None:
+        '''Return modification time and size of config file'''
+        try:
+            stat = os.stat(self.__config.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> AppConfig | None:
+        '''
+        Return new config if file is changed and valid, otherwise None
+        '''
+        if (stat := self.__file_stat()) == self.__stat:
+            return None
+        self.__stat = stat
+        try:
+            raw = read_config(self.__config.path)
+            changed = keep_restart_settings(self.__config, raw)
+            config = AppConfig(raw, self.__config.path)
+        except (OSError, yaml.YAMLError, ConfigError) as err:
+            logger.error('Config %s is not reloaded: %s', self.__config.path, err)
+            return None
+
+        if changed:
+            logger.warning('Changes of %s are applied after restart', ', '.join(changed))
+        self.__config = config
+        logger.info('Config %s reloaded', config.path)
+        return config
@@ -0,0 +1,260 @@
+'''
+This module contains long-lived translation service.
+One googletrans client works on its own event loop thread,
+results are memoized in LRU cache persisted to temp_dir.
+Async engine awaits the same client without blocking its own loop.
+'''
+from __future__ import annotations
+
+import os
+import json
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from googletrans import Translator
+from metrics import STAGE_SECONDS, API_CALLS
+
+
+logger = logging.getLogger(__name__)
+
+# Captions joined into one request are split back by this line
+BATCH_SEPARATOR = '\n⁂\n'
+# Google Translate accepts about 5000 characters per request
+BATCH_MAX_CHARS = 4500
+
+
+class TranslationService:
+    '''
+    Translates texts with one reusable googletrans client and memoizes results
+    '''
+    def __init__(
+        self,
+        cache_path: str,
+        max_entries: int = 1000,
+        timeout: float = 10,
+        src_lang: str = 'ru',
+        dst_lang: str = 'en'
+    ):
+        self.__cache_path = cache_path
+        self.__src_lang = src_lang
+        self.__dst_lang = dst_lang
+        self.__max_entries = max_entries
+        self.__timeout = timeout
+        self.__lock = threading.Lock()
+        self.__cache: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+        self.__load_cache()
+
+        self.__loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self.__loop.run_forever,
+            name='translator',
+            daemon=True
+        ).start()
+        self.__translator = self.__run(self.__create_translator())
+
+    async def __create_translator(self) -> Translator:
+        '''Translator http client must be created on service loop'''
+        return Translator(timeout=self.__timeout)
+
+    def __run(self, coroutine):
+        '''Run coroutine on service loop and wait for result'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result(
+            timeout=self.__timeout * 2
+        )
+
+    async def __run_async(self, coroutine):
+        '''Run coroutine on service loop, result is awaited on caller loop'''
+        return await asyncio.wait_for(
+            asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.__loop)),
+            timeout=self.__timeout * 2
+        )
+
+    def __load_cache(self) -> None:
+        '''Read translations saved by previous run'''
+        if not os.path.exists(self.__cache_path):
+            return
+        try:
+            with open(self.__cache_path, encoding='utf-8') as cache_file:
+                for src_lang, dst_lang, text, translation in json.load(cache_file):
+                    self.__cache[(text, src_lang, dst_lang)] = translation
+            logger.debug('%s translations loaded from %s', len(self.__cache), self.__cache_path)
+        except (OSError, ValueError) as err:
+            logger.warning('Cannot load translations from %s: %s', self.__cache_path, err)
+
+    def __save_cache(self) -> None:
+        '''Write cache to temp file and rename it, so file is never half-written'''
+        with self.__lock:
+            entries = [
+                [src_lang, dst_lang, text, translation]
+                for (text, src_lang, dst_lang), translation in self.__cache.items()
+            ]
+        temp_path = self.__cache_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(entries, cache_file, ensure_ascii=False)
+        os.replace(temp_path, self.__cache_path)
+
+    def __remember(self, key: tuple[str, str, str], translation: str) -> None:
+        '''Store translation, dropping least recently used ones above max_entries'''
+        with self.__lock:
+            self.__cache[key] = translation
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.__max_entries:
+                self.__cache.popitem(last=False)
+
+    def __cached(self, key: tuple[str, str, str]) -> str | None:
+        '''Return memoized translation or None'''
+        with self.__lock:
+            if (translation := self.__cache.get(key)) is not None:
+                self.__cache.move_to_end(key)
+            return translation
+
+    def translate(self, text: str, src_lang: str | None = None, dst_lang: str | None = None) -> str:
+        '''Translate text, using memoized result if any'''
+        return self.translate_many([text], src_lang, dst_lang)[0]
+
+    def translate_many(
+        self,
+        texts: list[str],
+        src_lang: str | None = None,
+        dst_lang: str | None = None
+    ) -> list[str]:
+        '''
+        Translate several texts. Texts not translated yet
+        are sent in as few requests as possible.
+        '''
+        src_lang = src_lang or self.__src_lang
+        dst_lang = dst_lang or self.__dst_lang
+        missing = self.__missing(texts, src_lang, dst_lang)
+
+        for batch in self.__batches(missing):
+            try:
+                with STAGE_SECONDS.time('translation'):
+                    translations = self.__run(self.__translate_batch(batch, src_lang, dst_lang))
+            except Exception:
+                API_CALLS.inc('translate', 'error')
+                raise
+            self.__store(batch, translations, src_lang, dst_lang)
+
+        return self.__results(texts, missing, src_lang, dst_lang)
+
+    async def translate_many_async(
+        self,
+        texts: list[str],
+        src_lang: str | None = None,
+        dst_lang: str | None = None
+    ) -> list[str]:
+        '''
+        Same as translate_many, awaited from other event loop
+        '''
+        src_lang = src_lang or self.__src_lang
+        dst_lang = dst_lang or self.__dst_lang
+        missing = self.__missing(texts, src_lang, dst_lang)
+
+        for batch in self.__batches(missing):
+            try:
+                with STAGE_SECONDS.time('translation'):
+                    translations = await self.__run_async(
+                        self.__translate_batch(batch, src_lang, dst_lang)
+                    )
+            except Exception:
+                API_CALLS.inc('translate', 'error')
+                raise
+            self.__store(batch, translations, src_lang, dst_lang)
+
+        return self.__results(texts, missing, src_lang, dst_lang)
+
+    def __missing(self, texts: list[str], src_lang: str, dst_lang: str) -> list[str]:
+        '''Return unique texts, not translated yet'''
+        return list(dict.fromkeys(
+            text for text in texts
+            if text and self.__cached((text, src_lang, dst_lang)) is None
+        ))
+
+    def __store(
+        self,
+        batch: list[str],
+        translations: list[str],
+        src_lang: str,
+        dst_lang: str
+    ) -> None:
+        '''Memoize translations of batch'''
+        API_CALLS.inc('translate', 'ok')
+        for text, translation in zip(batch, translations):
+            logger.info('Text %s translated as %s', text, translation)
+            self.__remember((text, src_lang, dst_lang), translation)
+
+    def __results(
+        self,
+        texts: list[str],
+        missing: list[str],
+        src_lang: str,
+        dst_lang: str
+    ) -> list[str]:
+        '''Save cache if it is changed and return translations of texts'''
+        if missing:
+            try:
+                self.__save_cache()
+            except OSError as err:
+                logger.warning('Cannot save translations to %s: %s', self.__cache_path, err)
+
+        return [
+            (self.__cached((text, src_lang, dst_lang)) or text) if text else text
+            for text in texts
+        ]
+
+    @staticmethod
+    def __batches(texts: list[str]) -> list[list[str]]:
+        '''Group texts so joined batch fits into one request'''
+        batches = []
+        size = BATCH_MAX_CHARS
+        for text in texts:
+            if size + len(text) + len(BATCH_SEPARATOR) > BATCH_MAX_CHARS:
+                batches.append([])
+                size = 0
+            batches[-1].append(text)
+            size += len(text) + len(BATCH_SEPARATOR)
+        return batches
+
+    async def __translate_batch(
+        self,
+        batch: list[str],
+        src_lang: str,
+        dst_lang: str
+    ) -> list[str]:
+        '''Translate batch of texts as one joined text'''
+        result = await self.__translator.translate(
+            BATCH_SEPARATOR.join(batch),
+            src=src_lang,
+            dest=dst_lang
+        )
+        if len(batch) == 1:
+            return [result.text]
+
+        translations = result.text.split(BATCH_SEPARATOR.strip())
+        if len(translations) == len(batch):
+            return [translation.strip() for translation in translations]
+
+        logger.debug('Batch of %s texts cannot be split back, translating one by one', len(batch))
+        results = await self.__translator.translate(batch, src=src_lang, dest=dst_lang)
+        return [result.text for result in results]
+
+
+_translation_service: TranslationService | None = None
+
+
+def get_translation_service(config: dict) -> TranslationService:
+    '''
+    Return process-wide translation service, configured by config['translation']
+    '''
+    global _translation_service # pylint: disable=global-statement
+    if _translation_service is None:
+        translation_config = config.get('translation') or {}
+        _translation_service = TranslationService(
+            os.path.join(config['temp_dir'], 'translations.json'),
+            max_entries=translation_config.get('cache_size', 1000),
+            timeout=translation_config.get('timeout', 10),
+            src_lang=translation_config.get('src_lang', 'ru'),
+            dst_lang=translation_config.get('dst_lang', 'en')
+        )
+    return _translation_service